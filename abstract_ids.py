@@ -0,0 +1,257 @@
+"""abstract_ids.py
+
+Stable, anonymous abstract ids, kept in a registry on disk.
+
+Drawing the ids at random for every run means that adding or removing a single submission
+changes the id of every abstract after it, which invalidates the abstract pdf, the bundles and
+the assignments that were made with the old ids. Instead, each submission is identified by a
+fingerprint of who submitted it and its title, and the registry maps each fingerprint to the id
+that it was given the first time it was seen, so the ids survive reruns, late submissions and
+withdrawals.
+
+New ids are the values of a keyed permutation of the id space (a small Feistel network, with
+cycle walking to stay inside the space), taken in order:
+
+    id = low + permute(counter),  counter = 0, 1, 2, ...
+
+A permutation never repeats itself, so each new id costs O(1) without checking against or
+redrawing around the ids that were already handed out. The key is drawn at random when the
+registry is created and only stored in the registry, so without the registry the ids do not give
+away the order that the abstracts came in. Ids that were kept from the sheet are skipped when
+the permutation comes across them; the permutation is inverted to count how many of those are
+still ahead of the counter, so the id space is only considered full when it really is. The id
+space can be of any size; if it runs out, it is grown 10x, unless its upper end was set
+explicitly.
+
+The registry is a json file:
+
+    {"low": 100, "high": 1000, "key": "...", "counter": 3, "ids": {fingerprint: id, ...}}
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import unicodedata
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+# default id space, three digit ids like the ones used so far
+DEFAULT_LOW, DEFAULT_HIGH = 100, 1000
+
+FEISTEL_ROUNDS = 4
+
+# columns that identify a submission, the first one that is in the sheet is used from each group
+FINGERPRINT_COLUMNS = [
+    ['Email Address', 'Email'],
+    ['Title'],
+]
+
+
+def _normalize(value) -> str:
+    """_normalize
+
+    Lower case, without accents, punctuation or repeated whitespace, so that fixing the
+    capitalization or a typo in the punctuation of a title does not change the fingerprint.
+    """
+    if not isinstance(value, str):
+        return ''
+    value = unicodedata.normalize('NFKD', value)
+    value = ''.join(ch for ch in value if not unicodedata.combining(ch)).lower()
+    return ' '.join(re.sub(r'[^\w\s@.]', ' ', value).split())
+
+
+def submission_fingerprints(students: pd.DataFrame) -> List[str]:
+    """submission_fingerprints
+
+    Fingerprint each submission by its submitter's email and its title. Rows with the same
+    fingerprint (e.g. a submission that was entered twice) are told apart by how many times the
+    fingerprint came up before.
+
+    Args:
+        students (pd.DataFrame): abstract submissions
+
+    Returns:
+        List[str]: fingerprint of each row
+    """
+    columns = []
+    for group in FINGERPRINT_COLUMNS:
+        columns += [col for col in group if col in students.columns][:1]
+    if not columns:
+        raise ValueError('cannot fingerprint the submissions, none of the columns %s are in the sheet' % FINGERPRINT_COLUMNS)
+
+    seen = {}
+    fingerprints = []
+    for values in zip(*(students[col] for col in columns)):
+        base = hashlib.sha256('\x1f'.join(_normalize(value) for value in values).encode()).hexdigest()[:24]
+        seen[base] = seen.get(base, -1) + 1
+        fingerprints.append(base if not seen[base] else '%s#%d' % (base, seen[base]))
+
+    return fingerprints
+
+
+def permute(value: int, size: int, key: bytes, inverse: bool = False) -> int:
+    """permute
+
+    Keyed permutation of range(size): a balanced Feistel network over the smallest even number of
+    bits that covers size, with cycle walking for the values that fall outside of it.
+
+    Args:
+        value (int): in range(size)
+        size (int): size of the id space
+        key (bytes): secret key of the registry
+        inverse (bool): run the permutation backwards, i.e. find the value that permutes to value
+
+    Returns:
+        int: in range(size), different for every value
+    """
+    half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+    mask = (1 << half_bits) - 1
+
+    def round_function(round_num, half):
+        digest = hashlib.blake2b(b'%d:%d' % (round_num, half), key=key, digest_size=8).digest()
+        return int.from_bytes(digest, 'big') & mask
+
+    while True:
+        left, right = value >> half_bits, value & mask
+        if not inverse:
+            for round_num in range(FEISTEL_ROUNDS):
+                left, right = right, left ^ round_function(round_num, right)
+        else:
+            for round_num in reversed(range(FEISTEL_ROUNDS)):
+                left, right = right ^ round_function(round_num, left), left
+        value = (left << half_bits) | right
+        if value < size:
+            return value
+
+
+def load_registry(registry_path: str) -> dict:
+    """load_registry
+
+    Args:
+        registry_path (str): path of the registry json file
+
+    Returns:
+        dict: the registry, or a new empty one with a random key if registry_path does not exist
+    """
+    if os.path.exists(registry_path):
+        with open(registry_path, 'r') as f:
+            return json.load(f)
+
+    return {
+        'low': DEFAULT_LOW,
+        'high': DEFAULT_HIGH,
+        'key': secrets.token_hex(16),
+        'counter': 0,
+        'ids': {},
+    }
+
+
+def write_registry(registry_path: str, registry: dict) -> None:
+    """write_registry
+
+    Args:
+        registry_path (str): path of the registry json file
+        registry (dict): from load_registry
+    """
+    if os.path.dirname(registry_path):
+        os.makedirs(os.path.dirname(registry_path), exist_ok=True)
+    with open(registry_path + '.tmp', 'w') as f:
+        json.dump(registry, f, indent=1, sort_keys=True)
+    os.replace(registry_path + '.tmp', registry_path)
+
+    return
+
+
+def ids_ahead(registry: dict, used: set, size: int) -> int:
+    """ids_ahead
+
+    Args:
+        registry (dict): from load_registry
+        used (set): ids that are taken
+        size (int): size of the id space
+
+    Returns:
+        int: how many of the taken ids the permutation has not come across yet, and will skip
+    """
+    key = bytes.fromhex(registry['key'])
+    return sum(1 for abs_id in used if 0 <= abs_id - registry['low'] < size
+               and permute(abs_id - registry['low'], size, key, inverse=True) >= registry['counter'])
+
+
+def allocate_ids(fingerprints: List[str], registry_path: str, existing_ids=None,
+                 id_space: Tuple[int, int] = None) -> np.ndarray:
+    """allocate_ids
+
+    Give each submission its id from the registry, and a new id to every submission that is not
+    in the registry yet, then save the registry.
+
+    Args:
+        fingerprints (List[str]): from submission_fingerprints
+        registry_path (str): path of the registry json file
+        existing_ids: optional ids that the submissions already have (e.g. the ids column of
+                      assigned_ids_students.csv), with NaN for the ones that do not. these are kept,
+                      and recorded in the registry
+        id_space (Tuple[int, int]): (lowest id, highest id + 1). if not given, the space of the
+                                    registry is used, and grown if it runs out
+
+    Returns:
+        np.ndarray: int array with the id of each submission
+    """
+    registry = load_registry(registry_path)
+    if id_space is not None and (registry['low'], registry['high']) != tuple(id_space):
+        registry['low'], registry['high'] = id_space
+        log.info('abstract ids are now drawn from %d to %d', registry['low'], registry['high'] - 1)
+
+    ids = registry['ids']
+
+    if existing_ids is not None:
+        owners = {abs_id: fingerprint for fingerprint, abs_id in ids.items()}
+        for fingerprint, abs_id in zip(fingerprints, np.array(existing_ids, dtype=float)):
+            if np.isnan(abs_id) or ids.get(fingerprint) == int(abs_id):
+                continue
+            abs_id = int(abs_id)
+            if abs_id in owners and owners[abs_id] != fingerprint:
+                log.warning('abstract id %d in the sheet was given to a different submission in %s, the sheet wins',
+                            abs_id, registry_path)
+                ids.pop(owners[abs_id], None)
+            ids[fingerprint] = abs_id
+            owners[abs_id] = fingerprint
+
+    new = [fingerprint for fingerprint in dict.fromkeys(fingerprints) if fingerprint not in ids]
+
+    size = registry['high'] - registry['low']
+    used = set(ids.values())
+    # the taken ids that the permutation will come across are skipped, so they do not count as free
+    if new and registry['counter'] + len(new) + ids_ahead(registry, used, size) > size:
+        if id_space is not None:
+            raise ValueError('oh no! %d new abstracts do not fit in the abstract id space %d to %d' % (
+                len(new), registry['low'], registry['high'] - 1))
+        while registry['counter'] + len(new) + ids_ahead(registry, used, size) > size:
+            size *= 10
+        registry['high'] = registry['low'] + size
+        log.info('abstract id space grown to %d to %d', registry['low'], registry['high'] - 1)
+
+    key = bytes.fromhex(registry['key'])
+    for fingerprint in new:
+        while True:
+            if registry['counter'] >= size:
+                raise ValueError('oh no! ran out of abstract ids from %d to %d' % (registry['low'], registry['high'] - 1))
+            abs_id = registry['low'] + permute(registry['counter'], size, key)
+            registry['counter'] += 1
+            # only ids kept from the sheet, or issued before the space was changed, can be taken
+            if abs_id not in used:
+                break
+        ids[fingerprint] = abs_id
+        used.add(abs_id)
+
+    if new or existing_ids is not None:
+        write_registry(registry_path, registry)
+    log.info('%d abstracts kept their ids, %d were given new ids', len(fingerprints) - len(new), len(new))
+
+    return np.array([ids[fingerprint] for fingerprint in fingerprints], dtype=int)
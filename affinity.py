@@ -0,0 +1,248 @@
+"""affinity.py
+
+Judge x abstract affinity from the text of the abstracts and the expertise of the judges, for
+--expertise.
+
+Within a category the greedy assignment only looks at how many abstracts each judge already
+has, so a cardiologist in Clinical Science is as likely to get an orthopedics abstract as a
+cardiology one. The expertise file lists what each judge works on (keywords, or the titles of
+their recent papers), with one or more rows per judge:
+
+    judge,expertise
+    Jane Doe,heart failure; cardiac imaging
+    Jane Doe,Echocardiographic predictors of outcome after valve repair
+
+The titles and sections of each abstract and the expertise of each judge are turned into TF-IDF
+vectors over a shared vocabulary (sublinear term frequency, smoothed inverse document frequency,
+unit length rows), and the affinity of a judge and an abstract is the cosine similarity of their
+vectors, in [0, 1]. Both sets of vectors are sparse matrices, so the whole affinity matrix is a
+single sparse product
+
+    affinity = judges (judges x terms) @ abstracts (abstracts x terms)'
+
+which takes well under a second for thousands of abstracts and hundreds of judges. Judges that
+are not in the expertise file have an affinity of 0 with every abstract.
+
+The matrix is cached in the .msrs_cache folder next to the expertise file, under a hash of
+every text that went into it, so it is only computed again when an abstract or the expertise
+changes.
+"""
+import hashlib
+import logging
+import os
+import re
+import unicodedata
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, diags
+
+from excel_cache import CACHE_DIR_NAME, read_excel_cached
+
+log = logging.getLogger(__name__)
+
+# bump this when the vectors change, so that old cache entries are not used
+AFFINITY_VERSION = 1
+
+# columns of the submissions sheet with the text of each abstract, the title counts twice
+ABSTRACT_TEXT_COLUMNS = [
+    'Title',
+    'Title',
+    'Background',
+    'Methods',
+    'Results',
+    'Conclusion',
+    'Please enter your abstract text below:',
+]
+
+STOP_WORDS = set('''
+    a about above after again against all also am an and any are as at be because been before being
+    below between both but by can could did do does doing down during each few for from further had
+    has have having he her here hers him his how however i if in into is it its itself just may might
+    more most my no nor not of off on once only or other our out over own same she should so some
+    such than that the their them then there these they this those through to too under until up
+    upon very was we were what when where which while who whom why will with within without would
+    you your
+    abstract aim aims background conclusion conclusions data found methods objective patient patients
+    purpose result results showed study studies using used use
+'''.split())
+
+
+def tokenize(text) -> List[str]:
+    """tokenize
+
+    Args:
+        text (str): any text, non strings are treated as empty
+
+    Returns:
+        List[str]: lower case words without accents or stop words, with plurals stripped,
+                   e.g. 'Cardiac MRI outcomes' -> ['cardiac', 'mri', 'outcome']
+    """
+    if not isinstance(text, str):
+        return []
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch)).lower()
+
+    tokens = []
+    for token in re.findall(r'[a-z][a-z0-9]+', text):
+        if token in STOP_WORDS:
+            continue
+        if len(token) > 4 and token.endswith('s') and not token.endswith(('ss', 'us', 'is')):
+            token = token[:-1]
+        tokens.append(token)
+
+    return tokens
+
+
+def tfidf_vectors(documents: List[str]) -> csr_matrix:
+    """tfidf_vectors
+
+    Args:
+        documents (List[str]): the documents
+
+    Returns:
+        csr_matrix: (documents x terms) TF-IDF matrix with unit length rows (rows of empty
+                    documents are all 0)
+    """
+    vocabulary = {}
+    indices = []
+    indptr = [0]
+    for document in documents:
+        indices.extend(vocabulary.setdefault(token, len(vocabulary)) for token in tokenize(document))
+        indptr.append(len(indices))
+
+    counts = csr_matrix((np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int64),
+                         np.array(indptr, dtype=np.int64)), shape=(len(documents), len(vocabulary)))
+    counts.sum_duplicates()
+
+    doc_freq = np.bincount(counts.indices, minlength=len(vocabulary))
+    idf = np.log((1 + len(documents)) / (1 + doc_freq)) + 1
+
+    vectors = counts.copy()
+    vectors.data = (1 + np.log(vectors.data)) * idf[vectors.indices]
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+
+    return csr_matrix(diags(1 / norms) @ vectors, dtype=np.float32)
+
+
+def name_key(name: str) -> str:
+    """name_key
+
+    Returns:
+        str: the judge name, lower case and with single spaces, to match the expertise file
+    """
+    return ' '.join(str(name).lower().split())
+
+
+def read_expertise(expertise_file: str) -> Dict[str, str]:
+    """read_expertise
+
+    Args:
+        expertise_file (str): csv or excel file with the columns judge (first and last name, as in
+                              unified.csv) and expertise, with any number of rows per judge
+
+    Returns:
+        Dict[str, str]: mapping of [name_key of the judge] -> [all of their expertise]
+    """
+    if expertise_file.endswith('.csv'):
+        expertise = pd.read_csv(expertise_file)
+    else:
+        expertise = read_excel_cached(expertise_file)
+
+    expertise = expertise[['judge', 'expertise']].dropna()
+    expertise['judge'] = expertise['judge'].map(name_key)
+
+    return expertise.groupby('judge')['expertise'].agg(lambda texts: ' \n'.join(map(str, texts))).to_dict()
+
+
+def abstract_documents(student_df: pd.DataFrame) -> List[str]:
+    """abstract_documents
+
+    Args:
+        student_df (pd.DataFrame): full students dataframe from preprocess_abstract_submissions
+
+    Returns:
+        List[str]: the text of each abstract, from the ABSTRACT_TEXT_COLUMNS that are in the sheet
+    """
+    columns = [col for col in ABSTRACT_TEXT_COLUMNS if col in student_df.columns]
+    if not columns:
+        log.warning('none of the abstract text columns %s are in the submissions, the affinities are all 0',
+                    sorted(set(ABSTRACT_TEXT_COLUMNS)))
+        return [''] * len(student_df)
+
+    return [' \n'.join(text for text in texts if isinstance(text, str)) for texts in zip(*(student_df[col] for col in columns))]
+
+
+def compute_affinity(student_df: pd.DataFrame, judge_names: List[str], expertise_file: str,
+                     use_cache: bool = True) -> dict:
+    """compute_affinity
+
+    Args:
+        student_df (pd.DataFrame): full students dataframe from preprocess_abstract_submissions
+        judge_names (List[str]): judge names in "first last" format
+        expertise_file (str): see read_expertise
+        use_cache (bool): whether the matrix may be loaded from / saved to the cache
+
+    Returns:
+        dict: with the keys
+            - matrix: float32 array of shape (num judges, num abstracts), the affinity of each pair
+            - judge_pos: mapping of [judge name] -> [row]
+            - abstract_pos: mapping of [abstract id] -> [column]
+    """
+    expertise = read_expertise(expertise_file)
+    abstract_ids = [int(abs_id) for abs_id in student_df['ids']]
+    abstract_docs = abstract_documents(student_df)
+    judge_docs = [expertise.get(name_key(name), '') for name in judge_names]
+
+    missing = [name for name, doc in zip(judge_names, judge_docs) if not doc]
+    if missing:
+        log.warning('%d / %d judges are not in %s, their abstracts are assigned by load only: %s',
+                    len(missing), len(judge_names), expertise_file, ', '.join(missing))
+
+    key = hashlib.sha1(repr((AFFINITY_VERSION, abstract_ids, abstract_docs, judge_docs)).encode()).hexdigest()[:16]
+    cache_file = os.path.join(os.path.dirname(os.path.abspath(expertise_file)), CACHE_DIR_NAME, 'affinity_%s.npz' % key)
+
+    if use_cache and os.path.exists(cache_file):
+        log.info('loading the judge / abstract affinities from %s', cache_file)
+        matrix = np.load(cache_file)['matrix']
+    else:
+        vectors = tfidf_vectors(abstract_docs + judge_docs)
+        abstract_vectors, judge_vectors = vectors[:len(abstract_docs)], vectors[len(abstract_docs):]
+        matrix = (judge_vectors @ abstract_vectors.T).toarray().astype(np.float32)
+        log.info('computed the affinities of %d judges and %d abstracts over %d terms',
+                 len(judge_names), len(abstract_ids), vectors.shape[1])
+        if use_cache:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            np.savez_compressed(cache_file, matrix=matrix)
+
+    return {
+        'matrix': matrix,
+        'judge_pos': {name: idx for idx, name in enumerate(judge_names)},
+        'abstract_pos': {abs_id: idx for idx, abs_id in enumerate(abstract_ids)},
+    }
+
+
+def category_affinity(affinity: dict, judge_names: List[str], abstract_ids: List[int]) -> dict:
+    """category_affinity
+
+    Cut the affinities of a single category out of the matrix from compute_affinity, so that
+    only these are sent to the process that assigns the category.
+
+    Args:
+        affinity (dict): from compute_affinity
+        judge_names (List[str]): judges of the category
+        abstract_ids (List[int]): abstracts of the category
+
+    Returns:
+        dict: with the same keys as compute_affinity
+    """
+    rows = [affinity['judge_pos'][name] for name in judge_names]
+    columns = [affinity['abstract_pos'][abs_id] for abs_id in abstract_ids]
+
+    return {
+        'matrix': affinity['matrix'][np.ix_(rows, columns)],
+        'judge_pos': {name: idx for idx, name in enumerate(judge_names)},
+        'abstract_pos': {abs_id: idx for idx, abs_id in enumerate(abstract_ids)},
+    }
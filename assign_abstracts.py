@@ -10,34 +10,36 @@ There will be two modes for abstract assignment:
 
 """
 import argparse
+import csv
+import heapq
 import logging
 import os
 import random
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from pprint import pprint
 from typing import Dict, List, Union
 
 import numpy as np
 import pandas as pd
-from rich.logging import RichHandler
-
-FORMAT = "%(message)s"
-logging.basicConfig(
-    level="DEBUG",
-    format=FORMAT,
-    datefmt="[%X]",
-    handlers=[RichHandler(rich_tracebacks=True)],
-)
+from scipy.sparse import csr_matrix
+
+from abstract_ids import allocate_ids, submission_fingerprints
+from assignment_store import build_store, write_store
+from excel_cache import clear_excel_cache, read_excel_cached
+from instrumentation import (COUNTERS, LOG_LEVELS, counter_delta, counter_snapshot, merge_counters,
+                             setup_logging, stage, write_metrics)
+from name_matching import build_author_index, match_name
+
 log = logging.getLogger(__name__)
 
 
-def parse_command_line():
-    log.debug('parsing command line')
-    log.debug('='*30)
+def add_arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """add_arguments
 
-    parser = argparse.ArgumentParser(
-        description='Sort student abstracts to faculty judges',
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
-    )
+    Add the command line options of the assignment to parser, so that they can be shared by
+    this script and the msrs assign subcommand.
+    """
     parser.add_argument('--students', action="store", type=str, default="data/students.xlsx",
                         help="file containing abstract submissions"
                         )
@@ -71,22 +73,116 @@ def parse_command_line():
     parser.add_argument('--outdir', action="store", type=str, default='sorted', required=True,
                         help='directory in which output files should be written'
                         )
+    parser.add_argument('--solver', action="store", type=str, default='greedy', choices=['greedy', 'flow'],
+                        help='greedy assignment, or max-flow assignment that always finds a full assignment if one exists'
+                        )
+    parser.add_argument('--workers', action="store", type=int,
+                        help='number of processes used to assign the categories in parallel. defaults to 1, or to all cores with --search_seeds. 1 always runs in this process'
+                        )
+    parser.add_argument('--seed', action="store", type=int, default=2022,
+                        help='seed of the random shuffling, so that the assignments are reproducible'
+                        )
+    parser.add_argument('--search_seeds', '--search-seeds', action="store", type=int, default=0,
+                        help='try this many seeds derived from --seed with the greedy solver, and keep the best assignments (see seed_search.py)'
+                        )
+    parser.add_argument('--expertise', action="store", type=str,
+                        help='csv or excel file with the columns judge and expertise (keywords or recent paper titles). the greedy solver prefers the judges whose expertise is closest to each abstract (see affinity.py)'
+                        )
+    parser.add_argument('--affinity_weight', action="store", type=float, default=0.0,
+                        help='with --expertise, how many abstracts of extra load a perfect match is worth. 0 only uses the expertise to break ties between equally loaded judges'
+                        )
+    parser.add_argument('--parquet', action="store_true",
+                        help='also write the assignments in long format to unified.parquet (requires pyarrow)'
+                        )
+    parser.add_argument('--no_cache', action="store_true",
+                        help='always parse the excel files, instead of loading them from the cache'
+                        )
+    parser.add_argument('--clear_cache', action="store_true",
+                        help='remove the cached copies of the excel files before reading them'
+                        )
+    parser.add_argument('--pool_judges', action="store_true",
+                        help='move judges that signed up for several categories to the categories that are short of judges'
+                        )
+    parser.add_argument('--repair', action="store", type=str,
+                        help='output directory of a previous run. keep its assignments and only reassign the slots affected by changed judges or abstracts'
+                        )
+    add_id_arguments(parser)
+    parser.add_argument('--log_level', '--log-level', action="store", type=str, default='INFO', choices=LOG_LEVELS,
+                        help='only log messages at or above this level'
+                        )
+    parser.add_argument('--metrics', action="store", type=str,
+                        help='if provided, write the wall time and memory of each stage and run counters to this json file'
+                        )
+
+    return parser
+
+
+def add_id_arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """add_id_arguments
+
+    Add the options of the abstract id registry, shared with render_abstracts.py.
+    """
+    parser.add_argument('--id_registry', action="store", type=str,
+                        help='json file that keeps the id of each abstract across runs. defaults to abstract_id_registry.json next to --students'
+                        )
+    parser.add_argument('--id_min', action="store", type=int,
+                        help='lowest abstract id to give out. defaults to the one in the registry (100 for a new registry)'
+                        )
+    parser.add_argument('--id_max', action="store", type=int,
+                        help='highest abstract id to give out. by default the id space grows 10x whenever it runs out'
+                        )
+
+    return parser
 
-    args = vars(parser.parse_args())
-    log.debug(args)
+
+def id_space_from_args(args: dict) -> tuple:
+    """id_space_from_args
+
+    Returns:
+        tuple: (lowest id, highest id + 1) from --id_min and --id_max, or None to use the space of
+               the registry
+    """
+    if args['id_max'] is None:
+        if args['id_min'] is not None:
+            log.warning('--id_min is ignored without --id_max')
+        return None
+
+    return (args['id_min'] if args['id_min'] is not None else 100, args['id_max'] + 1)
+
+
+def parse_command_line():
+
+    parser = argparse.ArgumentParser(
+        description='Sort student abstracts to faculty judges',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    args = vars(add_arguments(parser).parse_args())
+
+    setup_logging(args['log_level'])
+    log.debug('parsing command line')
+    log.debug('='*30)
+    log.debug('%s', args)
     return args
 
 
-def read_judge_cat_assign(judges_file: str, judges_tab: str, judges_header: int, categories: list) -> dict:
+def read_judges(judges_file: str, judges_tab: str, judges_header: int, use_cache: bool = True) -> pd.DataFrame:
 
     log.info('reading judge assignments from file %s' % judges_file)
     log.info('='*30)
 
-    judges = pd.read_excel(judges_file,
-                           sheet_name=judges_tab, header=judges_header, engine='openpyxl')
+    with stage('read'):
+        judges = read_excel_cached(judges_file,
+                                   sheet_name=judges_tab, header=judges_header, use_cache=use_cache, engine='openpyxl')
 
     log.debug('here are the columns read from the judging spreadsheet')
-    log.debug(list(judges.columns))
+    log.debug('%s', list(judges.columns))
+
+    return judges
+
+
+def read_judge_cat_assign(judges_file: str, judges_tab: str, judges_header: int, categories: list, use_cache: bool = True) -> dict:
+
+    judges = read_judges(judges_file, judges_tab, judges_header, use_cache=use_cache)
 
     # for cleanliness
     judges.drop(columns=[
@@ -112,14 +208,61 @@ def read_judge_cat_assign(judges_file: str, judges_tab: str, judges_header: int,
         judges_per_cat[cat] = judges.loc[(judges["Would you like to judge student abstracts?"] == "Yes") & (
             judges["Assignment"] == cat)][output_cols].copy()
 
-        log.debug('judges for category %s' % cat)
-        log.debug('='*30)
-        log.debug(judges_per_cat[cat].to_string())
+        # rendering the whole dataframe is expensive, so only do it if it is going to be logged
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('judges for category %s', cat)
+            log.debug('='*30)
+            log.debug(judges_per_cat[cat].to_string())
 
     return judges_per_cat
 
 
-def write_abstract_assignments(abstract_assignments: dict, judges_per_cat: Dict[str, pd.DataFrame], outdir: str) -> None:
+def build_assignment_table(abstract_assignments: dict, judges_per_cat: Dict[str, pd.DataFrame]) -> dict:
+    """build_assignment_table
+
+    Flatten the judging assignments into arrays, with one row per judge, in category order and
+    in the same order as the judges in each category's dataframe.
+
+    The returned dictionary has the following keys:
+        - category: array of category names
+        - email, first, last: arrays of judge information
+        - load: array with the number of abstracts assigned to each judge
+        - abstracts: int array of shape (num judges, max load) with the abstract ids assigned
+                     to each judge, padded with -1
+
+    Args:
+        abstract_assignments (dict): dictionary of abstract assignments
+        judges_per_cat (dict): dictionary of judge information dataframes
+
+    Returns:
+        dict: the assignment table
+    """
+    categories, emails, firsts, lasts, id_lists = [], [], [], [], []
+    for cat, judge_dict in abstract_assignments.items():
+        category_judges = judges_per_cat[cat]
+        for email, first, last in zip(category_judges['Email Address'], category_judges['First Name'], category_judges['Last Name']):
+            categories.append(cat)
+            emails.append(email)
+            firsts.append(first)
+            lasts.append(last)
+            id_lists.append(judge_dict["%s %s" % (first.strip(), last.strip())])
+
+    load = np.array([len(id_list) for id_list in id_lists], dtype=int)
+    abstracts = np.full((len(id_lists), load.max() if len(load) else 0), -1, dtype=int)
+    for row, id_list in enumerate(id_lists):
+        abstracts[row, :len(id_list)] = id_list
+
+    return {
+        'category': np.array(categories, dtype=object),
+        'email': np.array(emails, dtype=object),
+        'first': np.array(firsts, dtype=object),
+        'last': np.array(lasts, dtype=object),
+        'load': load,
+        'abstracts': abstracts,
+    }
+
+
+def write_abstract_assignments(abstract_assignments: dict, judges_per_cat: Dict[str, pd.DataFrame], outdir: str, parquet: bool = False) -> None:
     """write_abstract_assignments
 
     Function for writing out all of the judging assignments. 
@@ -130,137 +273,295 @@ def write_abstract_assignments(abstract_assignments: dict, judges_per_cat: Dict[
     judges_per_cat is a dictionary that maps [category] -> pandas dataframe of the 
     judging information, e.g. name, email, etc. 
 
+    The per-category files and unified.csv are written together in a single pass over the
+    judges. The Abs1 ... Absn header is sized to the largest number of abstracts assigned
+    to a single judge, and fields are quoted as needed, so commas in names are safe. The same
+    assignments are written to assignments.npz (see assignment_store.py), which is what the
+    later steps read.
+
     Args:
         abstract_assignments (dict): dictionary of abstract assignments 
         judges_per_cat (dict): dictionary of judge information dataframes  
         outdir (str): directory where judge abstract assignments should be written
+        parquet (bool): also write the assignments in long format to unified.parquet
     """
     log.info('writing the abstract assignments for each judge to file')
     log.info('='*30)
 
-    # first, we will write all of the abstract assignments in one file for each of the categories
-    for cat, judge_dict in abstract_assignments.items():
-        category_judges = judges_per_cat[cat]
-
-        # we expect category_judges to be a df with the following columns:
-        # judge email
-        # judge first name
-        # judge last name
-
-        with open(os.path.join(outdir, "abstract_assignments_%s.csv" % cat.replace(" ", "_")), "w") as f:
-
-            # write the header line. We need to add Abs 1 ... Abs n to the column headers also.
-            f.writelines(','.join(
-                list(category_judges.columns) + ['Abs%d' % i for i in range(1, 16)]) + "\n")
-
-            # iterate over the judges to write out each judge's assigned abstracts
-            for idx, (email, first, last) in category_judges.iterrows():
-                name_key = "%s %s" % (first.strip(), last.strip())
-                judge_abstract_id_list = judge_dict[name_key]
-                f.writelines(
-                    ','.join([email, first, last] + list(map(str, judge_abstract_id_list))) + "\n")
-
-    # write out an additional file that contains all of the judge abstract assignments,
-    # instead of as individual files.
-    with open(os.path.join(outdir, 'unified.csv'), 'w') as f:
-
-        # write the header line. This time, it will be [category] [email] [first] [last] [abs 1] ... [abs n]
-        f.writelines(','.join(
-            ['category'] + list(category_judges.columns) + ['Abs%d' % i for i in range(1, 16)])
-            + "\n")
-
-        # again, iterate over all judges in all categories
-        for cat, judge_dict in abstract_assignments.items():
-            category_judges = judges_per_cat[cat]
-
-            for idx, (email, first, last) in category_judges.iterrows():
-                name_key = "%s %s" % (first.strip(), last.strip())
-                judge_abstract_id_list = judge_dict[name_key]
-                f.writelines(
-                    ','.join([cat.replace(',', ';'), email, first, last] + list(map(str, judge_abstract_id_list))) + "\n")
+    table = build_assignment_table(abstract_assignments, judges_per_cat)
+    judge_cols = ['Email Address', 'First Name', 'Last Name']
+
+    write_store(build_store(table), outdir)
+
+    with ExitStack() as stack:
+        # one file for each of the categories, and one that contains all of the judge abstract assignments
+        category_writers = {}
+        for cat in abstract_assignments:
+            f = stack.enter_context(open(os.path.join(
+                outdir, "abstract_assignments_%s.csv" % cat.replace(" ", "_")), "w", newline=''))
+            category_writers[cat] = csv.writer(f)
+            category_load = table['load'][table['category'] == cat]
+            category_writers[cat].writerow(
+                judge_cols + ['Abs%d' % i for i in range(1, (category_load.max() if len(category_load) else 0) + 1)])
+
+        f = stack.enter_context(open(os.path.join(outdir, 'unified.csv'), 'w', newline=''))
+        unified_writer = csv.writer(f)
+        unified_writer.writerow(
+            ['category'] + judge_cols + ['Abs%d' % i for i in range(1, table['abstracts'].shape[1] + 1)])
+
+        for cat, email, first, last, load, abstracts in zip(
+                table['category'], table['email'], table['first'], table['last'], table['load'], table['abstracts']):
+            judge_abstract_id_list = abstracts[:load].tolist()
+            category_writers[cat].writerow([email, first, last] + judge_abstract_id_list)
+            unified_writer.writerow([cat, email, first, last] + judge_abstract_id_list)
+
+    if parquet:
+        # long format, one row per (judge, abstract) assignment
+        judge_idx = np.repeat(np.arange(len(table['load'])), table['load'])
+        slots = np.concatenate([np.arange(load) for load in table['load']]) if len(judge_idx) else np.array([], dtype=int)
+        pd.DataFrame({
+            'category': table['category'][judge_idx],
+            'Email Address': table['email'][judge_idx],
+            'First Name': table['first'][judge_idx],
+            'Last Name': table['last'][judge_idx],
+            'slot': slots + 1,
+            'abstract id': table['abstracts'][judge_idx, slots],
+        }).to_parquet(os.path.join(outdir, 'unified.parquet'), index=False)
 
     return
 
 
-def assign_abstracts_to_judges(id_df, category_judges, JUDGES_PER_ABSTRACT=4, JUDGE_LIM=15):
+def assign_abstracts_to_judges(id_df, category_judges, JUDGES_PER_ABSTRACT=4, JUDGE_LIM=15, conflict_index=None,
+                               affinity=None, affinity_weight=0.0):
 
     log.info('sorting abstracts to judges')
     log.info('-- judges per abstract: %d, max abstracts per judge: %d' %
              (JUDGES_PER_ABSTRACT, JUDGE_LIM))
     log.info('='*30)
 
-    id_df = id_df.sample(frac=1).reset_index(drop=True)
     judge_dict = {"%s %s" % (first.strip(), last.strip()): [] for first, last in zip(
         category_judges['First Name'], category_judges['Last Name'])}
 
+    # the conflict index is built before shuffling, since it is keyed on judge name and abstract id
+    if conflict_index is None:
+        conflict_index = build_conflict_index(id_df, list(judge_dict.keys()))
+    conflict_matrix = conflict_index['matrix']
+    judge_pos = conflict_index['judge_pos']
+    abstract_pos = conflict_index['abstract_pos']
+
+    id_df = id_df.sample(frac=1).reset_index(drop=True)
+
+    # priority queue of the judges, keyed by the number of abstracts they have been assigned.
+    # ties are broken using rng so that there is still random shuffling. judges that have
+    # been fully assigned are not pushed back, so everything in the heap is free to judge.
+    judge_heap = [(0, np.random.random_sample(), name) for name in judge_dict.keys()]
+    heapq.heapify(judge_heap)
+
     opted_out = []
-    judge_conflict_identified = []
     for idx, (abs_id, cat, authors, to_judge) in id_df.iterrows():
 
         if to_judge != 'Yes':
-            log.debug('abstract %d opt out' % (abs_id))
+            log.debug('abstract %d opt out', abs_id)
             opted_out.append(abs_id)
             continue
 
-        # reorder judges so that the assignment is not order dependent
-        # shuffled_names = list(judge_dict.keys())
-        # random.shuffle(shuffled_names)
+        # column of the conflict matrix for this abstract
+        abstract_conflicts = conflict_matrix[:, abstract_pos[abs_id]]
+
+        # assign each abstract to the pre-defined number of least loaded judges.
+        # each judge is popped at most once per abstract, so no judge gets the abstract twice
+        # with affinities, the judges closest to the abstract are preferred among the least loaded
+        preference = None
+        if affinity is not None:
+            abstract_affinity = affinity['matrix'][:, affinity['abstract_pos'][abs_id]]
+            preference = lambda name: abstract_affinity[affinity['judge_pos'][name]]
+        selected = select_least_loaded_judges(
+            judge_heap, JUDGES_PER_ABSTRACT, lambda name: abstract_conflicts[judge_pos[name]],
+            preference=preference, preference_weight=affinity_weight)
+
+        for name in selected:
+            judge_dict[name].append(abs_id)
+            if len(judge_dict[name]) < JUDGE_LIM:
+                heapq.heappush(judge_heap, (len(judge_dict[name]), np.random.random_sample(), name))
+
+        if len(selected) < JUDGES_PER_ABSTRACT:
+            COUNTERS['abstracts_under_assigned'] += 1
+            log.warning('oh no! only able to assign abstract id %d to %d / %d judges' %
+                        (abs_id, len(selected), JUDGES_PER_ABSTRACT))
 
-        names = [(name, len(judge_dict[name]), np.random.randn(1))
-                 for name in judge_dict.keys()]
+    log.info('opted out: %s ', opted_out)
+    log.info('judge conflicts: %d', len(conflict_index['conflicts']))
+    log.debug('final judging assignments:')
+    if log.isEnabledFor(logging.DEBUG):
+        for k, v in judge_dict.items():
+            log.debug('%s ; \t\t %s', k, v)
 
-        # sort the judge names in ascending order by the number of abstracts that they have been assigned
-        # break ties at each level using rng so that there is still random shuffling
-        names.sort(key=lambda x: (x[1], x[2]))
+    return judge_dict
 
-        # pull out just the name field again
-        shuffled_names = [name[0] for name in names]
 
-        # keep track of whether assignments are successful
-        status = [False]*JUDGES_PER_ABSTRACT
+def select_least_loaded_judges(judge_heap: list, num_judges: int, is_conflicted, preference=None,
+                               preference_weight: float = 0.0) -> List[str]:
+    """select_least_loaded_judges
 
-        # assign each abstract to the pre-defined number of judges
-        for iteration in range(JUDGES_PER_ABSTRACT):
+    Pop the num_judges least loaded judges without a conflict off of judge_heap, which is a
+    heap of (number of abstracts assigned, random tie break, judge name) tuples.
 
-            # loop over judges to see if any are free to judge the abstract
-            for name in shuffled_names:
-                cur_abs = judge_dict[name]
+    Judges with a conflict are pushed back unchanged. The selected judges are NOT pushed back,
+    the caller is expected to push them back with their updated load, or leave them out if they
+    have hit the limit. This costs O((num_judges + conflicts) log judges) per abstract.
 
-                # check the following conditions are met:
-                # 	- judge has not been fully assigned
-                # 	- judge is not an author on the abstract
-                # 	- judge has not already been assigned the abstract
+    With a preference (e.g. the affinity of each judge with the abstract, in [0, 1]), the judges
+    are picked by the lowest
 
-                if search_judge_conflicts(name, authors):
-                    judge_conflict_identified.append((name, abs_id))
-                    shuffled_names.remove(name)
-                    log.warning('judge conflict: %s %s %s' %
-                                (abs_id, name, authors))
+        cost = load - preference_weight * preference
 
-                if (len(cur_abs) < JUDGE_LIM) and (name not in authors) and (abs_id not in cur_abs):
-                    judge_dict[name].append(abs_id)
-                    status[iteration] = True
-                    break
+    instead, with ties broken by the highest preference and then at random. With a weight of 0
+    this only breaks ties between equally loaded judges. Judges more than preference_weight
+    above the num_judges-th least loaded judge cannot be picked, so only the judges up to that
+    load are popped, and the ones that are not picked are pushed back.
 
-        if not all(status):
-            log.warning('oh no! only able to assign abstract id %d to %d / %d judges' %
-                        (abs_id, sum(status), JUDGES_PER_ABSTRACT))
+    Args:
+        judge_heap (list): heap of (load, tie break, judge name)
+        num_judges (int): number of judges to select
+        is_conflicted (callable): returns True if the judge name cannot judge the abstract
+        preference (callable): optional, returns how well suited the judge name is to the abstract
+        preference_weight (float): how many abstracts of load a preference of 1 is worth
 
-    log.info('opted out: %s ' % opted_out)
-    log.info('judge conflicts: %s' % judge_conflict_identified)
-    log.info('final judging assignments:')
-    for k, v in judge_dict.items():
-        log.info('%s ; \t\t %s' % (k, v))
+    Returns:
+        List[str]: names of the selected judges, least loaded first. May be shorter than
+                   num_judges if there are not enough judges available.
+    """
+    selected = []
+    skipped = []
+    conflicted = 0
+    while judge_heap and len(selected) < num_judges:
+        entry = heapq.heappop(judge_heap)
+        if is_conflicted(entry[2]):
+            skipped.append(entry)
+            conflicted += 1
+        else:
+            selected.append(entry)
+
+    if preference is not None and len(selected) == num_judges:
+        # every judge within preference_weight of the last selected load is a candidate
+        max_load = selected[-1][0] + preference_weight
+        while judge_heap and judge_heap[0][0] <= max_load:
+            entry = heapq.heappop(judge_heap)
+            if is_conflicted(entry[2]):
+                skipped.append(entry)
+                conflicted += 1
+            else:
+                selected.append(entry)
+        scored = sorted(selected, key=lambda entry: (
+            entry[0] - preference_weight * preference(entry[2]), -preference(entry[2]), entry[1]))
+        selected = sorted(scored[:num_judges])
+        skipped += scored[num_judges:]
+
+    for entry in skipped:
+        heapq.heappush(judge_heap, entry)
+
+    # every candidate popped off the heap is checked for a conflict exactly once
+    COUNTERS['candidates_scanned'] += len(selected) + len(skipped)
+    COUNTERS['candidates_conflicted'] += conflicted
+
+    return [entry[2] for entry in selected]
+
+
+def category_judge_names(category_judges: pd.DataFrame) -> List[str]:
+    """category_judge_names
 
-    return judge_dict
+    Returns:
+        List[str]: names of the judges in "first last" format, as used in the assignments
+    """
+    return ["%s %s" % (first.strip(), last.strip()) for first, last in zip(
+        category_judges['First Name'], category_judges['Last Name'])]
+
+
+def build_conflict_index(id_df: pd.DataFrame, judge_names: List[str]) -> dict:
+    """build_conflict_index
+
+    Precompute every judge / author conflict for a category, so that the assignment loop and
+    the quality check can look conflicts up instead of re-parsing the authors list for every
+    judge, abstract and slot.
+
+    Names are matched with name_matching: author and judge names are normalized (accents,
+    degrees, nicknames, hyphenated surnames), authors are blocked by surname, and each judge is
+    only compared with the authors in their blocks. Every match at or above CONFLICT_THRESHOLD
+    is a conflict, and its confidence is kept for the conflict report.
+
+    The returned dictionary has the following keys:
+        - matrix: boolean array of shape (num judges, num abstracts), True where there is a conflict
+        - judges: list of judge names, in row order
+        - abstract_ids: list of abstract ids, in column order
+        - judge_pos: mapping of [judge name] -> [row]
+        - abstract_pos: mapping of [abstract id] -> [column]
+        - conflicts: list of (judge name, abstract id, authors, matched author, confidence) for
+                     each detected conflict
+
+    Args:
+        id_df (pd.DataFrame): abstract submissions, with the columns 'ids' and 'Authors'
+        judge_names (List[str]): judge names in "first last" format
+
+    Returns:
+        dict: the conflict index
+    """
+    abstract_ids = list(id_df['ids'])
+    authors_lists = [authors if isinstance(authors, str) else '' for authors in id_df['Authors']]
+
+    # parse each of the authors lists once, and file the authors under their surname blocks
+    author_index = build_author_index(authors_lists)
+
+    matrix = np.zeros((len(judge_names), len(abstract_ids)), dtype=bool)
+    conflicts = []
+    for judge_idx, name in enumerate(judge_names):
+        matches, compared = match_name(author_index, name)
+        COUNTERS['conflict_index_candidates'] += compared
+        for pos, author, confidence in matches:
+            matrix[judge_idx, pos] = True
+            conflicts.append((name, abstract_ids[pos], authors_lists[pos], author, confidence))
+            log.debug('judge conflict: %s %s %s (%s, %.2f)', abstract_ids[pos], name, authors_lists[pos], author, confidence)
+
+    COUNTERS['judge_conflicts'] += len(conflicts)
+
+    return {
+        'matrix': matrix,
+        'judges': list(judge_names),
+        'abstract_ids': abstract_ids,
+        'judge_pos': {name: idx for idx, name in enumerate(judge_names)},
+        'abstract_pos': {abs_id: idx for idx, abs_id in enumerate(abstract_ids)},
+        'conflicts': conflicts,
+    }
+
+
+def write_conflict_report(conflict_indexes: Dict[str, dict], outdir: str) -> None:
+    """write_conflict_report
+
+    Write out all of the judge / author conflicts that were detected, one row per conflict,
+    so that they can be double checked by hand.
+
+    Args:
+        conflict_indexes (dict): mapping of [category] -> conflict index from build_conflict_index
+        outdir (str): directory where the report should be written
+    """
+    rows = [(cat, name, abs_id, authors, author, confidence)
+            for cat, conflict_index in conflict_indexes.items()
+            for name, abs_id, authors, author, confidence in conflict_index['conflicts']]
 
+    report = pd.DataFrame(rows, columns=['category', 'judge', 'abstract id', 'authors', 'matched author', 'confidence'])
+    report.to_csv(os.path.join(outdir, 'judge_conflicts.csv'), index=False)
+    log.info('wrote %d judge conflicts to %s' % (len(report), os.path.join(outdir, 'judge_conflicts.csv')))
 
-def preprocess_abstract_submissions(students_file: str, students_tab: str) -> Union[pd.DataFrame, pd.DataFrame]:
+    return
+
+
+def preprocess_abstract_submissions(students_file: str, students_tab: str, use_cache: bool = True,
+                                    id_registry: str = None, id_space: tuple = None) -> Union[pd.DataFrame, pd.DataFrame]:
     """preprocess_abstract_submissions
 
     This preprocessing step is used to do the following: 
-        1) introduce random abstract ID for each student so that we can refer to 
-            abstracts by the ID number, and not by the student name
+        1) introduce an anonymous abstract ID for each student so that we can refer to 
+            abstracts by the ID number, and not by the student name. the IDs are kept in a
+            registry (see abstract_ids.py), so a submission keeps its ID across reruns
         2) replace the column name "Humanism, Ethics, Education, and the Art of Medicine" 
             with the column name:  "Humanism, Ethics, Education, and the Art of Medicine (HEART)"
 
@@ -276,6 +577,11 @@ def preprocess_abstract_submissions(students_file: str, students_tab: str) -> Un
     Args:
         students_file (str): student abstract submission file
         students_tab (str): student abstract submission file, which tab 
+        use_cache (bool): whether the parsed excel sheet may be loaded from / saved to the cache
+        id_registry (str): path of the abstract id registry, abstract_id_registry.json next to
+                           students_file by default
+        id_space (tuple): (lowest id, highest id + 1) to draw new ids from. by default the space of
+                          the registry, which grows when it runs out
 
     Returns:
         Union[pd.DataFrame, pd.DataFrame]: the preprocessed dataframe containing only a specific
@@ -284,21 +590,31 @@ def preprocess_abstract_submissions(students_file: str, students_tab: str) -> Un
     log.info('processing abstract submissions')
     log.info('='*30)
 
-    students = pd.read_excel(students_file, sheet_name=students_tab)
-    rng = np.random.default_rng(seed=2022)
-    ids = rng.choice(np.arange(100, 300), size=len(students), replace=False)
-    students['ids'] = ids
+    with stage('read'):
+        students = read_excel_cached(students_file, sheet_name=students_tab, use_cache=use_cache)
 
-    students['Scholarly Concentration'] = students['Scholarly Concentration'].apply(lambda x: x.replace(
-        "Humanism, Ethics, Education, and the Art of Medicine", "Humanism, Ethics, Education, and the Art of Medicine (HEART)"))
+    with stage('preprocess'):
+        # ids come from the registry, so every submission keeps its id across reruns. ids that the
+        # sheet already has (e.g. assigned_ids_students.csv) are kept, and recorded in the registry
+        if id_registry is None:
+            id_registry = os.path.join(os.path.dirname(students_file), 'abstract_id_registry.json')
+        ids = allocate_ids(submission_fingerprints(students), id_registry,
+                           existing_ids=students['ids'] if 'ids' in students.columns else None, id_space=id_space)
+        students['ids'] = ids
+
+        # the lookahead leaves sheets that have already been through this step alone
+        students['Scholarly Concentration'] = students['Scholarly Concentration'].str.replace(
+            r"Humanism, Ethics, Education, and the Art of Medicine(?! \(HEART\))",
+            "Humanism, Ethics, Education, and the Art of Medicine (HEART)", regex=True)
 
     log.debug('the following IDs were generated for student abstracts: ')
-    log.debug(ids)
+    log.debug('%s', ids)
 
     return students[['ids', 'Scholarly Concentration', 'Authors', 'Are you interested in being considered for an oral or podium presentation?']], students
 
 
-def quality_check(id_df: pd.DataFrame, abstract_assignments: dict) -> bool:
+def quality_check(id_df: pd.DataFrame, abstract_assignments: dict, conflict_indexes: Dict[str, dict] = None,
+                  judges_per_abstract: Dict[str, int] = None, JUDGE_LIM: int = 15) -> dict:
     """quality_check
 
     This is a function used as a quality check to see whether the abstract assignment process
@@ -307,9 +623,23 @@ def quality_check(id_df: pd.DataFrame, abstract_assignments: dict) -> bool:
     In the current version of the code, no output will be written from this script if 
     the sanity check is not passed. 
 
+    All of the assignments are put into one sparse judge x abstract incidence matrix, so that
+    each of the checks below is a handful of vectorized operations instead of a scan over lists:
+
+        - every abstract sent out for judging has exactly judges_per_abstract[category] judges
+          (or at least one judge, if judges_per_abstract is not given)
+        - no judge has more than JUDGE_LIM abstracts
+        - no abstract is assigned to a judge that is conflicted with it
+        - no abstract is assigned to the same judge twice
+        - no opted out abstract is assigned, and every abstract is assigned within its own category
+
     Args:
         id_df (pd.DataFrame): dataframe which contains the student abstract submissions, along with their random IDs
         abstract_assignments (dict): dictionary representing which abstracts have been assigned to which judges. 
+        conflict_indexes (dict): optional mapping of [category] -> conflict index. If provided, 
+                                 assignments of an abstract to a conflicted judge also fail the check. 
+        judges_per_abstract (dict): optional mapping of [category] -> number of judges per abstract
+        JUDGE_LIM (int): maximum number of abstracts per judge
 
     id_df is a dataframe which should have the columns: 
         - abstract id 
@@ -317,69 +647,221 @@ def quality_check(id_df: pd.DataFrame, abstract_assignments: dict) -> bool:
         - authors list 
         - whether the abstract should be sent out for judging 
     Returns:
-        bool: False if there are any abstracts not assigned to judges. 
+        dict: report with 'passed', which is False if any of the checks failed, the number of
+              abstracts and assignments checked, and for each check the list of offending entries:
+                - under_assigned, over_assigned: (abstract id, category, judges, expected judges)
+                - overloaded_judges: (category, judge, number of abstracts)
+                - conflicted, duplicates: (category, judge, abstract id)
+                - opted_out_assigned, wrong_category: (category, judge, abstract id)
     """
-    assigned_ids = []
-
-    for cat, judge_dict in abstract_assignments.items():
-        for name_key, judge_abstract_id_list in judge_dict.items():
-            assigned_ids += judge_abstract_id_list
-
-    assigned_ids = list(set(assigned_ids))
-
-    any = 0
-    for idx, (abstract, cat, authors, to_judge) in id_df.iterrows():
-        if (to_judge == 'Yes') and (abstract not in assigned_ids):
-            log.warning('abstract %d in category %s was not assigned for judging. authors: %s' % (
-                abstract, cat, authors))
-            any += 1
-
-    return (any == 0)
-
+    abstract_ids = id_df.iloc[:, 0].to_numpy()
+    abstract_cats = id_df.iloc[:, 1].to_numpy()
+    to_judge = (id_df.iloc[:, 3] == 'Yes').to_numpy()
+
+    # one row per (category, judge), one column per abstract in id_df
+    judge_keys = [(cat, name) for cat, judge_dict in abstract_assignments.items() for name in judge_dict]
+    judge_lists = [abstract_assignments[cat][name] for cat, name in judge_keys]
+    loads = np.array([len(abs_list) for abs_list in judge_lists], dtype=np.int64)
+    rows = np.repeat(np.arange(len(judge_keys)), loads)
+    assigned = np.fromiter((abs_id for abs_list in judge_lists for abs_id in abs_list),
+                           dtype=np.int64, count=int(loads.sum()))
+    cols = pd.Index(abstract_ids).get_indexer(assigned)
+    judge_cats = np.array([cat for cat, _ in judge_keys], dtype=object)
+
+    report = {
+        'num_abstracts': len(abstract_ids),
+        'num_assignments': len(assigned),
+    }
 
-def search_judge_conflicts(judge_name: str, authors_list: str) -> bool:
-    """search_judge_conflicts
+    # abstracts that are not in id_df, or that ended up with a judge of another category
+    misplaced = (cols < 0) | (abstract_cats[np.maximum(cols, 0)] != judge_cats[rows])
+    report['wrong_category'] = [(judge_keys[r][0], judge_keys[r][1], int(assigned[i]))
+                                for i, r in zip(np.nonzero(misplaced)[0], rows[misplaced])]
+
+    known = cols >= 0
+    incidence = csr_matrix((np.ones(known.sum(), dtype=np.int32), (rows[known], cols[known])),
+                           shape=(len(judge_keys), len(abstract_ids)))
+    # building the csr matrix sums repeated (judge, abstract) entries, so anything above 1 is a duplicate
+    incidence.sum_duplicates()
+    entries = incidence.tocoo()
+    dup_rows, dup_cols = entries.row[entries.data > 1], entries.col[entries.data > 1]
+    report['duplicates'] = [(judge_keys[r][0], judge_keys[r][1], int(abstract_ids[c]))
+                            for r, c in zip(dup_rows, dup_cols)]
+
+    num_judges = incidence.getnnz(axis=0)
+    if judges_per_abstract is not None:
+        expected = np.array([judges_per_abstract.get(cat, 0) for cat in abstract_cats], dtype=np.int64)
+        under = to_judge & (num_judges < expected)
+        over = to_judge & (num_judges > expected)
+    else:
+        expected = np.ones(len(abstract_ids), dtype=np.int64)
+        under = to_judge & (num_judges == 0)
+        over = np.zeros(len(abstract_ids), dtype=bool)
+    report['under_assigned'] = [(int(abstract_ids[c]), abstract_cats[c], int(num_judges[c]), int(expected[c]))
+                                for c in np.nonzero(under)[0]]
+    report['over_assigned'] = [(int(abstract_ids[c]), abstract_cats[c], int(num_judges[c]), int(expected[c]))
+                               for c in np.nonzero(over)[0]]
+
+    opted_out = known.copy()
+    opted_out[known] = ~to_judge[cols[known]]
+    report['opted_out_assigned'] = [(judge_keys[r][0], judge_keys[r][1], int(assigned[i]))
+                                    for i, r in zip(np.nonzero(opted_out)[0], rows[opted_out])]
+
+    report['overloaded_judges'] = [(judge_keys[r][0], judge_keys[r][1], int(loads[r]))
+                                   for r in np.nonzero(loads > JUDGE_LIM)[0]]
+
+    report['conflicted'] = []
+    if conflict_indexes is not None:
+        for cat, conflict_index in conflict_indexes.items():
+            in_cat = np.nonzero((judge_cats[rows] == cat) & ~misplaced)[0]
+            if not len(in_cat):
+                continue
+            # look each judge up once, rather than once per assignment
+            judge_pos = {r: conflict_index['judge_pos'][judge_keys[r][1]] for r in np.unique(rows[in_cat])}
+            conflict_rows = np.array([judge_pos[r] for r in rows[in_cat]], dtype=np.int64)
+            conflict_cols = pd.Index(conflict_index['abstract_ids']).get_indexer(assigned[in_cat])
+            hit = conflict_cols >= 0
+            hit[hit] = conflict_index['matrix'][conflict_rows[hit], conflict_cols[hit]]
+            COUNTERS['quality_check_conflict_lookups'] += len(in_cat)
+            report['conflicted'] += [(cat, judge_keys[r][1], int(assigned[i]))
+                                     for i, r in zip(in_cat[hit], rows[in_cat[hit]])]
+
+    messages = {
+        'under_assigned': 'abstract %d in category %s was assigned to %d / %d judges',
+        'over_assigned': 'abstract %d in category %s was assigned to %d / %d judges',
+        'overloaded_judges': 'judge in category %s, %s, was assigned %d abstracts',
+        'conflicted': 'abstract in category %s was assigned to conflicted judge %s: %d',
+        'duplicates': 'abstract in category %s was assigned to judge %s more than once: %d',
+        'opted_out_assigned': 'opted out abstract in category %s was assigned to judge %s: %d',
+        'wrong_category': 'abstract not in category %s was assigned to judge %s: %d',
+    }
+    for check, message in messages.items():
+        for entry in report[check]:
+            log.warning(message, *entry)
 
-    More advanced method of searching for judge name within the authors list. 
+    report['passed'] = not any(report[check] for check in messages)
+    if report['passed']:
+        log.info('quality check passed for %d assignments of %d abstracts',
+                 report['num_assignments'], report['num_abstracts'])
+    else:
+        log.warning('quality check failed: %s', ', '.join(
+            '%d %s' % (len(report[check]), check) for check in messages if report[check]))
 
-    Separates the judge name by white space. We know that judge_name is going to be 
-    just first name and last name. 
+    return report
 
-    Separates the authors list by commas, then each chunk is separated by spaces. 
 
-    This means if we have judge name as [Billy Osler] and author list as 
-    [William Halsted, Billy H Osler], this will return True. 
+def derive_seed(seed: int, category_idx: int) -> int:
+    """derive_seed
 
-    A simple string matching alone would not have returned True. 
+    Derive an independent, reproducible seed for each category from the global seed.
 
-    i.e. this matches first name + last name while ignoring optional middle initial.
+    Args:
+        seed (int): global seed
+        category_idx (int): position of the category in the list of categories
 
-    TODO: I forget if this picks up the case in which people optionally include their
-          degree in the name field smh. 
+    Returns:
+        int: seed for the category
+    """
+    return int(np.random.SeedSequence([seed, category_idx]).generate_state(1)[0])
+
+
+def assign_category(task: dict) -> dict:
+    """assign_category
+
+    Run the abstract assignment for a single category. This is a top level function so that
+    it can be run in a process pool, so everything it needs is passed in through task and
+    everything it produces is returned.
+
+    task is a dictionary with the keys:
+        - category: name of the category
+        - id_df: abstract submissions in the category
+        - category_judges: judges in the category
+        - judges_per_abstract: number of judges that should see each abstract
+        - solver: 'greedy' or 'flow'
+        - seed: seed for the category, see derive_seed
+        - conflict_index: optional conflict index of the category from build_conflict_index, so
+                          that it is not built again for every seed of --search_seeds
+        - affinity: optional judge / abstract affinities of the category from
+                    affinity.category_affinity, used by the greedy solver
+        - affinity_weight: see select_least_loaded_judges
+        - previous: previous assignments of the category to repair, or None to assign from scratch
 
     Args:
-        judge_name (str): name of judge
-        authors_list (str): str of all authors
+        task (dict): description of the category to assign
 
     Returns:
-        bool: [description]
+        dict: with the keys category, judge_dict, conflict_index, opted_out and counters, the
+              counts added to COUNTERS while assigning the category
     """
-    judge_name_chunks = judge_name.lower().split(' ')
-    parsed_chunks = [author.strip().lower().split(' ')
-                     for author in authors_list.split(',')]
-    for author_chunks in parsed_chunks:
-        if all([chunk in author_chunks for chunk in judge_name_chunks]):
-            log.debug('judge name found in authors list: %s %s' %
-                      (judge_name, authors_list))
-            return True
+    counters_before = counter_snapshot()
+    cat = task['category']
+    category_df = task['id_df']
+    category_judges = task['category_judges']
+
+    log.info('category: %s' % cat)
+    np.random.seed(task['seed'])
+    random.seed(task['seed'])
+
+    conflict_index = task.get('conflict_index') or build_conflict_index(
+        category_df,
+        ["%s %s" % (first.strip(), last.strip())
+         for first, last in zip(category_judges['First Name'], category_judges['Last Name'])]
+    )
 
-    return False
+    if task['previous'] is not None:
+        from assignment_repair import repair_assignments
+        judge_dict = repair_assignments(
+            category_df,
+            category_judges,
+            task['previous'],
+            conflict_index,
+            JUDGES_PER_ABSTRACT=task['judges_per_abstract']
+        )
+    elif task['solver'] == 'flow':
+        from assignment_flow import assign_abstracts_with_flow
+        judge_dict = assign_abstracts_with_flow(
+            category_df,
+            category_judges,
+            conflict_index,
+            JUDGES_PER_ABSTRACT=task['judges_per_abstract']
+        )
+    else:
+        judge_dict = assign_abstracts_to_judges(
+            category_df,
+            category_judges,
+            JUDGES_PER_ABSTRACT=task['judges_per_abstract'],
+            conflict_index=conflict_index,
+            affinity=task.get('affinity'),
+            affinity_weight=task.get('affinity_weight', 0.0)
+        )
 
+    return {
+        'category': cat,
+        'judge_dict': judge_dict,
+        'conflict_index': conflict_index,
+        'opted_out': list(category_df.loc[category_df.iloc[:, 3] != 'Yes', 'ids']),
+        'counters': counter_delta(counters_before),
+    }
 
-def main():
 
-    args = parse_command_line()
+def run_assignment(args: dict) -> dict:
+    """run_assignment
+
+    Run the whole assignment from parsed command line options: read and preprocess the
+    abstracts and judges, assign each category, check the assignments and write them out.
+
+    Args:
+        args (dict): options from add_arguments
 
+    Returns:
+        dict: the in memory results, so that later steps do not have to read them back from
+              disk, with the keys
+            - id_df, student_df: from preprocess_abstract_submissions
+            - judges_per_cat: mapping of [category] -> dataframe of judges
+            - abstract_assignments: mapping of [category] -> [judge name] -> [list of abstract ids]
+            - quality_check: the report from quality_check
+              (abstract_assignments and quality_check are None if --repair gave up)
+    """
     categories = [
         "Basic Science",
         "Clinical Science",
@@ -398,32 +880,150 @@ def main():
 
     # NOTE: these seeds allow for the abstract assignment process to be random, yet REPRODUCIBLE. 
     #       if you want a different realization of the randomness, change the seed. 
-    np.random.seed(2022)
-    random.seed(2022)
+    #       each category gets its own seed derived from this one, so that the assignments do
+    #       not depend on the order in which the categories are run. with --search_seeds, the
+    #       best of several seeds derived from this one is used instead.
+    seed = args['seed']
+    np.random.seed(seed)
+    random.seed(seed)
+
+    if args['clear_cache']:
+        clear_excel_cache(args['students'])
+        clear_excel_cache(args['judges'])
 
     log.info('preprocessing abstract submissions')
     id_df, student_df = preprocess_abstract_submissions(
-        args['students'], args['students_tab'])
+        args['students'], args['students_tab'], use_cache=not args['no_cache'],
+        id_registry=args['id_registry'], id_space=id_space_from_args(args))
     log.info('processing %d abstract submissions' % (len(id_df)))
 
-    judges_per_cat = read_judge_cat_assign(
-        args['judges'], args['judges_tab'], args['judges_header'], categories)
-
-    abstract_assignments = {}
-    for cat in categories:
-        log.info('category: %s' % cat)
-        abstract_assignments[cat] = assign_abstracts_to_judges(
-            id_df.loc[id_df['Scholarly Concentration'] == cat],
-            judges_per_cat[cat],
-            JUDGES_PER_ABSTRACT=category_hyperparam[cat]
-        )
+    os.makedirs(args['outdir'], exist_ok=True)
+
+    if args['pool_judges']:
+        from judge_pool import allocate_judges, write_pool_report
+        judges = read_judges(args['judges'], args['judges_tab'], args['judges_header'], use_cache=not args['no_cache'])
+        to_judge = id_df.loc[id_df.iloc[:, 3] == 'Yes', 'Scholarly Concentration']
+        judges_per_cat, pool_report = allocate_judges(
+            judges, categories, {cat: int((to_judge == cat).sum()) for cat in categories}, category_hyperparam)
+        write_pool_report(pool_report, args['outdir'])
+    else:
+        judges_per_cat = read_judge_cat_assign(
+            args['judges'], args['judges_tab'], args['judges_header'], categories, use_cache=not args['no_cache'])
+
+    previous = None
+    if args['repair']:
+        from assignment_repair import read_previous_assignments
+        previous = read_previous_assignments(args['repair'])
+        previous_ids = {abs_id for judge_dict in previous.values() for abs_lists in judge_dict.values() for abs_id in abs_lists}
+        missing = previous_ids - set(id_df['ids'])
+        if len(missing) > len(previous_ids) / 2:
+            log.error('%d / %d of the previously assigned abstracts are not in %s. --repair needs the '
+                      'students sheet with the ids column of the previous run (assigned_ids_students.csv)',
+                      len(missing), len(previous_ids), args['students'])
+            return {'id_df': id_df, 'student_df': student_df, 'judges_per_cat': judges_per_cat,
+                    'abstract_assignments': None, 'quality_check': None}
+
+    affinity = None
+    if args['expertise']:
+        if args['solver'] != 'greedy' or previous is not None:
+            log.warning('--expertise only applies to the greedy solver without --repair, ignoring it')
+        else:
+            from affinity import category_affinity, compute_affinity
+            with stage('affinity'):
+                affinity = compute_affinity(
+                    student_df, [name for cat in categories for name in category_judge_names(judges_per_cat[cat])],
+                    args['expertise'], use_cache=not args['no_cache'])
+
+    tasks = [{
+        'category': cat,
+        'id_df': id_df.loc[id_df['Scholarly Concentration'] == cat],
+        'category_judges': judges_per_cat[cat],
+        'judges_per_abstract': category_hyperparam[cat],
+        'solver': args['solver'],
+        'seed': derive_seed(seed, cat_idx),
+        'previous': previous.get(cat, {}) if previous is not None else None,
+    } for cat_idx, cat in enumerate(categories)]
+
+    if affinity is not None:
+        for task in tasks:
+            task['affinity'] = category_affinity(affinity, category_judge_names(task['category_judges']), list(task['id_df']['ids']))
+            task['affinity_weight'] = args['affinity_weight']
+
+    search = None
+    searching = args['search_seeds'] > 1
+    if searching and (args['solver'] != 'greedy' or previous is not None):
+        log.warning('--search_seeds only applies to the greedy solver without --repair, ignoring it')
+        searching = False
+    if searching:
+        # the conflicts do not depend on the seed, so each category's index is built once for all seeds
+        for task in tasks:
+            task['conflict_index'] = build_conflict_index(task['id_df'], category_judge_names(task['category_judges']))
+
+    with stage('assign'):
+        if searching:
+            from seed_search import search_seeds, write_seed_report
+            workers = args['workers'] or os.cpu_count() or 1
+            search = search_seeds(tasks, seed, args['search_seeds'], workers, log_level=args['log_level'])
+            results = search['results']
+            # only the counts of the seed that was kept, as if it had been the only one tried
+            for result in results:
+                merge_counters(result['counters'])
+            write_seed_report(search, args['outdir'])
+        elif (args['workers'] or 1) > 1:
+            # the categories share no judges and no abstracts, so they can be solved independently.
+            # submit the largest categories first so that they do not end up waiting on the small ones
+            tasks.sort(key=lambda task: len(task['id_df']), reverse=True)
+            with ProcessPoolExecutor(max_workers=args['workers'], initializer=setup_logging,
+                                     initargs=(args['log_level'],)) as executor:
+                results = list(executor.map(assign_category, tasks))
+
+            # counters from the worker processes are not shared with this one
+            for result in results:
+                merge_counters(result['counters'])
+        else:
+            results = [assign_category(task) for task in tasks]
+
+    # merge the per-category results back together, in the usual category order
+    results = {result['category']: result for result in results}
+    abstract_assignments = {cat: results[cat]['judge_dict'] for cat in categories}
+    conflict_indexes = {cat: results[cat]['conflict_index'] for cat in categories}
+    log.info('opted out: %s ', [abs_id for cat in categories for abs_id in results[cat]['opted_out']])
+
+    write_conflict_report(conflict_indexes, args['outdir'])
+
+    with stage('quality_check'):
+        report = quality_check(id_df, abstract_assignments, conflict_indexes,
+                               judges_per_abstract=category_hyperparam)
+
+    if report['passed']:
+
+        with stage('write'):
+            write_abstract_assignments(
+                abstract_assignments, judges_per_cat, args['outdir'], parquet=args['parquet'])
+
+            student_df.to_csv("assigned_ids_students.csv")
+
+        if previous is not None:
+            from assignment_repair import find_changed_judges, write_changed_judges
+            changes = find_changed_judges(previous, abstract_assignments)
+            write_changed_judges(changes, args['outdir'])
+            log.info('bundles changed for %d judges, see changed_judges.csv: %s',
+                     len(changes), ', '.join(name for _, name, _, _, _ in changes))
+
+    if args['metrics']:
+        write_metrics(args['metrics'], args=args, quality_check=report,
+                      seed_search=None if search is None else {'seed': search['seed'], 'score': search['score'],
+                                                               'candidates_tried': len(search['tried'])})
+        log.info('wrote run metrics to %s', args['metrics'])
+
+    return {'id_df': id_df, 'student_df': student_df, 'judges_per_cat': judges_per_cat,
+            'abstract_assignments': abstract_assignments, 'quality_check': report}
 
-    if quality_check(id_df, abstract_assignments):
 
-        write_abstract_assignments(
-            abstract_assignments, judges_per_cat, args['outdir'])
+def main():
 
-        student_df.to_csv("assigned_ids_students.csv")
+    args = parse_command_line()
+    run_assignment(args)
 
     return
 
@@ -0,0 +1,186 @@
+"""assignment_flow.py
+
+Max-flow based engine for assigning abstracts to judges, as an alternative to the greedy
+loop in assign_abstracts.py.
+
+Each category is modelled as a flow network:
+
+    source -> abstract    capacity JUDGES_PER_ABSTRACT
+    abstract -> judge     capacity 1, only if the judge has no conflict with the abstract
+    judge -> sink         capacity L <= JUDGE_LIM
+
+A flow that saturates every source edge is a full assignment. The per-judge cap L is binary
+searched for the smallest value that still gives a full assignment, which limits the most loaded
+judges. A cap alone leaves the flow free to give some judges nothing at all, so a lower bound F
+on the judge -> sink edges is then binary searched as well, for the largest F (at most
+total / judges) that still gives a full assignment under L. Every judge ends up with between F
+and L abstracts, except the judges that have fewer than F abstracts without a conflict, who get
+all of those. Lower bounds are handled with the standard reduction to a max-flow between an added
+source and sink. If no full assignment exists even at JUDGE_LIM, the maximum flow is used, which
+assigns as many (abstract, judge) pairs as is possible, without the lower bounds.
+
+Requires scipy in addition to the dependencies listed in the README.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_flow
+
+from instrumentation import COUNTERS
+
+log = logging.getLogger(__name__)
+
+
+def assign_abstracts_with_flow(id_df: pd.DataFrame, category_judges: pd.DataFrame, conflict_index: dict,
+                               JUDGES_PER_ABSTRACT: int = 4, JUDGE_LIM: int = 15) -> dict:
+    """assign_abstracts_with_flow
+
+    Assign the abstracts of a single category to judges by solving a max-flow problem.
+    Returns the same structure as assign_abstracts_to_judges, i.e. a mapping of
+    [judge name] -> [list of abstract ids], so write_abstract_assignments keeps working.
+
+    Args:
+        id_df (pd.DataFrame): abstract submissions for the category, with the columns
+                              'ids', 'Scholarly Concentration', 'Authors' and the opt in column
+        category_judges (pd.DataFrame): judges for the category
+        conflict_index (dict): conflict index for the category, from build_conflict_index
+        JUDGES_PER_ABSTRACT (int): number of judges that should see each abstract
+        JUDGE_LIM (int): maximum number of abstracts per judge
+
+    Returns:
+        dict: mapping of [judge name] -> [list of abstract ids]
+    """
+    log.info('sorting abstracts to judges with max-flow solver')
+    log.info('-- judges per abstract: %d, max abstracts per judge: %d' %
+             (JUDGES_PER_ABSTRACT, JUDGE_LIM))
+    log.info('='*30)
+
+    judge_names = ["%s %s" % (first.strip(), last.strip()) for first, last in zip(
+        category_judges['First Name'], category_judges['Last Name'])]
+    judge_dict = {name: [] for name in judge_names}
+
+    # shuffle so that which of the optimal assignments gets picked is random, but reproducible
+    id_df = id_df.sample(frac=1).reset_index(drop=True)
+    judge_order = np.random.permutation(len(judge_names))
+
+    to_judge = id_df.iloc[:, 3] == 'Yes'
+    log.info('opted out: %s ', list(id_df.loc[~to_judge, 'ids']))
+    abstract_ids = list(id_df.loc[to_judge, 'ids'])
+
+    if not abstract_ids or not judge_names:
+        if abstract_ids:
+            log.warning('oh no! no judges available for %d abstracts' % len(abstract_ids))
+        return judge_dict
+
+    num_abstracts = len(abstract_ids)
+    num_judges = len(judge_names)
+
+    # allowed (abstract, judge) edges are the ones without a conflict
+    abstract_cols = [conflict_index['abstract_pos'][abs_id] for abs_id in abstract_ids]
+    judge_rows = [conflict_index['judge_pos'][judge_names[j]] for j in judge_order]
+    allowed = ~conflict_index['matrix'][np.ix_(judge_rows, abstract_cols)].T
+    edge_abstract, edge_judge = np.nonzero(allowed)
+
+    # node layout: [source] [abstracts] [judges] [sink]
+    source = 0
+    abstract_nodes = 1 + np.arange(num_abstracts)
+    judge_nodes = 1 + num_abstracts + np.arange(num_judges)
+    sink = 1 + num_abstracts + num_judges
+    num_nodes = sink + 1
+
+    demand = num_abstracts * JUDGES_PER_ABSTRACT
+
+    # abstracts that each judge could take, which caps how many a judge can be made to take
+    judge_degree = np.bincount(edge_judge, minlength=num_judges)
+
+    # maximum flow with every judge taking at most judge_cap abstracts. with judge_floor, a full
+    # assignment where every judge also takes at least min(judge_floor, degree), or None
+    def solve(judge_cap: int, judge_floor: int = 0):
+        COUNTERS['flow_solves'] += 1
+        if not judge_floor:
+            rows = np.concatenate([
+                np.full(num_abstracts, source), abstract_nodes[edge_abstract], judge_nodes])
+            cols = np.concatenate([
+                abstract_nodes, judge_nodes[edge_judge], np.full(num_judges, sink)])
+            caps = np.concatenate([
+                np.full(num_abstracts, JUDGES_PER_ABSTRACT), np.ones(len(edge_abstract)),
+                np.full(num_judges, judge_cap)]).astype(np.int32)
+            graph = csr_matrix((caps, (rows, cols)), shape=(num_nodes, num_nodes))
+            return maximum_flow(graph, source, sink, method='dinic')
+
+        # lower bounds, by the usual reduction to a max-flow between a new source and sink: the
+        # source -> abstract edges are fixed at JUDGES_PER_ABSTRACT and the judge -> sink edges
+        # carry at least the floor, so those amounts are sent straight from the new source to
+        # the heads of the edges and from their tails to the new sink, and the old sink drains
+        # back into the old source. the bounds can be met if and only if the new edges are
+        # saturated
+        floor = np.minimum(judge_floor, judge_degree)
+        new_source, new_sink = num_nodes, num_nodes + 1
+        rows = np.concatenate([
+            np.full(num_abstracts, new_source), [source], abstract_nodes[edge_abstract],
+            judge_nodes, judge_nodes, [new_source], [sink]])
+        cols = np.concatenate([
+            abstract_nodes, [new_sink], judge_nodes[edge_judge],
+            np.full(num_judges, sink), np.full(num_judges, new_sink), [sink], [source]])
+        caps = np.concatenate([
+            np.full(num_abstracts, JUDGES_PER_ABSTRACT), [demand], np.ones(len(edge_abstract)),
+            judge_cap - floor, floor, [floor.sum()], [demand]]).astype(np.int32)
+        graph = csr_matrix((caps, (rows, cols)), shape=(num_nodes + 2, num_nodes + 2))
+        result = maximum_flow(graph, new_source, new_sink, method='dinic')
+        return result if result.flow_value == demand + floor.sum() else None
+
+    # binary search for the smallest per-judge cap that still gives a full assignment
+    low = max(1, min(JUDGE_LIM, -(-demand // num_judges)))
+    high = JUDGE_LIM
+    best = solve(high)
+    if best.flow_value < demand:
+        log.warning('oh no! no full assignment exists, assigning %d / %d abstract slots' %
+                    (best.flow_value, demand))
+    else:
+        while low < high:
+            mid = (low + high) // 2
+            result = solve(mid)
+            if result.flow_value == demand:
+                best, high = result, mid
+            else:
+                low = mid + 1
+        log.info('full assignment found with at most %d abstracts per judge' % high)
+
+        # the cap only limits the most loaded judges, so binary search as well for the largest
+        # number of abstracts that every judge can be given at that cap (fewer for the judges
+        # that do not have that many abstracts without a conflict)
+        judge_cap = high
+        low, high = 0, min(judge_cap, demand // num_judges)
+        while low < high:
+            mid = (low + high + 1) // 2
+            result = solve(judge_cap, judge_floor=mid)
+            if result is not None:
+                best, low = result, mid
+            else:
+                high = mid - 1
+        log.info('every judge gets at least %d abstracts, where their conflicts allow it' % low)
+
+    # read the assignment back off of the abstract -> judge edges that carry flow
+    flow = best.flow.tocoo()
+    is_assignment = (flow.data > 0) & (flow.row >= 1) & (flow.row <= num_abstracts) & (flow.col > num_abstracts) & (flow.col < sink)
+    assigned_abstract = flow.row[is_assignment] - 1
+    assigned_judge = judge_order[flow.col[is_assignment] - 1 - num_abstracts]
+
+    order = np.argsort(assigned_abstract, kind='stable')
+    for a, j in zip(assigned_abstract[order], assigned_judge[order]):
+        judge_dict[judge_names[j]].append(abstract_ids[a])
+
+    counts = np.bincount(assigned_abstract, minlength=num_abstracts)
+    COUNTERS['abstracts_under_assigned'] += int((counts < JUDGES_PER_ABSTRACT).sum())
+    for a in np.nonzero(counts < JUDGES_PER_ABSTRACT)[0]:
+        log.warning('oh no! only able to assign abstract id %d to %d / %d judges' %
+                    (abstract_ids[a], counts[a], JUDGES_PER_ABSTRACT))
+
+    log.debug('final judging assignments:')
+    if log.isEnabledFor(logging.DEBUG):
+        for k, v in judge_dict.items():
+            log.debug('%s ; \t\t %s', k, v)
+
+    return judge_dict
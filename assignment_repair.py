@@ -0,0 +1,198 @@
+"""assignment_repair.py
+
+Incremental repair of an existing set of judging assignments, for when judges drop out or
+abstracts are withdrawn or arrive late after the assignments have already been sent out.
+
+Running assign_abstracts.py again from scratch reshuffles every judge's abstracts, so every
+bundle would have to be resent. Instead, the previous assignments (unified.csv) are kept as
+they are, and only the slots that were affected by the change are filled:
+
+    - abstracts assigned to a judge that is no longer in the judges file lose that judge
+    - abstracts that were withdrawn, opted out or moved category are removed from their judges
+    - assignments that have become conflicted (e.g. the authors list was corrected) are removed
+    - abstracts that now have fewer judges than requested, including new abstracts, are given
+      new judges with the same least loaded first heap as the greedy solver
+
+Every other assignment is left untouched and in the same order, so the judges whose bundles
+actually changed can be listed, and only those need to be sent again. Apart from reading the
+inputs, the work done is proportional to the number of open slots, not to the whole event.
+"""
+import csv
+import heapq
+import logging
+import os
+from collections import defaultdict
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from assign_abstracts import select_least_loaded_judges
+from assignment_store import STORE_NAME, read_assignments, to_assignments
+from instrumentation import COUNTERS
+
+log = logging.getLogger(__name__)
+
+
+def read_previous_assignments(previous_dir: str) -> Dict[str, Dict[str, List[int]]]:
+    """read_previous_assignments
+
+    Read the assignments written by a previous run of assign_abstracts.py, from its
+    assignments.npz, or its unified.csv if it was written before the assignment store.
+
+    Args:
+        previous_dir (str): output directory of the previous run
+
+    Returns:
+        dict: mapping of [category] -> [judge name] -> [list of abstract ids], in the order
+              that they were assigned
+    """
+    path = os.path.join(previous_dir, STORE_NAME)
+    if not os.path.exists(path):
+        path = os.path.join(previous_dir, 'unified.csv')
+
+    return to_assignments(read_assignments(path))
+
+
+def repair_assignments(id_df: pd.DataFrame, category_judges: pd.DataFrame, previous_judge_dict: Dict[str, List[int]],
+                       conflict_index: dict, JUDGES_PER_ABSTRACT: int = 4, JUDGE_LIM: int = 15) -> dict:
+    """repair_assignments
+
+    Repair the previous assignments of a single category, see the module docstring.
+    Returns the same structure as assign_abstracts_to_judges.
+
+    Args:
+        id_df (pd.DataFrame): abstract submissions for the category, with the columns
+                              'ids', 'Scholarly Concentration', 'Authors' and the opt in column
+        category_judges (pd.DataFrame): current judges for the category
+        previous_judge_dict (dict): previous mapping of [judge name] -> [list of abstract ids]
+                                    for the category, from read_previous_assignments
+        conflict_index (dict): conflict index for the category, from build_conflict_index
+        JUDGES_PER_ABSTRACT (int): number of judges that should see each abstract
+        JUDGE_LIM (int): maximum number of abstracts per judge
+
+    Returns:
+        dict: mapping of [judge name] -> [list of abstract ids]
+    """
+    log.info('repairing previous abstract assignments')
+    log.info('-- judges per abstract: %d, max abstracts per judge: %d' %
+             (JUDGES_PER_ABSTRACT, JUDGE_LIM))
+    log.info('='*30)
+
+    conflict_matrix = conflict_index['matrix']
+    judge_pos = conflict_index['judge_pos']
+    abstract_pos = conflict_index['abstract_pos']
+
+    judge_names = ["%s %s" % (first.strip(), last.strip()) for first, last in zip(
+        category_judges['First Name'], category_judges['Last Name'])]
+
+    to_judge = id_df.iloc[:, 3] == 'Yes'
+    judged_ids = set(id_df.loc[to_judge, 'ids'])
+
+    # keep every previous assignment that is still valid, in its original order
+    judge_dict = {}
+    holders = defaultdict(list)
+    dropped = 0
+    for name in judge_names:
+        kept = []
+        for abs_id in previous_judge_dict.get(name, []):
+            if abs_id not in judged_ids or abs_id in kept or conflict_matrix[judge_pos[name], abstract_pos[abs_id]]:
+                dropped += 1
+                continue
+            kept.append(abs_id)
+            holders[abs_id].append(name)
+        judge_dict[name] = kept
+    dropped += sum(len(abs_list) for name, abs_list in previous_judge_dict.items() if name not in judge_dict)
+
+    # if fewer judges per abstract are requested than before, take the extra abstracts away
+    # from the most loaded judges
+    for abs_id, names in holders.items():
+        if len(names) > JUDGES_PER_ABSTRACT:
+            for name in sorted(names, key=lambda name: len(judge_dict[name]), reverse=True)[:len(names) - JUDGES_PER_ABSTRACT]:
+                judge_dict[name].remove(abs_id)
+                names.remove(name)
+                dropped += 1
+
+    judge_heap = [(len(abs_list), np.random.random_sample(), name)
+                  for name, abs_list in judge_dict.items() if len(abs_list) < JUDGE_LIM]
+    heapq.heapify(judge_heap)
+
+    # abstracts in random order, so that late abstracts do not always get the last pick
+    open_ids = [abs_id for abs_id in id_df.loc[to_judge, 'ids'].sample(frac=1)
+                if len(holders[abs_id]) < JUDGES_PER_ABSTRACT]
+
+    filled = 0
+    for abs_id in open_ids:
+        abstract_conflicts = conflict_matrix[:, abstract_pos[abs_id]]
+        current = set(holders[abs_id])
+        needed = JUDGES_PER_ABSTRACT - len(current)
+
+        selected = select_least_loaded_judges(
+            judge_heap, needed, lambda name: name in current or abstract_conflicts[judge_pos[name]])
+
+        for name in selected:
+            judge_dict[name].append(abs_id)
+            holders[abs_id].append(name)
+            if len(judge_dict[name]) < JUDGE_LIM:
+                heapq.heappush(judge_heap, (len(judge_dict[name]), np.random.random_sample(), name))
+        filled += len(selected)
+
+        if len(selected) < needed:
+            COUNTERS['abstracts_under_assigned'] += 1
+            log.warning('oh no! only able to assign abstract id %d to %d / %d judges' %
+                        (abs_id, len(holders[abs_id]), JUDGES_PER_ABSTRACT))
+
+    COUNTERS['repair_slots_filled'] += filled
+    log.info('repair: dropped %d previous assignments, filled %d open slots for %d abstracts',
+             dropped, filled, len(open_ids))
+
+    return judge_dict
+
+
+def find_changed_judges(previous: Dict[str, Dict[str, List[int]]], abstract_assignments: dict) -> List[tuple]:
+    """find_changed_judges
+
+    Compare the repaired assignments to the previous ones.
+
+    Args:
+        previous (dict): from read_previous_assignments
+        abstract_assignments (dict): mapping of [category] -> [judge name] -> [list of abstract ids]
+
+    Returns:
+        List[tuple]: (category, judge name, status, abstracts added, abstracts removed) for every
+                     judge whose abstracts changed, where status is 'added' for judges that were
+                     not in the previous assignments, 'removed' for judges that are no longer
+                     assigned, and 'changed' otherwise
+    """
+    changes = []
+    for cat in list(abstract_assignments) + [cat for cat in previous if cat not in abstract_assignments]:
+        before = previous.get(cat, {})
+        after = abstract_assignments.get(cat, {})
+        for name in list(after) + [name for name in before if name not in after]:
+            if before.get(name, []) == after.get(name, []):
+                continue
+            status = 'added' if name not in before else 'removed' if name not in after else 'changed'
+            old, new = before.get(name, []), after.get(name, [])
+            changes.append((cat, name, status,
+                            [abs_id for abs_id in new if abs_id not in old],
+                            [abs_id for abs_id in old if abs_id not in new]))
+
+    return changes
+
+
+def write_changed_judges(changes: List[tuple], outdir: str) -> None:
+    """write_changed_judges
+
+    Write the judges whose bundles have to be sent again to changed_judges.csv.
+
+    Args:
+        changes (list): from find_changed_judges
+        outdir (str): directory to write changed_judges.csv to
+    """
+    with open(os.path.join(outdir, 'changed_judges.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['category', 'judge', 'status', 'abstracts added', 'abstracts removed'])
+        for cat, name, status, added, removed in changes:
+            writer.writerow([cat, name, status, ' '.join(map(str, added)), ' '.join(map(str, removed))])
+
+    return
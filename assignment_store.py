@@ -0,0 +1,192 @@
+"""assignment_store.py
+
+Compact, indexed store of the judging assignments, written next to unified.csv as
+assignments.npz.
+
+unified.csv is one row per judge with the abstracts spread over Abs1 ... Absn columns, which is
+what the mail merge needs, but every other step has to parse it again and find the columns by
+position, and finding the judges of a single abstract means scanning every row. The store keeps
+the same assignments as integer coded numpy arrays:
+
+    judges:     judge_category (code into categories), judge_email, judge_first, judge_last, with
+                the names as written in the judges sheet
+    long table: judge (row in the judges), abstract (id), category (code), slot (0 based position
+                in the judge's list), one entry per (judge, abstract) assignment, sorted by judge
+                and slot
+    indexes:    judge_indptr, so that the abstracts of judge j are abstract[judge_indptr[j]:judge_indptr[j + 1]]
+                abstract_ids (sorted), abstract_indptr and abstract_judges, so that the judges of
+                abstract_ids[a] are abstract_judges[abstract_indptr[a]:abstract_indptr[a + 1]]
+
+so both kinds of lookups cost O(degree) (plus a binary search for the abstract id), and loading
+the store is a single np.load without any parsing. 100k assignments take well under a megabyte.
+
+read_assignments also accepts a unified.csv, which it reads by column name, so that hand edited
+assignments still work everywhere the store is read.
+"""
+import csv
+import logging
+import os
+from collections import defaultdict
+from typing import Dict, List
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+STORE_NAME = 'assignments.npz'
+
+
+def build_store(table: dict) -> Dict[str, np.ndarray]:
+    """build_store
+
+    Args:
+        table (dict): the assignment table, from assign_abstracts.build_assignment_table
+
+    Returns:
+        Dict[str, np.ndarray]: the arrays of the store, see the module docstring
+    """
+    # categories are coded in the order they first come up
+    categories = list(dict.fromkeys(table['category']))
+    codes = {cat: code for code, cat in enumerate(categories)}
+    judge_category = np.array([codes[cat] for cat in table['category']], dtype=np.int8)
+
+    load = np.asarray(table['load'], dtype=np.int64)
+    judge = np.repeat(np.arange(len(load), dtype=np.int32), load)
+    judge_indptr = np.concatenate([[0], np.cumsum(load)]).astype(np.int64)
+    slot = (np.arange(len(judge)) - judge_indptr[judge]).astype(np.int16)
+    abstract = np.asarray(table['abstracts'])[judge, slot].astype(np.int32) if len(judge) else np.array([], dtype=np.int32)
+
+    # abstract -> judges, as a second CSR index over the same assignments
+    order = np.lexsort((judge, abstract))
+    abstract_ids, abstract_counts = np.unique(abstract, return_counts=True)
+
+    return {
+        'categories': np.array(categories, dtype=str),
+        'judge_category': judge_category,
+        'judge_email': np.asarray(table['email'], dtype=str),
+        'judge_first': np.asarray(table['first'], dtype=str),
+        'judge_last': np.asarray(table['last'], dtype=str),
+        'judge': judge,
+        'abstract': abstract,
+        'category': judge_category[judge],
+        'slot': slot,
+        'judge_indptr': judge_indptr,
+        'abstract_ids': abstract_ids.astype(np.int32),
+        'abstract_indptr': np.concatenate([[0], np.cumsum(abstract_counts)]).astype(np.int64),
+        'abstract_judges': judge[order],
+    }
+
+
+def write_store(store: Dict[str, np.ndarray], outdir: str) -> str:
+    """write_store
+
+    Args:
+        store (Dict[str, np.ndarray]): from build_store
+        outdir (str): directory to write assignments.npz to
+
+    Returns:
+        str: path of the store
+    """
+    path = os.path.join(outdir, STORE_NAME)
+    # np.savez adds .npz to any other extension
+    tmp_path = os.path.join(outdir, 'assignments.tmp.npz')
+    np.savez_compressed(tmp_path, **store)
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def load_store(path: str) -> Dict[str, np.ndarray]:
+    """load_store
+
+    Args:
+        path (str): assignments.npz written by write_store
+
+    Returns:
+        Dict[str, np.ndarray]: the arrays of the store
+    """
+    with np.load(path, allow_pickle=False) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def read_assignments(path: str) -> Dict[str, np.ndarray]:
+    """read_assignments
+
+    Args:
+        path (str): assignments.npz, a directory that contains it, or a unified.csv. a unified.csv is
+                    read by column name (category, Email Address, First Name, Last Name, Abs1 ...)
+
+    Returns:
+        Dict[str, np.ndarray]: the arrays of the store
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, STORE_NAME)
+    if path.endswith('.npz'):
+        return load_store(path)
+
+    categories, emails, firsts, lasts, id_lists = [], [], [], [], []
+    with open(path, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        abs_cols = [col for col in reader.fieldnames if col.startswith('Abs') and col[3:].isdigit()]
+        abs_cols.sort(key=lambda col: int(col[3:]))
+        for row in reader:
+            categories.append(row['category'])
+            emails.append(row['Email Address'])
+            firsts.append(row['First Name'])
+            lasts.append(row['Last Name'])
+            # -1 pads the rows of other writers of the same layout (see build_assignment_table)
+            id_lists.append([int(row[col]) for col in abs_cols if row[col] and row[col].strip() and int(row[col]) != -1])
+
+    load = np.array([len(id_list) for id_list in id_lists], dtype=int)
+    abstracts = np.full((len(id_lists), load.max() if len(load) else 0), -1, dtype=int)
+    for row, id_list in enumerate(id_lists):
+        abstracts[row, :len(id_list)] = id_list
+
+    return build_store({'category': categories, 'email': emails, 'first': firsts, 'last': lasts,
+                        'load': load, 'abstracts': abstracts})
+
+
+def judge_names(store: Dict[str, np.ndarray]) -> List[str]:
+    """judge_names
+
+    Returns:
+        List[str]: the name of each judge in "first last" format, as used in the assignments
+    """
+    return ["%s %s" % (first.strip(), last.strip()) for first, last in zip(store['judge_first'], store['judge_last'])]
+
+
+def judge_abstracts(store: Dict[str, np.ndarray], judge_idx: int) -> np.ndarray:
+    """judge_abstracts
+
+    Returns:
+        np.ndarray: ids of the abstracts of judge judge_idx, in slot order
+    """
+    return store['abstract'][store['judge_indptr'][judge_idx]:store['judge_indptr'][judge_idx + 1]]
+
+
+def abstract_judges(store: Dict[str, np.ndarray], abs_id: int) -> np.ndarray:
+    """abstract_judges
+
+    Returns:
+        np.ndarray: rows of the judges that have abstract abs_id, empty if it is not assigned
+    """
+    pos = np.searchsorted(store['abstract_ids'], abs_id)
+    if pos == len(store['abstract_ids']) or store['abstract_ids'][pos] != abs_id:
+        return store['abstract_judges'][:0]
+
+    return store['abstract_judges'][store['abstract_indptr'][pos]:store['abstract_indptr'][pos + 1]]
+
+
+def to_assignments(store: Dict[str, np.ndarray]) -> Dict[str, Dict[str, List[int]]]:
+    """to_assignments
+
+    Returns:
+        dict: mapping of [category] -> [judge name] -> [list of abstract ids], as returned by the
+              solvers
+    """
+    assignments = defaultdict(dict)
+    for judge_idx, name in enumerate(judge_names(store)):
+        assignments[str(store['categories'][store['judge_category'][judge_idx]])][name] = \
+            judge_abstracts(store, judge_idx).tolist()
+
+    return dict(assignments)
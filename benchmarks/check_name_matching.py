@@ -0,0 +1,74 @@
+"""check_name_matching.py
+
+Regression checks for the judge / author conflict matching in name_matching.py. Each case is a
+judge name, an authors list, and whether the judge should be found among the authors. Cases
+that the original search_judge_conflicts (legacy_conflicts.py) catches are checked against it
+as well, so that the fuzzy matcher never misses a conflict that the exact matcher would find.
+
+Usage:
+
+    python benchmarks/check_name_matching.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from legacy_conflicts import search_judge_conflicts  # noqa: E402
+from name_matching import build_author_index, match_name  # noqa: E402
+
+# (judge name, authors list, expected conflict)
+CASES = [
+    # surnames that are also degrees
+    ('Chris Ma', 'Chris Ma, MA', True),
+    ('Linh Do', 'Linh Do, Jane Roe', True),
+    ('Ann Pa', 'Jane Roe, Ann Pa', True),
+    ('Lee Ms', 'Lee Ms, PhD', True),
+    ('Kim Np', 'Kim Np', True),
+    # given names after the first
+    ('Michael Smith', 'J. Michael Smith, MD', True),
+    ('Michael Smith', 'J Michael Smith MD PhD', True),
+    # close first names are different people
+    ('Mary Smith', 'Marty Smith', False),
+    ('Mary Smith', 'Marty Smyth', False),
+    # variants that should still match
+    ('Bill Osler', 'William Osler, MD', True),
+    ('José Núñez', 'Jose Nunez', True),
+    ('Ann Smith-Jones', 'Ann Jones', True),
+    ('William Halsted', 'William Halstead', True),
+    ('Jane Doe', 'Dr. Jane Doe, MD, PhD', True),
+    ('Jane Doe', 'J Doe', True),
+    ('Jonathan Hopkins', 'Jonathon Hopkins', True),
+    # different surnames that share a prefix
+    ('John Martin', 'John Martinez', False),
+    ('Mary Kim', 'Mary Kimm', False),
+    ('John Smith', 'John Smith-Wilson', False),
+    ('Anna Lee', 'Anna Leeds', False),
+    ('Yuki Okafor', 'Yuki Miller-Okafor', False),
+    # a middle initial is not a first name
+    ('Aisha Perez', 'Jessica A Perez', False),
+    ('Mary Miller', 'Richard M Miller', False),
+    # a close surname needs the same first name
+    ('Jane Halsted', 'J Halstead', False),
+    ('Jane Doe', 'John Doe', False),
+]
+
+
+def main():
+
+    failures = 0
+    for judge, authors, expected in CASES:
+        matches, _ = match_name(build_author_index([authors]), judge)
+        found = bool(matches)
+        legacy = search_judge_conflicts(judge.lower(), authors)
+        if found != expected or (legacy and not found):
+            failures += 1
+            print('FAIL: %r in %r: found %s, expected %s (search_judge_conflicts: %s)' % (
+                judge, authors, found, expected, legacy))
+
+    print('%d / %d name matching cases passed' % (len(CASES) - failures, len(CASES)))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
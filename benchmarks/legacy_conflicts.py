@@ -0,0 +1,48 @@
+"""legacy_conflicts.py
+
+The exact judge / author conflict check that assign_abstracts.py used before the conflict
+matrix (build_conflict_index) and the fuzzy matching in name_matching.py. It is kept here as the
+reference implementation: run_benchmarks.py times it against the conflict index, and
+check_name_matching.py checks that the fuzzy matching never misses a conflict that it finds.
+"""
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def search_judge_conflicts(judge_name: str, authors_list: str) -> bool:
+    """search_judge_conflicts
+
+    More advanced method of searching for judge name within the authors list.
+
+    Separates the judge name by white space. We know that judge_name is going to be
+    just first name and last name.
+
+    Separates the authors list by commas, then each chunk is separated by spaces.
+
+    This means if we have judge name as [Billy Osler] and author list as
+    [William Halsted, Billy H Osler], this will return True.
+
+    A simple string matching alone would not have returned True.
+
+    i.e. this matches first name + last name while ignoring optional middle initial.
+
+    Degrees do not get in the way: after a comma ("Billy Osler, MD") they are a chunk of their
+    own, and without one ("Billy Osler MD") they are just an extra word in the author's chunk.
+
+    Args:
+        judge_name (str): name of judge
+        authors_list (str): str of all authors
+
+    Returns:
+        bool: whether every word of judge_name is a word of one of the authors
+    """
+    judge_name_chunks = judge_name.lower().split(' ')
+    parsed_chunks = [author.strip().lower().split(' ')
+                     for author in authors_list.split(',')]
+    for author_chunks in parsed_chunks:
+        if all([chunk in author_chunks for chunk in judge_name_chunks]):
+            log.debug('judge name found in authors list: %s %s', judge_name, authors_list)
+            return True
+
+    return False
@@ -0,0 +1,353 @@
+"""run_benchmarks.py
+
+Benchmark harness for the assignment and bundling pipeline, run on synthetic data from
+synthetic_data.py so that no student data is needed.
+
+For each scale (number of abstracts), the following stages are timed:
+
+- read_students: preprocess_abstract_submissions
+- read_judges: read_judge_cat_assign
+- conflict_index: build_conflict_index for every category
+- conflict_scan_legacy: legacy_conflicts.search_judge_conflicts for every (judge, abstract) pair, skipped at large scales
+- assign_<solver>: assignment of every category with each of the requested solvers
+- quality_check: quality_check on the greedy assignment
+- write: write_abstract_assignments
+- bundle: writing every judge's bundle from the merged pdf
+
+Each stage records wall time and peak memory, and the assignment stages also record the
+quality of the assignment (coverage, load spread, conflicted assignments). Results are
+appended as JSON lines to --results, tagged with the git commit, so that runs from different
+commits can be compared with --compare.
+
+Usage:
+
+    python benchmarks/run_benchmarks.py --scales 200,1000,5000,20000 --results bench.jsonl
+    python benchmarks/run_benchmarks.py --compare bench.jsonl
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pprint import pprint
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import assign_abstracts  # noqa: E402
+import preprocess_abs  # noqa: E402
+import synthetic_data  # noqa: E402
+from legacy_conflicts import search_judge_conflicts  # noqa: E402
+
+# above this many (judge, abstract) pairs, the legacy pairwise conflict scan takes too long
+LEGACY_SCAN_LIMIT = 2_000_000
+
+
+def parse_command_line() -> dict:
+
+    parser = argparse.ArgumentParser(
+        description='benchmark the abstract assignment and bundling pipeline on synthetic data')
+
+    parser.add_argument('--scales', type=str, action='store', default='200,1000,5000,20000',
+                        help='comma separated numbers of abstracts to benchmark')
+    parser.add_argument('--solvers', type=str, action='store', default='greedy,flow',
+                        help='comma separated solvers to benchmark')
+    parser.add_argument('--seed', type=int, action='store', default=0,
+                        help='seed for the synthetic data')
+    parser.add_argument('--skip_bundle', action='store_true',
+                        help='do not benchmark writing the judge bundles')
+    parser.add_argument('--trace_memory', action='store_true',
+                        help='record the peak python heap of each stage with tracemalloc. slows every stage down')
+    parser.add_argument('--workdir', type=str, action='store',
+                        help='directory for the synthetic inputs and outputs. defaults to a temporary directory')
+    parser.add_argument('--results', type=str, action='store', default='bench_results.jsonl',
+                        help='file that the results are appended to, as JSON lines')
+    parser.add_argument('--compare', type=str, action='store',
+                        help='instead of running, print a comparison of the commits in this results file')
+
+    args = vars(parser.parse_args())
+    print('--- received the following commandline arguments')
+    pprint(args)
+    return args
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return 'unknown'
+
+
+@contextmanager
+def stage(records: list, name: str, trace_memory: bool, **info):
+    """stage
+
+    Time the body of the with statement and append a record for it. Anything the body stores
+    into the yielded dictionary is added to the record.
+    """
+    extra = {}
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        yield extra
+        error = None
+    except Exception as e:
+        error = repr(e)
+    wall = time.perf_counter() - start
+
+    record = {'stage': name, 'wall_s': round(wall, 4), **info, **extra}
+    if trace_memory:
+        record['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        tracemalloc.stop()
+    # max rss never goes down, so this is the peak of the whole run up to and including the stage
+    record['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+    if error is not None:
+        record['error'] = error
+    records.append(record)
+    print('%-28s %9.3fs%s' % (name, wall, '  ERROR %s' % error if error else ''))
+
+
+def assignment_quality(abstract_assignments: dict, category_dfs: dict, judges_per_abstract: dict,
+                       conflict_indexes: dict, judge_lim: int = 15) -> dict:
+    """assignment_quality
+
+    Summarize how good an assignment is: how many of the required (abstract, judge) slots were
+    filled, how evenly the abstracts are spread over the judges, and whether any conflicted
+    judge was assigned.
+    """
+    required = assigned = under_assigned = conflicted = 0
+    loads = []
+    for cat, judge_dict in abstract_assignments.items():
+        df = category_dfs[cat]
+        to_judge = df.loc[df.iloc[:, 3] == 'Yes', 'ids']
+        counts = dict.fromkeys(to_judge, 0)
+        index = conflict_indexes[cat]
+        for name, ids in judge_dict.items():
+            loads.append(len(ids))
+            for abs_id in ids:
+                counts[abs_id] = counts.get(abs_id, 0) + 1
+                conflicted += int(index['matrix'][index['judge_pos'][name], index['abstract_pos'][abs_id]])
+        k = judges_per_abstract[cat]
+        required += k * len(counts)
+        assigned += sum(min(k, c) for c in counts.values())
+        under_assigned += sum(c < k for c in counts.values())
+
+    loads = np.array(loads) if loads else np.zeros(1)
+    return {
+        'coverage': round(assigned / required, 6) if required else 1.0,
+        'under_assigned': int(under_assigned),
+        'conflicted_assignments': int(conflicted),
+        'load_min': int(loads.min()),
+        'load_max': int(loads.max()),
+        'load_std': round(float(loads.std()), 4),
+        'judges_over_limit': int((loads > judge_lim).sum()),
+    }
+
+
+def run_scale(num_abstracts: int, args: dict, workdir: str) -> list:
+    """run_scale
+
+    Generate synthetic inputs for num_abstracts abstracts and time every stage of the pipeline.
+    """
+    records = []
+    trace = args['trace_memory']
+    scale_dir = os.path.join(workdir, 'n%d' % num_abstracts)
+    outdir = os.path.join(scale_dir, 'out')
+    os.makedirs(outdir, exist_ok=True)
+
+    judges = synthetic_data.generate_judges(num_abstracts, seed=args['seed'])
+    students = synthetic_data.generate_students(num_abstracts, judges, seed=args['seed'])
+    paths = synthetic_data.write_workbooks(students, judges, scale_dir)
+
+    categories = [
+        "Basic Science",
+        "Clinical Science",
+        "Public Health",
+        "Humanism, Ethics, Education, and the Art of Medicine (HEART)",
+        "History of Medicine",
+    ]
+    judges_per_abstract = dict(zip(categories, synthetic_data.JUDGES_PER_ABSTRACT))
+
+    # start from an empty id registry, so that every run measures allocating all of the ids
+    id_registry = os.path.join(scale_dir, 'abstract_id_registry.json')
+    if os.path.exists(id_registry):
+        os.remove(id_registry)
+
+    id_df = student_df = None
+    with stage(records, 'read_students', trace):
+        id_df, student_df = assign_abstracts.preprocess_abstract_submissions(
+            paths['students'], paths['students_tab'], use_cache=False, id_registry=id_registry)
+    if id_df is None:
+        # the submissions could not be given ids, fall back to sequential ids so that the
+        # remaining stages can still be measured
+        student_df = students.copy()
+        student_df['ids'] = np.arange(100, 100 + len(student_df))
+        student_df['Scholarly Concentration'] = student_df['Scholarly Concentration'].str.replace(
+            "Humanism, Ethics, Education, and the Art of Medicine", categories[3], regex=False)
+        id_df = student_df[['ids', 'Scholarly Concentration', 'Authors', synthetic_data.OPT_IN_COLUMN]]
+
+    with stage(records, 'read_judges', trace):
+        judges_per_cat = assign_abstracts.read_judge_cat_assign(
+            paths['judges'], paths['judges_tab'], paths['judges_header'], categories, use_cache=False)
+
+    category_dfs = {cat: id_df.loc[id_df['Scholarly Concentration'] == cat] for cat in categories}
+    judge_names = {cat: ["%s %s" % (first.strip(), last.strip()) for first, last in zip(
+        judges_per_cat[cat]['First Name'], judges_per_cat[cat]['Last Name'])] for cat in categories}
+    num_pairs = sum(len(category_dfs[cat]) * len(judge_names[cat]) for cat in categories)
+
+    conflict_indexes = {}
+    with stage(records, 'conflict_index', trace, pairs=num_pairs) as extra:
+        for cat in categories:
+            conflict_indexes[cat] = assign_abstracts.build_conflict_index(category_dfs[cat], judge_names[cat])
+        extra['conflicts'] = sum(len(index['conflicts']) for index in conflict_indexes.values())
+
+    if num_pairs <= LEGACY_SCAN_LIMIT:
+        with stage(records, 'conflict_scan_legacy', trace, pairs=num_pairs) as extra:
+            found = 0
+            for cat in categories:
+                for authors in category_dfs[cat]['Authors']:
+                    for name in judge_names[cat]:
+                        found += search_judge_conflicts(name, authors)
+            extra['conflicts'] = found
+
+    assignments = {}
+    for solver in args['solvers']:
+        with stage(records, 'assign_%s' % solver, trace) as extra:
+            result = {}
+            for cat_idx, cat in enumerate(categories):
+                np.random.seed(assign_abstracts.derive_seed(2022, cat_idx))
+                if solver == 'flow':
+                    from assignment_flow import assign_abstracts_with_flow
+                    result[cat] = assign_abstracts_with_flow(
+                        category_dfs[cat], judges_per_cat[cat], conflict_indexes[cat],
+                        JUDGES_PER_ABSTRACT=judges_per_abstract[cat])
+                else:
+                    result[cat] = assign_abstracts.assign_abstracts_to_judges(
+                        category_dfs[cat], judges_per_cat[cat],
+                        JUDGES_PER_ABSTRACT=judges_per_abstract[cat], conflict_index=conflict_indexes[cat])
+            assignments[solver] = result
+        if solver in assignments:
+            records[-1].update(assignment_quality(
+                assignments[solver], category_dfs, judges_per_abstract, conflict_indexes))
+
+    if not assignments:
+        return records
+    abstract_assignments = next(iter(assignments.values()))
+
+    with stage(records, 'quality_check', trace) as extra:
+        report = assign_abstracts.quality_check(id_df, abstract_assignments, conflict_indexes,
+                                                judges_per_abstract=judges_per_abstract)
+        extra['passed'] = report['passed']
+
+    with stage(records, 'write', trace):
+        assign_abstracts.write_abstract_assignments(abstract_assignments, judges_per_cat, outdir)
+
+    if not args['skip_bundle']:
+        # the merged pdf has to be in the same order as the ids, so it is only written now
+        pdf_path = os.path.join(scale_dir, 'abstracts_merged.pdf')
+        synthetic_data.write_abstract_pdf(
+            [synthetic_data.abstract_page_lines(row) for _, row in student_df.iterrows()], pdf_path)
+
+        bundle_dir = os.path.join(scale_dir, 'attachments')
+        os.makedirs(bundle_dir, exist_ok=True)
+        with stage(records, 'bundle', trace) as extra:
+            page_index = preprocess_abs.build_page_index(len(student_df), list(student_df['ids']))
+            bundles = preprocess_abs.read_judge_bundles(os.path.join(outdir, 'assignments.npz'), bundle_dir)
+            preprocess_abs.init_bundle_worker(pdf_path, page_index, bundle_dir, True)
+            results = [preprocess_abs.write_judge_bundle(bundle) for bundle in bundles]
+            extra['bundles'] = len(results)
+            extra['failed'] = sum(error is not None for _, error, _ in results)
+
+    for record in records:
+        record['abstracts'] = num_abstracts
+        record['judges'] = len(judges)
+
+    return records
+
+
+def compare(results_file: str) -> None:
+    """compare
+
+    Print the wall time of every (stage, scale) for each commit in the results file, using the
+    latest run of each commit, with the ratio against the first commit.
+    """
+    latest = {}
+    commits = []
+    with open(results_file, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['commit'] not in commits:
+                commits.append(record['commit'])
+            latest[(record['commit'], record['stage'], record['abstracts'])] = record
+
+    keys = sorted({(stage_name, n) for _, stage_name, n in latest}, key=lambda x: (x[1], x[0]))
+    print('%-24s %8s ' % ('stage', 'abstracts') + ' '.join('%18s' % c for c in commits))
+    for stage_name, n in keys:
+        base = latest.get((commits[0], stage_name, n))
+        cells = []
+        for commit in commits:
+            record = latest.get((commit, stage_name, n))
+            if record is None:
+                cells.append('%18s' % '-')
+            elif base is None or commit == commits[0] or not base['wall_s']:
+                cells.append('%17.3fs' % record['wall_s'])
+            else:
+                cells.append('%9.3fs (x%5.2f)' % (record['wall_s'], record['wall_s'] / base['wall_s']))
+        print('%-24s %8d ' % (stage_name, n) + ' '.join(cells))
+
+    return
+
+
+def main():
+
+    args = parse_command_line()
+
+    if args['compare']:
+        compare(args['compare'])
+        return
+
+    args['solvers'] = [solver for solver in args['solvers'].split(',') if solver]
+    scales = [int(n) for n in args['scales'].split(',') if n]
+
+    # the pipeline logs every judge's assignments, which would dominate the timings
+    logging.getLogger().setLevel(logging.ERROR)
+
+    workdir = args['workdir'] or tempfile.mkdtemp(prefix='msrs_bench_')
+    run_info = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seed': args['seed'],
+    }
+
+    try:
+        for num_abstracts in scales:
+            print('--- %d abstracts' % num_abstracts)
+            records = run_scale(num_abstracts, args, workdir)
+            with open(args['results'], 'a') as f:
+                for record in records:
+                    f.write(json.dumps({**run_info, **record}) + '\n')
+    finally:
+        if not args['workdir']:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print('--- results appended to %s' % args['results'])
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""synthetic_data.py
+
+Deterministic generator of fake MSRS inputs, for benchmarking the assignment and bundling
+pipeline without any real student data.
+
+Generates, for a given number of abstracts and seed:
+
+- a students workbook, tab "PROCESSING_READY", with the same columns as the abstract submission
+  survey (title, abstract sections, category, authors, opt in)
+- a judges workbook, tab "ASSIGNED_TO_CATEGORIES", with the header on row 3 like the real sheet
+- a merged abstract pdf with one page per abstract, see write_abstract_pdf
+
+Author lists are made to look like the real ones: optional middle initials, degrees tacked on
+after a comma ("Jane Q Doe, MD, PhD"), hyphenated surnames and accents. Some abstracts have a
+judge from the same category as an author, so that there are conflicts to find, and some
+abstracts opt out of judging.
+
+Usage:
+
+    python benchmarks/synthetic_data.py --abstracts 1000 --outdir /tmp/msrs_synthetic
+"""
+import argparse
+import os
+import sys
+from pprint import pprint
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from render_abstracts import pdf_string, write_pdf  # noqa: E402
+
+CATEGORIES = [
+    "Basic Science",
+    "Clinical Science",
+    "Public Health",
+    "Humanism, Ethics, Education, and the Art of Medicine",
+    "History of Medicine",
+]
+
+# share of the abstracts in each category, roughly what a real year looks like
+CATEGORY_SHARE = [0.4, 0.35, 0.12, 0.08, 0.05]
+
+# default number of judges per abstract in each category, same as assign_abstracts.py
+JUDGES_PER_ABSTRACT = [7, 5, 4, 4, 4]
+
+OPT_IN_COLUMN = 'Are you interested in being considered for an oral or podium presentation?'
+
+FIRST_NAMES = [
+    'James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+    'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Wei', 'Priya',
+    'Mohammed', 'Aisha', 'Hiroshi', 'Yuki', 'José', 'María', 'Chinedu', 'Ngozi', 'Søren', 'Zoë',
+]
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+    'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin',
+    'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Sanchez', 'Clark', 'Ramirez', 'Lewis', 'Robinson',
+    'Nguyen', 'Patel', 'Kim', 'Chen', 'Okafor', 'Yamamoto', 'Müller', 'Núñez', 'Osler', 'Halsted',
+]
+DEGREES = ['MD', 'PhD', 'MD, PhD', 'MPH', 'MS', 'BS', 'MD, MPH']
+WORDS = (
+    'patients cohort outcomes risk analysis cells expression mice tumor protein signaling clinical '
+    'trial randomized survey community health disparities education curriculum ethics history '
+    'hospital surgery imaging diagnosis treatment response inflammation pathway genome sequencing '
+    'association mortality prevalence intervention students residents burnout archive century'
+).split()
+
+
+def _random_name(rng: np.random.Generator) -> tuple:
+    first = FIRST_NAMES[rng.integers(len(FIRST_NAMES))]
+    last = LAST_NAMES[rng.integers(len(LAST_NAMES))]
+    if rng.random() < 0.08:
+        last = '%s-%s' % (last, LAST_NAMES[rng.integers(len(LAST_NAMES))])
+    return first, last
+
+
+def _author_string(rng: np.random.Generator, first: str, last: str) -> str:
+    middle = ' %s' % chr(ord('A') + rng.integers(26)) if rng.random() < 0.4 else ''
+    if rng.random() < 0.1:
+        middle += '.'
+    degree = ', %s' % DEGREES[rng.integers(len(DEGREES))] if rng.random() < 0.25 else ''
+    return '%s%s %s%s' % (first, middle, last, degree)
+
+
+def _sentence(rng: np.random.Generator, num_words: int) -> str:
+    return ' '.join(WORDS[i] for i in rng.integers(len(WORDS), size=num_words)).capitalize() + '.'
+
+
+def generate_judges(num_abstracts: int, seed: int = 0, judge_lim: int = 15) -> pd.DataFrame:
+    """generate_judges
+
+    Generate enough judges for every category to be fully assigned, with about 10% spare capacity.
+
+    Args:
+        num_abstracts (int): number of abstracts that will be generated
+        seed (int): seed for the random number generator
+        judge_lim (int): maximum number of abstracts per judge
+
+    Returns:
+        pd.DataFrame: judges, with the columns of the judge sign up sheet
+    """
+    rng = np.random.default_rng([seed, 1])
+
+    rows = []
+    used_names = set()
+    for cat, share, k in zip(CATEGORIES, CATEGORY_SHARE, JUDGES_PER_ABSTRACT):
+        if cat.startswith('Humanism'):
+            cat = cat + ' (HEART)'
+        num_judges = max(k, int(np.ceil(1.1 * share * num_abstracts * k / judge_lim)))
+        for _ in range(num_judges):
+            # judges are keyed by name in assign_abstracts.py, so the names have to be unique
+            first, last = _random_name(rng)
+            while (first, last) in used_names:
+                last = '%s-%s' % (LAST_NAMES[rng.integers(len(LAST_NAMES))], last)
+            used_names.add((first, last))
+            rows.append({
+                'Timestamp': pd.Timestamp('2021-10-01') + pd.Timedelta(minutes=int(rng.integers(60*24*30))),
+                'Email Address': '%s.%s%d@example.org' % (first.lower(), last.lower(), len(rows)),
+                # the real sheet has stray whitespace in the names
+                'First Name': first + (' ' if rng.random() < 0.1 else ''),
+                'Last Name': last,
+                'Would you like to judge student abstracts?': 'Yes' if rng.random() < 0.97 else 'No',
+                'Assignment': cat,
+            })
+
+    return pd.DataFrame(rows)
+
+
+def generate_students(num_abstracts: int, judges: pd.DataFrame, seed: int = 0,
+                      conflict_rate: float = 0.03, opt_out_rate: float = 0.05) -> pd.DataFrame:
+    """generate_students
+
+    Args:
+        num_abstracts (int): number of abstracts to generate
+        judges (pd.DataFrame): judges from generate_judges, used to seed conflicts
+        seed (int): seed for the random number generator
+        conflict_rate (float): fraction of abstracts with a judge from the same category as an author
+        opt_out_rate (float): fraction of abstracts that opt out of judging
+
+    Returns:
+        pd.DataFrame: abstract submissions, with the columns of the submission survey
+    """
+    rng = np.random.default_rng([seed, 2])
+
+    categories = rng.choice(len(CATEGORIES), size=num_abstracts, p=CATEGORY_SHARE)
+    judges_by_cat = {cat: judges.loc[judges['Assignment'].str.startswith(cat[:20])] for cat in CATEGORIES}
+
+    rows = []
+    for i in range(num_abstracts):
+        cat = CATEGORIES[categories[i]]
+        authors = [_author_string(rng, *_random_name(rng)) for _ in range(1 + rng.poisson(4))]
+
+        if rng.random() < conflict_rate and len(judges_by_cat[cat]):
+            judge = judges_by_cat[cat].iloc[rng.integers(len(judges_by_cat[cat]))]
+            authors.insert(rng.integers(len(authors) + 1),
+                           _author_string(rng, judge['First Name'].strip(), judge['Last Name']))
+
+        student_first, student_last = _random_name(rng)
+        freeform = rng.random() < 0.1
+        rows.append({
+            'Timestamp': pd.Timestamp('2021-11-01') + pd.Timedelta(minutes=int(rng.integers(60*24*30))),
+            'Email Address': 'student%d@example.edu' % i,
+            'First Name': student_first,
+            'Last Name': student_last,
+            'Scholarly Concentration': cat,
+            'Title': _sentence(rng, 6 + rng.integers(10)),
+            'Authors': ', '.join(authors),
+            'Background': None if freeform else ' '.join(_sentence(rng, 15) for _ in range(3)),
+            'Methods': None if freeform else ' '.join(_sentence(rng, 15) for _ in range(3)),
+            'Results': None if freeform else ' '.join(_sentence(rng, 15) for _ in range(4)),
+            'Conclusion': None if freeform else _sentence(rng, 20),
+            'Please enter your abstract text below:': ' '.join(_sentence(rng, 15) for _ in range(12)) if freeform else None,
+            OPT_IN_COLUMN: 'No' if rng.random() < opt_out_rate else 'Yes',
+        })
+
+    return pd.DataFrame(rows)
+
+
+def write_workbooks(students: pd.DataFrame, judges: pd.DataFrame, outdir: str) -> dict:
+    """write_workbooks
+
+    Write the students and judges workbooks laid out like the real ones.
+
+    Args:
+        students (pd.DataFrame): from generate_students
+        judges (pd.DataFrame): from generate_judges
+        outdir (str): directory to write the workbooks to
+
+    Returns:
+        dict: paths, tabs and header row to pass to assign_abstracts.py
+    """
+    os.makedirs(outdir, exist_ok=True)
+    students_file = os.path.join(outdir, 'student_abstracts.xlsx')
+    judges_file = os.path.join(outdir, 'judge_categories.xlsx')
+
+    with pd.ExcelWriter(students_file, engine='openpyxl') as writer:
+        students.to_excel(writer, sheet_name='PROCESSING_READY', index=False)
+
+    # the real sheet has category metrics above the header row
+    with pd.ExcelWriter(judges_file, engine='openpyxl') as writer:
+        judges.to_excel(writer, sheet_name='ASSIGNED_TO_CATEGORIES', index=False, startrow=3)
+
+    return {
+        'students': students_file,
+        'students_tab': 'PROCESSING_READY',
+        'judges': judges_file,
+        'judges_tab': 'ASSIGNED_TO_CATEGORIES',
+        'judges_header': 3,
+    }
+
+
+def write_abstract_pdf(pages: list, pdf_path: str) -> None:
+    """write_abstract_pdf
+
+    Write a minimal pdf with one page of plain text for each entry of pages, where each entry
+    is a list of lines. This stands in for the mail merged abstract pdf, without needing Word.
+    The pdf itself is written by render_abstracts.write_pdf.
+
+    Args:
+        pages (list): list of pages, each a list of lines of text
+        pdf_path (str): where to write the pdf
+    """
+    write_pdf([b'BT /F1 10 Tf 12 TL 54 740 Td ' + b' '.join(pdf_string(line) + b' Tj T*' for line in lines) + b' ET'
+               for lines in pages], pdf_path)
+
+    return
+
+
+def abstract_page_lines(row, width: int = 95) -> list:
+    """abstract_page_lines
+
+    Lay out an anonymized abstract (id, title and text only) as lines of a single page.
+    Text that does not fit on the page is cut off.
+
+    Args:
+        row: row of the students dataframe, with an 'ids' column
+        width (int): maximum number of characters per line
+
+    Returns:
+        list: lines of text
+    """
+    lines = ['Student ID: %d' % row['ids'], 'Title: %s' % row['Title'][:width - 7], '']
+    for section in ['Background', 'Methods', 'Results', 'Conclusion', 'Please enter your abstract text below:']:
+        text = row.get(section)
+        if not isinstance(text, str):
+            continue
+        words, line = text.split(), ''
+        for word in words:
+            if len(line) + len(word) + 1 > width:
+                lines.append(line)
+                line = ''
+            line = (line + ' ' + word).strip()
+        lines += [line, '']
+
+    return lines[:58]
+
+
+def parse_command_line() -> dict:
+
+    parser = argparse.ArgumentParser(
+        description='generate synthetic MSRS inputs for benchmarking')
+
+    parser.add_argument('--abstracts', type=int, action='store', default=1000,
+                        help='number of abstracts to generate')
+    parser.add_argument('--seed', type=int, action='store', default=0,
+                        help='seed for the generator, the same seed always gives the same data')
+    parser.add_argument('--outdir', type=str, action='store', required=True,
+                        help='directory to write the workbooks and pdf to')
+
+    args = vars(parser.parse_args())
+    print('--- received the following commandline arguments')
+    pprint(args)
+    return args
+
+
+def main():
+
+    args = parse_command_line()
+
+    judges = generate_judges(args['abstracts'], seed=args['seed'])
+    students = generate_students(args['abstracts'], judges, seed=args['seed'])
+    paths = write_workbooks(students, judges, args['outdir'])
+
+    # the pdf pages follow the row order, with placeholder ids. the real ids are only known once
+    # assign_abstracts.py has been run, see run_benchmarks.py
+    students['ids'] = np.arange(len(students))
+    write_abstract_pdf([abstract_page_lines(row) for _, row in students.iterrows()],
+                       os.path.join(args['outdir'], 'abstracts_merged.pdf'))
+
+    print('--- wrote %d abstracts and %d judges' % (len(students), len(judges)))
+    pprint(paths)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,617 @@
+"""dispatch_emails.py
+
+Email each judge their bundle of abstracts, instead of a Word mail merge with the bundles
+attached by hand (step 4 of the workflow).
+
+Each row of unified.csv (from assign_abstracts.py) is joined with its bundle,
+MSRS_abstracts_Dr_[first]_[last].pdf in the --bundles directory (from preprocess_abs.py), and the
+message is rendered from a template. The template is either the Word mail merge document
+(mailmerge_abstract_judging_email_template.docx), whose MERGEFIELDs (Last_Name, Abs1 ... Abs15)
+are filled in from the columns of unified.csv, or a text file with {Last_Name}-style fields. In
+either, the run of Abs fields is replaced with the list of the judge's abstract ids, so judges with
+fewer than 15 abstracts do not get a trail of empty commas.
+
+Messages are sent over a small pool of SMTP connections (--connections), each of which is reused
+for many messages, with a shared rate limit (--rate) so the mail server does not throttle or
+block the account, and with retries for temporary failures. With --outbox, nothing is sent, and
+every message is written to an .eml file and to outbox.mbox instead, to check them before the
+real run. --smtp_host localhost --smtp_port 1025 sends to a local SMTP stand-in.
+
+Every send is recorded in sent_log.jsonl. A message is logged as 'started' before it is handed to
+the server and 'sent' once the server has accepted it, and the file is flushed to disk each time.
+A message whose connection drops while it is being sent is not retried, since the server may have
+accepted it, and is left as 'started'. Rerunning after a crash skips the messages that were sent,
+and also the ones that were started but never confirmed, since they may well have gone out; those
+are listed, and are only sent again with --retry_uncertain. Messages are identified by the judge's
+email address and abstract ids, so a judge whose bundle changed (e.g. after assign_abstracts.py
+--repair) is emailed again.
+
+The SMTP password is read from the MSRS_SMTP_PASSWORD environment variable, so that it does not
+end up in the shell history.
+
+Usage:
+
+    python dispatch_emails.py --judging MSRS2021/abstract_assignments/unified.csv --bundles MSRS2021/attachments/ --template mailmerge_abstract_judging_email_template.docx --sender msrs@jhmi.edu --subject "MSRS abstract judging" --outbox MSRS2021/outbox/
+"""
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import mailbox
+import os
+import re
+import smtplib
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid, parseaddr
+from typing import Callable, Dict, List
+from xml.etree import ElementTree
+
+from instrumentation import COUNTERS, LOG_LEVELS, setup_logging, stage
+
+log = logging.getLogger(__name__)
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+# name of the file that records every message that was sent
+SENT_LOG_NAME = 'sent_log.jsonl'
+
+PASSWORD_VARIABLE = 'MSRS_SMTP_PASSWORD'
+
+# start of the error of a message that may or may not have been sent, see send_messages
+UNCERTAIN = 'uncertain: '
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """add_arguments
+
+    Add the command line options of the dispatch to parser, so that they can be shared by this
+    script and the msrs email subcommand.
+    """
+    parser.add_argument('--judging', action="store", type=str, required=True,
+                        help='unified.csv written by assign_abstracts.py'
+                        )
+    parser.add_argument('--bundles', action="store", type=str, required=True,
+                        help='directory with the judge bundles written by preprocess_abs.py'
+                        )
+    parser.add_argument('--template', action="store", type=str, required=True,
+                        help='the mail merge .docx, or a text file with {Last_Name}-style fields. a text template may start with a "Subject: ..." line'
+                        )
+    parser.add_argument('--subject', action="store", type=str, default='MSRS abstract judging',
+                        help='subject of the emails, may contain fields. a Subject line in a text template takes precedence'
+                        )
+    parser.add_argument('--sender', action="store", type=str, required=True,
+                        help='From address of the emails'
+                        )
+    parser.add_argument('--outbox', action="store", type=str,
+                        help='if provided, do not send anything, and write each message to an .eml file and outbox.mbox in this directory'
+                        )
+    parser.add_argument('--smtp_host', action="store", type=str, default='localhost',
+                        help='SMTP server to send through'
+                        )
+    parser.add_argument('--smtp_port', action="store", type=int, default=587,
+                        help='port of the SMTP server'
+                        )
+    parser.add_argument('--security', action="store", type=str, default='starttls', choices=['starttls', 'ssl', 'none'],
+                        help='how to encrypt the connection to the SMTP server. use none for a local SMTP stand-in'
+                        )
+    parser.add_argument('--username', action="store", type=str,
+                        help='SMTP login, the password is read from the %s environment variable' % PASSWORD_VARIABLE
+                        )
+    parser.add_argument('--connections', action="store", type=int, default=4,
+                        help='number of SMTP connections used to send in parallel'
+                        )
+    parser.add_argument('--rate', action="store", type=float, default=1.0,
+                        help='maximum number of messages sent per second, over all connections. 0 for no limit'
+                        )
+    parser.add_argument('--retries', action="store", type=int, default=3,
+                        help='number of times to retry a message after a temporary failure'
+                        )
+    parser.add_argument('--sent_log', action="store", type=str,
+                        help='log of the messages that were sent, for resuming. defaults to %s in --outbox, or in --bundles' % SENT_LOG_NAME
+                        )
+    parser.add_argument('--retry_uncertain', action="store_true",
+                        help='send the messages that were started but never confirmed on a previous run again'
+                        )
+    parser.add_argument('--log_level', '--log-level', action="store", type=str, default='INFO', choices=LOG_LEVELS,
+                        help='only log messages at or above this level'
+                        )
+
+    return parser
+
+
+def parse_command_line():
+
+    parser = argparse.ArgumentParser(
+        description='email each judge their bundle of abstracts')
+
+    args = vars(add_arguments(parser).parse_args())
+
+    setup_logging(args['log_level'])
+    log.debug('%s', args)
+    return args
+
+
+def docx_template_text(template_file: str) -> str:
+    """docx_template_text
+
+    Extract the text of a Word mail merge document, with each MERGEFIELD replaced by a {field}
+    placeholder. The text that Word shows for a field (e.g. the last name of the first row of the
+    data source) is dropped.
+
+    Args:
+        template_file (str): path to the .docx
+
+    Returns:
+        str: the text, one line per paragraph, with literal braces doubled
+    """
+    with zipfile.ZipFile(template_file) as docx:
+        root = ElementTree.fromstring(docx.read('word/document.xml'))
+
+    paragraphs = []
+    for paragraph in root.iter(WORD_NAMESPACE + 'p'):
+        text = []
+        # inside a complex field: the instruction comes before 'separate', its displayed value after
+        instruction, in_result = None, False
+        for node in paragraph.iter():
+            tag = node.tag[len(WORD_NAMESPACE):] if node.tag.startswith(WORD_NAMESPACE) else None
+            if tag == 'fldChar':
+                field_type = node.get(WORD_NAMESPACE + 'fldCharType')
+                if field_type == 'begin':
+                    instruction, in_result = '', False
+                elif field_type == 'separate':
+                    in_result = True
+                elif field_type == 'end':
+                    match = re.match(r'\s*MERGEFIELD\s+"?([^\s"\\]+)', instruction or '')
+                    if match:
+                        text.append('{%s}' % match.group(1))
+                    instruction, in_result = None, False
+            elif tag == 'instrText' and instruction is not None:
+                instruction += node.text or ''
+            elif tag == 'fldSimple':
+                match = re.match(r'\s*MERGEFIELD\s+"?([^\s"\\]+)', node.get(WORD_NAMESPACE + 'instr', ''))
+                if match:
+                    text.append('{%s}' % match.group(1))
+                # the displayed value is inside of the fldSimple, skip it
+                for child in node.iter(WORD_NAMESPACE + 't'):
+                    child.text = ''
+            elif instruction is not None and (in_result or tag in ('t', 'br', 'tab')):
+                continue
+            elif tag == 't':
+                text.append((node.text or '').replace('{', '{{').replace('}', '}}'))
+            elif tag in ('br', 'cr'):
+                text.append('\n')
+            elif tag == 'tab':
+                text.append('\t')
+        paragraphs.append(''.join(text))
+
+    return '\n'.join(paragraphs)
+
+
+def load_template(template_file: str) -> tuple:
+    """load_template
+
+    Args:
+        template_file (str): the mail merge .docx, or a text file with {field} placeholders
+
+    Returns:
+        tuple: (subject template or None, body template), in str.format syntax. A run of
+               {Abs1}, {Abs2}, ... fields is replaced with a single {Abstracts} field
+    """
+    if template_file.lower().endswith('.docx'):
+        subject, body = None, docx_template_text(template_file)
+    else:
+        with open(template_file, 'r', encoding='utf-8') as f:
+            body = f.read()
+        subject = None
+        match = re.match(r'Subject:(.*)\n', body)
+        if match:
+            subject, body = match.group(1).strip(), body[match.end():].lstrip('\n')
+
+    body = re.sub(r'\{Abs1\}(?:\s*,\s*\{Abs\d+\})+', '{Abstracts}', body)
+
+    return subject, body
+
+
+def read_judge_messages(judging: str, bundle_dir: str) -> List[dict]:
+    """read_judge_messages
+
+    Join each judge in unified.csv with their bundle.
+
+    Args:
+        judging (str): unified.csv written by assign_abstracts.py, read by column name (Email Address,
+                       First Name, Last Name, Abs1 ...), so hand edited files with extra or
+                       reordered columns work too
+        bundle_dir (str): directory with the judge bundles
+
+    Returns:
+        List[dict]: for each judge with at least one abstract, the keys
+            - email: the judge's email address
+            - abstract_ids: list of abstract ids, in order
+            - attachment: path of the bundle
+            - fields: merge fields, named like Word names them (the column names with spaces
+                      replaced by underscores, e.g. Last_Name, Abs1), plus Abstracts, the comma
+                      separated abstract ids
+    """
+    judges = []
+    with open(judging, 'r', newline='') as f:
+        reader = csv.DictReader(f)
+        abs_cols = [col for col in reader.fieldnames if col.startswith('Abs') and col[3:].isdigit()]
+        abs_cols.sort(key=lambda col: int(col[3:]))
+        for row in reader:
+            first, last = row['First Name'], row['Last Name']
+            # -1 pads the rows of other writers of the same layout, like in assignment_store.read_assignments
+            abs_ids = [int(row[col]) for col in abs_cols if row[col] and row[col].strip() and int(row[col]) != -1]
+            if not abs_ids:
+                log.info('skipping %s %s, who has no abstracts to judge', first.strip(), last.strip())
+                continue
+
+            # fields that the judge does not have (e.g. Abs14 for a judge with 12 abstracts) are
+            # empty, like in a Word mail merge
+            fields = defaultdict(str, {re.sub(r'\W', '_', col.strip()): (value or '').strip()
+                                       for col, value in row.items() if col is not None})
+            fields['Abstracts'] = ', '.join(map(str, abs_ids))
+            judges.append({
+                'email': row['Email Address'].strip(),
+                'abstract_ids': abs_ids,
+                'attachment': os.path.join(bundle_dir, "MSRS_abstracts_Dr_%s_%s.pdf" % (first, last)),
+                'fields': fields,
+            })
+
+    return judges
+
+
+def message_key(judge: dict) -> str:
+    """message_key
+
+    Returns:
+        str: identifies the message to a judge in the sent log, by their email address and
+             abstract ids
+    """
+    return hashlib.sha256(('%s:%s' % (judge['email'].lower(), judge['abstract_ids'])).encode()).hexdigest()[:16]
+
+
+def build_message(judge: dict, subject: str, body: str, sender: str) -> EmailMessage:
+    """build_message
+
+    Args:
+        judge (dict): from read_judge_messages
+        subject (str): subject template
+        body (str): body template
+        sender (str): From address
+
+    Returns:
+        EmailMessage: the message, with the bundle attached
+    """
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = judge['email']
+    message['Subject'] = subject.format_map(judge['fields'])
+    message['Date'] = formatdate(localtime=True)
+    message['Message-ID'] = make_msgid(domain=parseaddr(sender)[1].rpartition('@')[2] or None)
+    message.set_content(body.format_map(judge['fields']))
+
+    with open(judge['attachment'], 'rb') as f:
+        message.add_attachment(f.read(), maintype='application', subtype='pdf',
+                               filename=os.path.basename(judge['attachment']))
+
+    return message
+
+
+def load_sent_log(sent_log: str) -> Dict[str, dict]:
+    """load_sent_log
+
+    Args:
+        sent_log (str): path of the sent log
+
+    Returns:
+        dict: mapping of [message key] -> the last record for that message
+    """
+    records = {}
+    if not os.path.exists(sent_log):
+        return records
+
+    with open(sent_log, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line can be cut short by a crash
+                log.warning('ignoring a malformed line in %s', sent_log)
+                continue
+            records[record['key']] = record
+
+    return records
+
+
+def append_sent_log(sent_log: str, record: dict, lock: threading.Lock) -> None:
+    """append_sent_log
+
+    Append a record to the sent log, and make sure it is on disk before returning.
+    """
+    record = dict(record, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with lock:
+        with open(sent_log, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    return
+
+
+def make_rate_limiter(rate: float) -> Callable[[], None]:
+    """make_rate_limiter
+
+    Args:
+        rate (float): maximum number of calls per second, over all threads. 0 for no limit
+
+    Returns:
+        Callable[[], None]: function that blocks until the next call is allowed
+    """
+    lock = threading.Lock()
+    next_slot = [time.monotonic()]
+
+    def wait():
+        if rate <= 0:
+            return
+        with lock:
+            now = time.monotonic()
+            slot = max(now, next_slot[0])
+            next_slot[0] = slot + 1.0 / rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    return wait
+
+
+def open_smtp(args: dict) -> smtplib.SMTP:
+    """open_smtp
+
+    Open and log in to a connection to the SMTP server in args.
+    """
+    if args['security'] == 'ssl':
+        connection = smtplib.SMTP_SSL(args['smtp_host'], args['smtp_port'], timeout=60)
+    else:
+        connection = smtplib.SMTP(args['smtp_host'], args['smtp_port'], timeout=60)
+        if args['security'] == 'starttls':
+            connection.starttls()
+    if args['username']:
+        connection.login(args['username'], os.environ.get(PASSWORD_VARIABLE, ''))
+
+    return connection
+
+
+def is_temporary(error: Exception) -> bool:
+    """is_temporary
+
+    Returns:
+        bool: whether sending again later might work, i.e. dropped connections, network errors
+              and 4xx replies from the server. 5xx replies (e.g. a bad address) are permanent
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError))
+
+
+def send_messages(messages: List[tuple], template: tuple, args: dict, sent_log: str) -> dict:
+    """send_messages
+
+    Send messages over a pool of args['connections'] reused SMTP connections, with the rate
+    limit and retries in args. Each message is only built (and its bundle read) when it is about
+    to be sent.
+
+    Only failures that happen before the message is handed to the server, or that the server
+    replies with, are retried. If the connection drops while the message is being sent, there is
+    no telling whether the server got it, so it is not retried and stays 'started' in the sent log.
+
+    Args:
+        messages (List[tuple]): (message key, judge) for each message to send
+        template (tuple): (subject template, body template)
+        args (dict): options from add_arguments
+        sent_log (str): path of the sent log
+
+    Returns:
+        dict: mapping of [message key] -> None if the message was sent, or a description of the
+              error, which starts with UNCERTAIN if the message may have been sent
+    """
+    log_lock = threading.Lock()
+    wait = make_rate_limiter(args['rate'])
+
+    # each thread keeps its own connection open for all of the messages it sends
+    local = threading.local()
+    connections = []
+    connections_lock = threading.Lock()
+
+    def send(item):
+        key, judge = item
+        try:
+            message = build_message(judge, *template, args['sender'])
+        except Exception as e:
+            # e.g. a bundle that was removed or cannot be read since the run started
+            error = repr(e)
+            log.warning('could not build the message to %s: %s', judge['email'], error)
+            append_sent_log(sent_log, {'key': key, 'email': judge['email'], 'status': 'failed', 'error': error}, log_lock)
+            return key, error
+        error = None
+        for attempt in range(args['retries'] + 1):
+            if attempt:
+                # back off 2, 4, 8, ... seconds before trying again
+                time.sleep(2 ** attempt)
+                COUNTERS['email_retries'] += 1
+            handed_over = False
+            try:
+                if getattr(local, 'connection', None) is None:
+                    local.connection = open_smtp(args)
+                    with connections_lock:
+                        connections.append(local.connection)
+                else:
+                    # a reused connection may have been closed by the server while it was idle,
+                    # which is safe to find out now, but not once the message is on its way
+                    local.connection.noop()
+                wait()
+                append_sent_log(sent_log, {'key': key, 'email': judge['email'], 'status': 'started',
+                                           'message_id': message['Message-ID']}, log_lock)
+                handed_over = True
+                local.connection.send_message(message)
+            except Exception as e:
+                error = repr(e)
+                # smtplib errors are OSErrors too, but most of them leave the connection usable
+                dropped = isinstance(e, smtplib.SMTPServerDisconnected) or (
+                    isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException))
+                if dropped:
+                    local.connection = None
+                if handed_over and dropped:
+                    # the server may have accepted the message before the connection dropped, so
+                    # sending it again could email the judge twice. it stays 'started' in the sent
+                    # log, so that reruns skip it unless --retry_uncertain
+                    log.warning('the connection dropped while sending to %s, so the message may or may not have '
+                                'been sent, check by hand: %s', judge['email'], error)
+                    return key, UNCERTAIN + error
+                log.warning('sending to %s failed (attempt %d / %d): %s', judge['email'], attempt + 1, args['retries'] + 1, error)
+                if not is_temporary(e):
+                    break
+                continue
+
+            append_sent_log(sent_log, {'key': key, 'email': judge['email'], 'status': 'sent',
+                                       'message_id': message['Message-ID'], 'abstract_ids': judge['abstract_ids']}, log_lock)
+            log.info('sent %s to %s', os.path.basename(judge['attachment']), judge['email'])
+            return key, None
+
+        append_sent_log(sent_log, {'key': key, 'email': judge['email'], 'status': 'failed', 'error': error}, log_lock)
+        return key, error
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args['connections'])) as executor:
+            results = dict(executor.map(send, messages))
+    finally:
+        for connection in connections:
+            try:
+                connection.quit()
+            except Exception:
+                pass
+
+    return results
+
+
+def write_outbox(messages: List[tuple], template: tuple, args: dict, sent_log: str) -> dict:
+    """write_outbox
+
+    Write each message to [outbox]/[bundle name].eml, and all of them to [outbox]/outbox.mbox,
+    instead of sending them. Takes the same arguments as send_messages, and the directory from
+    args['outbox'].
+
+    Returns:
+        dict: mapping of [message key] -> None if the message was written, or a description of the
+              error, like send_messages
+    """
+    outbox = args['outbox']
+    os.makedirs(outbox, exist_ok=True)
+    log_lock = threading.Lock()
+    results = {}
+
+    mbox = mailbox.mbox(os.path.join(outbox, 'outbox.mbox'))
+    mbox.lock()
+    try:
+        for key, judge in messages:
+            try:
+                message = build_message(judge, *template, args['sender'])
+            except Exception as e:
+                results[key] = repr(e)
+                log.warning('could not build the message to %s: %s', judge['email'], results[key])
+                append_sent_log(sent_log, {'key': key, 'email': judge['email'], 'status': 'failed', 'error': results[key]}, log_lock)
+                continue
+            eml_name = os.path.splitext(os.path.basename(judge['attachment']))[0] + '.eml'
+            with open(os.path.join(outbox, eml_name), 'wb') as f:
+                f.write(message.as_bytes())
+            mbox.add(message)
+            mbox.flush()
+            append_sent_log(sent_log, {'key': key, 'email': judge['email'], 'status': 'sent', 'outbox': eml_name,
+                                       'message_id': message['Message-ID'], 'abstract_ids': judge['abstract_ids']}, log_lock)
+            results[key] = None
+    finally:
+        mbox.unlock()
+        mbox.close()
+
+    return results
+
+
+def run_dispatch(args: dict) -> dict:
+    """run_dispatch
+
+    Email every judge that has not been emailed their current bundle yet.
+
+    Args:
+        args (dict): options from add_arguments
+
+    Returns:
+        dict: mapping of [message key] -> None if the message was sent, or a description of the error
+    """
+    default_subject, body = load_template(args['template'])
+    subject = default_subject or args['subject']
+
+    judges = read_judge_messages(args['judging'], args['bundles'])
+    sent_log = args['sent_log'] or os.path.join(args['outbox'] or args['bundles'], SENT_LOG_NAME)
+    previous = load_sent_log(sent_log)
+
+    messages, uncertain, missing = [], [], []
+    for judge in judges:
+        key = message_key(judge)
+        status = previous.get(key, {}).get('status')
+        if status == 'sent':
+            continue
+        if status == 'started' and not args['retry_uncertain']:
+            uncertain.append(judge['email'])
+            continue
+        if not os.path.exists(judge['attachment']):
+            missing.append(judge['attachment'])
+            continue
+        messages.append((key, judge))
+
+    log.info('%d judges, %d already emailed, %d to email', len(judges),
+             len(judges) - len(messages) - len(uncertain) - len(missing), len(messages))
+    if missing:
+        log.warning('oh no! no bundle for %d judges, they were not emailed: %s', len(missing), missing)
+    if uncertain:
+        log.warning('the messages to %d judges were started on a previous run, but not confirmed, so they may '
+                    'have been sent. they were skipped, use --retry_uncertain to send them again: %s',
+                    len(uncertain), ', '.join(uncertain))
+
+    with stage('send'):
+        if args['outbox']:
+            results = write_outbox(messages, (subject, body), args, sent_log)
+        else:
+            results = send_messages(messages, (subject, body), args, sent_log)
+
+    failed = {key: error for key, error in results.items() if error is not None}
+    unsure = [judge['email'] for key, judge in messages if (results.get(key) or '').startswith(UNCERTAIN)]
+    COUNTERS['emails_sent'] += len(results) - len(failed)
+    log.info('%s %d messages, %d failed, see %s', 'wrote' if args['outbox'] else 'sent',
+             len(results) - len(failed), len(failed), sent_log)
+    if unsure:
+        log.warning('the connection dropped while sending to %d judges, so their messages may or may not have been '
+                    'sent. check the sent folder of the account, reruns skip them unless --retry_uncertain: %s',
+                    len(unsure), ', '.join(unsure))
+
+    return results
+
+
+def main():
+
+    args = parse_command_line()
+    run_dispatch(args)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
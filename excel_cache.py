@@ -0,0 +1,108 @@
+"""excel_cache.py
+
+Cache for the Excel sheets read by assign_abstracts.py and preprocess_abs.py.
+
+Parsing .xlsx files with openpyxl is slow once there are thousands of rows of abstract text,
+and the same sheets get re-read on every run while the assignment settings are being tweaked.
+Each (file, sheet, header row) that is read is converted to a Feather file, and later runs load
+from the Feather file instead, as long as the Excel file has the same modification time and size.
+
+Feather requires pyarrow. If pyarrow is not installed, or a sheet cannot be stored as Feather
+(e.g. a column that mixes numbers and text), the sheet is cached as a pickle instead.
+
+The cache lives in a .msrs_cache folder next to the Excel file, so that student data stays
+with the rest of the inputs.
+"""
+import glob
+import hashlib
+import logging
+import os
+import re
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR_NAME = '.msrs_cache'
+
+
+def _cache_prefix(excel_file: str, sheet_name, header) -> str:
+    """_cache_prefix
+
+    Path prefix of the cache entries for a (file, sheet, header row), without the part of the
+    name that depends on the file modification time and size.
+    """
+    excel_file = os.path.abspath(excel_file)
+    key = hashlib.sha1(repr((excel_file, sheet_name, header)).encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(excel_file))[0]
+    return os.path.join(os.path.dirname(excel_file), CACHE_DIR_NAME, '%s_%s' % (stem, key))
+
+
+def read_excel_cached(excel_file: str, sheet_name=0, header=0, use_cache: bool = True, **kwargs) -> pd.DataFrame:
+    """read_excel_cached
+
+    Drop in replacement for pd.read_excel that caches the parsed sheet.
+
+    Args:
+        excel_file (str): path to the Excel file
+        sheet_name: the tab within the Excel file to be read
+        header: the row to use as header row
+        use_cache (bool): if False, always parse the Excel file and do not touch the cache
+        **kwargs: passed on to pd.read_excel
+
+    Returns:
+        pd.DataFrame: the parsed sheet
+    """
+    if not use_cache:
+        return pd.read_excel(excel_file, sheet_name=sheet_name, header=header, **kwargs)
+
+    stat = os.stat(excel_file)
+    prefix = _cache_prefix(excel_file, sheet_name, header)
+    version = hashlib.sha1(repr((stat.st_mtime_ns, stat.st_size, sorted(kwargs.items()))).encode()).hexdigest()[:16]
+    feather_path = '%s_%s.feather' % (prefix, version)
+    pickle_path = '%s_%s.pkl' % (prefix, version)
+
+    if os.path.exists(feather_path):
+        log.debug('loading %s [%s] from cache %s', excel_file, sheet_name, feather_path)
+        return pd.read_feather(feather_path)
+    if os.path.exists(pickle_path):
+        log.debug('loading %s [%s] from cache %s', excel_file, sheet_name, pickle_path)
+        return pd.read_pickle(pickle_path)
+
+    df = pd.read_excel(excel_file, sheet_name=sheet_name, header=header, **kwargs)
+
+    # remove the entries for older versions of the file before writing the new one
+    for stale_path in glob.glob(prefix + '_*'):
+        os.remove(stale_path)
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+
+    try:
+        df.to_feather(feather_path)
+    except Exception as e:
+        log.debug('could not cache %s [%s] as feather (%s), using pickle', excel_file, sheet_name, e)
+        if os.path.exists(feather_path):
+            os.remove(feather_path)
+        df.to_pickle(pickle_path)
+
+    return df
+
+
+def clear_excel_cache(excel_file: str) -> None:
+    """clear_excel_cache
+
+    Remove every cached sheet of an Excel file.
+
+    Args:
+        excel_file (str): path to the Excel file
+    """
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(excel_file)), CACHE_DIR_NAME)
+    if not os.path.isdir(cache_dir):
+        return
+
+    stem = os.path.splitext(os.path.basename(excel_file))[0]
+    pattern = re.compile(r'^%s_[0-9a-f]{16}_[0-9a-f]{16}\.(feather|pkl)$' % re.escape(stem))
+    for name in os.listdir(cache_dir):
+        if pattern.match(name):
+            os.remove(os.path.join(cache_dir, name))
+
+    return
@@ -0,0 +1,150 @@
+"""instrumentation.py
+
+Logging setup and lightweight metrics for the MSRS scripts.
+
+Stages of a run are timed with the stage context manager, and anything worth counting
+(e.g. candidate judges scanned, candidates skipped for a conflict) is added to COUNTERS. write_metrics dumps
+both to a JSON file, so that we can see where a run spends its time without a profiler.
+
+Example:
+
+    with stage('assign'):
+        ...
+    COUNTERS['candidates_scanned'] += 10
+    write_metrics('metrics.json')
+"""
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+# counters for the current process, see merge_counters for combining counters from worker processes
+COUNTERS = Counter()
+
+# one record per stage that has been run, in the order that they finished
+STAGES = []
+
+
+def setup_logging(level: str = 'INFO') -> None:
+    """setup_logging
+
+    Send log records at or above level to the terminal through rich. rich is only imported
+    here, so that importing a module does not pay for it.
+
+    Args:
+        level (str): one of LOG_LEVELS
+    """
+    from rich.logging import RichHandler
+
+    logging.basicConfig(
+        level=level,
+        format="%(message)s",
+        datefmt="[%X]",
+        handlers=[RichHandler(rich_tracebacks=True)],
+        force=True,
+    )
+
+    return
+
+
+def peak_rss_mb() -> float:
+    """peak_rss_mb
+
+    Returns:
+        float: peak resident memory of this process so far in MB, or nan if it is not available
+    """
+    if resource is None:
+        return float('nan')
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes on linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+@contextmanager
+def stage(name: str):
+    """stage
+
+    Record the wall time and memory of the body of the with statement as a stage.
+
+    Args:
+        name (str): name of the stage, e.g. 'read' or 'assign'
+    """
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        rss_after = peak_rss_mb()
+        STAGES.append({
+            'stage': name,
+            'wall_s': round(wall, 4),
+            'peak_rss_mb': round(rss_after, 2),
+            'peak_rss_increase_mb': round(rss_after - rss_before, 2),
+        })
+        logging.getLogger(__name__).debug('stage %s took %.3fs', name, wall)
+
+
+def counter_snapshot() -> dict:
+    """counter_snapshot
+
+    Returns:
+        dict: copy of the current counters, to pass to counter_delta later
+    """
+    return dict(COUNTERS)
+
+
+def counter_delta(snapshot: dict) -> dict:
+    """counter_delta
+
+    Args:
+        snapshot (dict): from counter_snapshot
+
+    Returns:
+        dict: how much each counter has gone up since the snapshot was taken
+    """
+    return {key: value - snapshot.get(key, 0) for key, value in COUNTERS.items() if value != snapshot.get(key, 0)}
+
+
+def merge_counters(counts: dict) -> None:
+    """merge_counters
+
+    Add counts that were collected in a worker process to the counters of this process.
+
+    Args:
+        counts (dict): from counter_delta in the worker process
+    """
+    COUNTERS.update(counts)
+
+    return
+
+
+def write_metrics(metrics_file: str, **info) -> None:
+    """write_metrics
+
+    Write the stages and counters recorded so far to a JSON file.
+
+    Args:
+        metrics_file (str): where to write the metrics
+        **info: any other information to include, e.g. the command line arguments
+    """
+    metrics = {
+        **info,
+        'total_wall_s': round(sum(record['wall_s'] for record in STAGES), 4),
+        'stages': STAGES,
+        'counters': dict(COUNTERS),
+    }
+    with open(metrics_file, 'w') as f:
+        json.dump(metrics, f, indent=2, default=str)
+
+    return
@@ -0,0 +1,250 @@
+"""judge_pool.py
+
+Allocation of judges to categories across the whole event, for --pool_judges.
+
+Normally each judge is fixed to the category in the 'Assignment' column of the judges sheet,
+so a category can run short of judges while another has judges to spare. The sign up sheet
+also records every category a judge is interested in (the per-category columns, and the
+free text answer to the topic question), and judges were told that they would be placed in
+whichever topic needs more judges.
+
+Each category c needs at least
+
+    needed_c = max(JUDGES_PER_ABSTRACT_c, ceil(abstracts_c * JUDGES_PER_ABSTRACT_c / JUDGE_LIM))
+
+judges. Judges keep their assigned category where possible; the categories that are short
+are topped up from the spare judges of the other categories, and from judges that signed up
+without being assigned a category, as long as the judge is interested in the category. This
+is a single max-flow problem over all categories and judges (see move_judges):
+
+    source -> short category c      capacity needed_c - assigned_c
+    category c -> judge             capacity 1, if the judge is interested in c
+    judge -> category it came from  capacity 1
+    category it came from -> sink   capacity assigned - needed, the spare judges
+
+so no category is left short if it can be avoided.
+
+Being just above its minimum still leaves a category's judges with close to JUDGE_LIM abstracts
+each while another category's judges have a few, so the judges are then spread in proportion to
+the judge slots (abstracts x judges per abstract) of each category. Every category gets a
+target share of all of the judges, and a second max-flow of the same shape moves the judges
+above the target of their category (and the judges without a category) to the categories below
+their target that they are interested in. The abstracts per judge then come out about the same
+in every category, as far as the interests of the judges allow.
+
+Every judge still ends up in exactly one category, and the abstracts are then assigned per
+category as usual, since a judge scores the abstracts of a single category.
+"""
+import logging
+import os
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_flow
+
+log = logging.getLogger(__name__)
+
+JUDGE_COLUMN = "Would you like to judge student abstracts?"
+TOPIC_COLUMN = "What topic would you like to judge? If you are interested in multiple options, you'll be placed in whatever topic needs more judges. "
+
+OUTPUT_COLS = ['Email Address', 'First Name', 'Last Name', ]
+
+
+def judge_eligibility(judges: pd.DataFrame, categories: List[str]) -> np.ndarray:
+    """judge_eligibility
+
+    Work out which categories each judge is interested in. A judge is interested in a category
+    if it is their 'Assignment', if the column named after the category is filled in (with
+    anything other than 'No'), or if the category is mentioned in their answer to the topic
+    question, e.g. "Basic Science, History of Medicine".
+
+    Args:
+        judges (pd.DataFrame): judges sheet, with the columns of the sign up sheet
+        categories (List[str]): the MSRS categories
+
+    Returns:
+        np.ndarray: bool array of shape (num judges, num categories)
+    """
+    eligible = np.zeros((len(judges), len(categories)), dtype=bool)
+    topics = judges[TOPIC_COLUMN].fillna('').astype(str).str.lower() if TOPIC_COLUMN in judges.columns else None
+
+    for c, cat in enumerate(categories):
+        if 'Assignment' in judges.columns:
+            eligible[:, c] |= (judges['Assignment'] == cat).to_numpy()
+        if cat in judges.columns:
+            marked = judges[cat].fillna('').astype(str).str.strip().str.lower()
+            eligible[:, c] |= (~marked.isin(['', 'no', '0', 'false', 'nan'])).to_numpy()
+        if topics is not None:
+            # match on the name without the abbreviation, e.g. "Humanism, ... of Medicine"
+            eligible[:, c] |= topics.str.contains(cat.split(' (')[0].lower(), regex=False).to_numpy()
+
+    return eligible
+
+
+def proportional_split(total: int, weights: np.ndarray) -> np.ndarray:
+    """proportional_split
+
+    Args:
+        total (int): number of items to split
+        weights (np.ndarray): weight of each share
+
+    Returns:
+        np.ndarray: integer shares that add up to total, as close to proportional to weights as
+                    possible (largest remainders), all 0 if the weights are
+    """
+    if weights.sum() == 0:
+        return np.zeros(len(weights), dtype=int)
+    exact = total * weights / weights.sum()
+    shares = np.floor(exact).astype(int)
+    shares[np.argsort(shares - exact, kind='stable')[:total - shares.sum()]] += 1
+
+    return shares
+
+
+def move_judges(allocation: np.ndarray, eligible: np.ndarray, gain: np.ndarray, surplus: np.ndarray) -> np.ndarray:
+    """move_judges
+
+    Move judges from the categories with a surplus to the categories that gain judges, only to
+    categories they are interested in, as a single max-flow problem:
+
+        source -> category c            capacity gain_c
+        category c -> judge             capacity 1, if the judge is interested in c
+        judge -> category it is in      capacity 1
+        category it is in -> sink       capacity surplus of the category
+
+    Args:
+        allocation (np.ndarray): category of each judge, num categories for judges without one
+        eligible (np.ndarray): from judge_eligibility
+        gain (np.ndarray): how many judges each category should gain at most
+        surplus (np.ndarray): how many judges each category (and the judges without one, last)
+                              can give up at most
+
+    Returns:
+        np.ndarray: the new category of each judge
+    """
+    num_judges, num_cats = eligible.shape
+    allocation = allocation.copy()
+    movable = (surplus[allocation] > 0)[:, None] & (allocation[:, None] != np.arange(num_cats)[None, :]) & (gain > 0)[None, :]
+    edge_judge, edge_cat = np.nonzero(eligible & movable)
+    if not len(edge_judge):
+        return allocation
+
+    # node layout: [source] [categories] [judges] [categories the judges come from] [sink]
+    source = 0
+    cat_nodes = 1 + np.arange(num_cats)
+    judge_nodes = 1 + num_cats + np.arange(num_judges)
+    from_nodes = 1 + num_cats + num_judges + np.arange(num_cats + 1)
+    sink = from_nodes[-1] + 1
+
+    candidates = np.unique(edge_judge)
+    rows = np.concatenate([np.full(num_cats, source), cat_nodes[edge_cat], judge_nodes[candidates], from_nodes])
+    cols = np.concatenate([cat_nodes, judge_nodes[edge_judge], from_nodes[allocation[candidates]], np.full(num_cats + 1, sink)])
+    caps = np.concatenate([gain, np.ones(len(edge_judge)), np.ones(len(candidates)), surplus]).astype(np.int32)
+    graph = csr_matrix((caps, (rows, cols)), shape=(sink + 1, sink + 1))
+    flow = maximum_flow(graph, source, sink, method='dinic').flow.tocoo()
+
+    is_move = (flow.data > 0) & (flow.row >= 1) & (flow.row <= num_cats) & (flow.col >= judge_nodes[0]) & (flow.col < from_nodes[0])
+    allocation[flow.col[is_move] - judge_nodes[0]] = flow.row[is_move] - 1
+
+    return allocation
+
+
+def allocate_judges(judges: pd.DataFrame, categories: List[str], num_abstracts: Dict[str, int],
+                    judges_per_abstract: Dict[str, int], JUDGE_LIM: int = 15) -> Union[dict, pd.DataFrame]:
+    """allocate_judges
+
+    Allocate the judges that would like to judge abstracts to categories, see the module docstring.
+
+    Args:
+        judges (pd.DataFrame): judges sheet, with the columns of the sign up sheet
+        categories (List[str]): the MSRS categories
+        num_abstracts (dict): mapping of [category] -> number of abstracts sent out for judging
+        judges_per_abstract (dict): mapping of [category] -> number of judges per abstract
+        JUDGE_LIM (int): maximum number of abstracts per judge
+
+    Returns:
+        Union[dict, pd.DataFrame]: mapping of [category] -> dataframe of judges, like
+                                   read_judge_cat_assign, and the supply / demand report with
+                                   one row per category
+    """
+    volunteers = judges.loc[judges[JUDGE_COLUMN] == "Yes"].reset_index(drop=True)
+    eligible = judge_eligibility(volunteers, categories)
+    num_cats = len(categories)
+
+    # category of each judge in the sheet, num_cats for judges without one
+    primary = np.array([categories.index(a) if a in categories else num_cats for a in volunteers['Assignment']], dtype=int)
+
+    demand = np.array([num_abstracts[cat] * judges_per_abstract[cat] for cat in categories])
+    needed = np.array([max(judges_per_abstract[cat] if num_abstracts[cat] else 0, -(-d // JUDGE_LIM))
+                       for cat, d in zip(categories, demand)])
+    assigned = np.bincount(primary, minlength=num_cats + 1)
+    deficit = np.maximum(needed - assigned[:num_cats], 0)
+    spare = np.append(np.maximum(assigned[:num_cats] - needed, 0), assigned[num_cats])
+
+    # first make sure every category has the judges it needs
+    allocation = move_judges(primary, eligible, deficit, spare)
+
+    # then spread the judges that are left over in proportion to the judge slots of each category,
+    # so that the judges of every category get about as many abstracts. the judges without a
+    # category are all left over, and so are the ones above the target of their category
+    placeable = (primary < num_cats) | eligible.any(axis=1)
+    target = proportional_split(int(placeable.sum()), demand)
+    current = np.bincount(allocation, minlength=num_cats + 1)
+    gap = np.maximum(target - current[:num_cats], 0)
+    surplus = np.append(np.maximum(current[:num_cats] - np.maximum(target, needed), 0), current[num_cats])
+    allocation = move_judges(allocation, eligible, gap, surplus)
+
+    for j in np.nonzero(allocation != primary)[0]:
+        log.info('moved judge %s %s from %s to %s', volunteers.at[j, 'First Name'], volunteers.at[j, 'Last Name'],
+                 categories[primary[j]] if primary[j] < num_cats else 'no category', categories[allocation[j]])
+    unplaced = int(((allocation == num_cats) & placeable).sum())
+    if unplaced:
+        log.info('%d judges without a category were not needed by the categories they are interested in', unplaced)
+
+    judges_per_cat = {cat: volunteers.loc[allocation == c, OUTPUT_COLS].copy() for c, cat in enumerate(categories)}
+
+    final = np.bincount(allocation, minlength=num_cats + 1)[:num_cats]
+    report = pd.DataFrame({
+        'category': categories,
+        'abstracts': [num_abstracts[cat] for cat in categories],
+        'judges per abstract': [judges_per_abstract[cat] for cat in categories],
+        'slots needed': demand,
+        'judges needed': needed,
+        'judges assigned': assigned[:num_cats],
+        'judges interested': eligible.sum(axis=0),
+        'moved in': [int(((allocation == c) & (primary != c)).sum()) for c in range(num_cats)],
+        'moved out': [int(((allocation != c) & (primary == c)).sum()) for c in range(num_cats)],
+        'target judges': target,
+        'judges': final,
+        'abstracts per judge': np.round(demand / np.maximum(final, 1), 2),
+        'capacity': final * JUDGE_LIM,
+        'spare slots': final * JUDGE_LIM - demand,
+        'judges short': np.maximum(needed - final, 0),
+    })
+    for cat, short in zip(categories, report['judges short']):
+        if short:
+            log.warning('oh no! category %s is still %d judges short after pooling', cat, short)
+
+    return judges_per_cat, report
+
+
+def write_pool_report(report: pd.DataFrame, outdir: str) -> None:
+    """write_pool_report
+
+    Write the supply / demand report from allocate_judges to judge_pool_report.csv, and log a
+    one line summary of it. The full table is only logged at DEBUG.
+
+    Args:
+        report (pd.DataFrame): from allocate_judges
+        outdir (str): directory to write the report to
+    """
+    report_path = os.path.join(outdir, 'judge_pool_report.csv')
+    report.to_csv(report_path, index=False)
+    log.info('pooled %d judges over %d categories, %d moved, %d judges short, see %s',
+             report['judges'].sum(), len(report), report['moved in'].sum(), report['judges short'].sum(), report_path)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('judge supply and demand per category:\n%s', report.to_string(index=False))
+
+    return
@@ -0,0 +1,225 @@
+"""msrs.py
+
+Single command line entry point for the MSRS scripts, with one subcommand per step:
+
+    assign  - assign abstracts to judges (assign_abstracts.py)
+    render  - render the anonymized abstract pdf from the submissions (render_abstracts.py)
+    split   - split the big pdf of abstracts into one pdf per abstract (preprocess_abs.py)
+    bundle  - split, then bundle the abstracts of each judge into one pdf (preprocess_abs.py --bundle_abstracts)
+    email   - email each judge their bundle (dispatch_emails.py)
+    score   - normalize the judge scores and rank the abstracts (process_scores.py)
+    all     - assign, then bundle, then score if --scores is provided
+
+The subcommands only import the modules they need, so that e.g. `msrs.py --help` or
+`msrs.py score --help` does not pay for importing PyPDF2 or the assignment code, and the options
+of a subcommand are only added to the parser when that subcommand is run.
+
+`all` runs the steps in the same process and passes the results on in memory: the bundles are
+built from the assignments and the abstract ids that were just computed, instead of reading
+unified.csv and the submissions sheet back from disk, and the judge categories for the scores
+come from the same assignments.
+"""
+import argparse
+import sys
+
+SUBCOMMANDS = {
+    'assign': 'assign abstracts to judges',
+    'render': 'render the anonymized abstract pdf from the abstract submissions',
+    'split': 'split the big pdf of abstracts into one pdf per abstract',
+    'bundle': 'bundle the abstracts assigned to each judge into a single pdf',
+    'email': 'email each judge their bundle of abstracts',
+    'score': 'normalize judge scores with a gaussian mixed effects model and rank the abstracts',
+    'all': 'assign the abstracts, bundle them for each judge, and score them if --scores is provided',
+}
+
+
+def add_subcommand_arguments(command: str, parser: argparse.ArgumentParser) -> None:
+    """add_subcommand_arguments
+
+    Add the options of a single subcommand. This imports the modules of the subcommand.
+
+    Args:
+        command (str): name of the subcommand
+        parser (argparse.ArgumentParser): parser of the subcommand
+    """
+    if command == 'assign':
+        import assign_abstracts
+        assign_abstracts.add_arguments(parser)
+    elif command == 'render':
+        import render_abstracts
+        render_abstracts.add_arguments(parser)
+    elif command in ('split', 'bundle'):
+        import preprocess_abs
+        preprocess_abs.add_arguments(parser)
+    elif command == 'email':
+        import dispatch_emails
+        dispatch_emails.add_arguments(parser)
+    elif command == 'score':
+        import process_scores
+        process_scores.add_arguments(parser)
+    elif command == 'all':
+        import assign_abstracts
+        import preprocess_abs
+        import process_scores
+        assign_abstracts.add_arguments(parser)
+        preprocess_abs.add_arguments(parser.add_argument_group('bundle'), chained=True)
+        process_scores.add_arguments(parser.add_argument_group('score'), chained=True)
+
+    return
+
+
+def parse_command_line(argv: list = None) -> dict:
+
+    argv = sys.argv[1:] if argv is None else argv
+    # the first positional argument is the subcommand, the only one whose options are needed
+    command = next((arg for arg in argv if not arg.startswith('-')), None)
+
+    parser = argparse.ArgumentParser(
+        prog='msrs',
+        description='automate the MSRS abstract judging: assign, split, bundle and score the abstracts',
+    )
+    subparsers = parser.add_subparsers(dest='command', metavar='{%s}' % ','.join(SUBCOMMANDS))
+    subparsers.required = True
+    for name, help_text in SUBCOMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text, description=help_text,
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        if name == command:
+            add_subcommand_arguments(name, subparser)
+
+    args = vars(parser.parse_args(argv))
+    if args['command'] == 'bundle' and not args['judging']:
+        parser.error('msrs bundle requires --judging')
+    if args['command'] in ('split', 'bundle') and not args['submissions'] and not args['page_ranges']:
+        parser.error('msrs %s requires one of --submissions or --page_ranges' % args['command'])
+
+    return args
+
+
+def run_assign(args: dict) -> dict:
+    """run_assign
+
+    Returns:
+        dict: the in memory results, from assign_abstracts.run_assignment
+    """
+    from assign_abstracts import run_assignment
+    from instrumentation import setup_logging
+
+    setup_logging(args['log_level'])
+    return run_assignment(args)
+
+
+def run_render(args: dict):
+    """run_render
+
+    Returns:
+        pd.DataFrame: the pages of each abstract, from render_abstracts.run_rendering
+    """
+    from instrumentation import setup_logging
+    from render_abstracts import run_rendering
+
+    setup_logging(args['log_level'])
+    return run_rendering(args)
+
+
+def run_split(args: dict) -> tuple:
+    """run_split
+
+    Returns:
+        tuple: the page index and page hashes, from preprocess_abs.split_abstracts
+    """
+    from preprocess_abs import split_abstracts
+
+    return split_abstracts(args)
+
+
+def run_bundle(args: dict) -> dict:
+    """run_bundle
+
+    Returns:
+        dict: the bundle manifest, from preprocess_abs.bundle_judge_abstracts
+    """
+    from preprocess_abs import bundle_judge_abstracts, split_abstracts
+
+    page_index, page_hashes = split_abstracts(args)
+    return bundle_judge_abstracts(args, page_index, page_hashes)
+
+
+def run_email(args: dict) -> dict:
+    """run_email
+
+    Returns:
+        dict: the result of each message, from dispatch_emails.run_dispatch
+    """
+    from dispatch_emails import run_dispatch
+    from instrumentation import setup_logging
+
+    setup_logging(args['log_level'])
+    return run_dispatch(args)
+
+
+def run_score(args: dict) -> tuple:
+    """run_score
+
+    Returns:
+        tuple: the abstract rankings and judge effects, from process_scores.run_scoring
+    """
+    from instrumentation import setup_logging
+    from process_scores import run_scoring
+
+    setup_logging(args['log_level'])
+    return run_scoring(args)
+
+
+def run_all(args: dict) -> dict:
+    """run_all
+
+    Assign, bundle and (optionally) score, handing the results of each step to the next one in
+    memory.
+
+    Returns:
+        dict: the results of the assignment, from assign_abstracts.run_assignment, with the
+              bundle manifest under 'manifest' and the rankings under 'rankings' if they were
+              computed
+    """
+    from assign_abstracts import build_assignment_table
+    from preprocess_abs import bundle_judge_abstracts, bundles_from_assignments, split_abstracts
+
+    state = run_assign(args)
+    if state['quality_check'] is None or not state['quality_check']['passed']:
+        print('--- the assignments did not pass the quality check, so the abstracts were not bundled')
+        return state
+
+    bundle_args = dict(args, outdir=args['bundle_outdir'])
+    page_index, page_hashes = split_abstracts(bundle_args, abstract_df=state['student_df'])
+    table = build_assignment_table(state['abstract_assignments'], state['judges_per_cat'])
+    state['manifest'] = bundle_judge_abstracts(
+        bundle_args, page_index, page_hashes, bundles=bundles_from_assignments(table, bundle_args['outdir']))
+
+    if args['scores']:
+        from process_scores import run_scoring
+        judge_categories = {name: cat for cat, judge_dict in state['abstract_assignments'].items() for name in judge_dict}
+        state['rankings'], _ = run_scoring(args, judge_categories=judge_categories)
+
+    return state
+
+
+def main():
+
+    args = parse_command_line()
+
+    handlers = {
+        'assign': run_assign,
+        'render': run_render,
+        'split': run_split,
+        'bundle': run_bundle,
+        'email': run_email,
+        'score': run_score,
+        'all': run_all,
+    }
+    handlers[args['command']](args)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""name_matching.py
+
+Fuzzy matching of judge names against the authors of each abstract, for conflict detection.
+
+Exact matching of name tokens misses a lot of real conflicts: "Bill Osler" vs "William Osler",
+"José Núñez" vs "Jose Nunez", "Ann Smith-Jones" vs "Ann Jones", or "Halsted" vs "Halstead".
+Degrees also get in the way, since "Jane Doe, MD, PhD" splits into three "authors" on commas.
+
+Names are normalized first: accents are stripped, everything is lower cased, hyphenated
+surnames are split into their parts, and common nicknames are mapped to the full first name.
+Degrees and suffixes are only dropped where they cannot be part of the name: as a chunk of their
+own after a comma ("Chris Ma, MA"), or after the surname ("Jane Doe MD"), and never if that would
+leave fewer than two words, since many of them are also surnames (Ma, Do, Pa). Each author is then
+filed under blocking keys for their surname: every surname token, and its Soundex code, which
+catches most spelling variants. A judge is only compared with the authors that share one of these
+keys, so the cost grows with the size of the blocks rather than with (judges x authors).
+
+Within a block, each (judge, author) pair gets a confidence in [0, 1], the product of
+
+    - surname: 1 if the surnames are the same, 0.9 if the author wrote one part of the judge's
+      hyphenated surname, or if they are one letter apart and long enough for that to be a typo,
+      otherwise 0, so that different surnames with a common prefix ("Martin" and "Martinez")
+      never match
+    - first name: the judge's first name is compared with the author's first given name: 1 if
+      they are the same after mapping nicknames, 0.85 if one is the initial of the other or a one
+      letter typo of a long name, otherwise 0. A first name spelled out as a later given name
+      also counts as the same ("Michael Smith" and "J. Michael Smith"), but a middle initial
+      does not ("Aisha Perez" and "Jessica A Perez")
+
+and pairs at or above CONFLICT_THRESHOLD are reported as conflicts. A surname that only matches
+approximately also needs the same first name, so that two similar names (e.g. "Mary Smith" and
+"Marty Smyth") do not add up to a conflict. Surnames are compared first, and the first names are
+only compared for the surnames that are similar enough. Both comparisons are cached, since the
+same pairs of names come up over and over.
+"""
+import re
+import unicodedata
+from collections import defaultdict
+from functools import lru_cache
+from typing import List, Tuple
+
+CONFLICT_THRESHOLD = 0.85
+
+# shortest name that a single letter difference is read as a typo of, rather than another name
+MIN_TYPO_LENGTH = 6
+
+# degrees and suffixes that show up after the names in author lists. several of these are also
+# surnames, so they are only dropped after the surname or after a comma, see name_words
+DEGREE_TOKENS = {
+    'md', 'phd', 'mph', 'ms', 'msc', 'ma', 'ba', 'bs', 'bsc', 'mba', 'do', 'rn', 'np', 'pa', 'pac', 'pharmd',
+    'mbbs', 'mbchb', 'dds', 'dmd', 'dvm', 'jd', 'mpp', 'mhs', 'mshs', 'scd', 'drph', 'mdphd', 'facs', 'facp',
+    'frcpc', 'frcs', 'jr', 'sr', 'ii', 'iii', 'iv', 'et', 'al', 'and',
+}
+
+# titles that show up before the names
+TITLE_TOKENS = {'dr', 'prof', 'professor', 'mr', 'mrs', 'ms', 'miss'}
+
+NON_NAME_TOKENS = DEGREE_TOKENS | TITLE_TOKENS
+
+NICKNAMES = {
+    'abby': 'abigail', 'alex': 'alexander', 'andy': 'andrew', 'becky': 'rebecca',
+    'ben': 'benjamin', 'beth': 'elizabeth', 'bill': 'william', 'billy': 'william', 'bob': 'robert',
+    'bobby': 'robert', 'cathy': 'catherine', 'charlie': 'charles', 'chris': 'christopher',
+    'chuck': 'charles', 'dan': 'daniel', 'danny': 'daniel', 'dave': 'david', 'debbie': 'deborah',
+    'dick': 'richard', 'ed': 'edward', 'eddie': 'edward', 'greg': 'gregory', 'hank': 'henry',
+    'jack': 'john', 'jake': 'jacob', 'jeff': 'jeffrey', 'jen': 'jennifer', 'jenny': 'jennifer',
+    'jim': 'james', 'jimmy': 'james', 'joe': 'joseph', 'johnny': 'john', 'josh': 'joshua',
+    'kate': 'katherine', 'katie': 'katherine', 'kathy': 'katherine', 'ken': 'kenneth', 'larry': 'lawrence',
+    'liz': 'elizabeth', 'maggie': 'margaret', 'matt': 'matthew', 'meg': 'margaret', 'mike': 'michael',
+    'nate': 'nathan', 'nick': 'nicholas', 'pat': 'patricia', 'peggy': 'margaret', 'pete': 'peter',
+    'rich': 'richard', 'rick': 'richard', 'rob': 'robert', 'ron': 'ronald', 'sam': 'samuel',
+    'steve': 'stephen', 'sue': 'susan', 'ted': 'edward', 'tim': 'timothy', 'tom': 'thomas',
+    'tommy': 'thomas', 'tony': 'anthony', 'vicky': 'victoria', 'will': 'william', 'zach': 'zachary',
+}
+
+# letters that do not decompose into a letter and an accent
+TRANSLITERATIONS = str.maketrans({'ø': 'o', 'æ': 'ae', 'œ': 'oe', 'ß': 'ss', 'ł': 'l', 'đ': 'd', 'þ': 'th', 'ı': 'i'})
+
+SOUNDEX_CODES = {letter: str(code) for code, letters in enumerate(
+    ['aehiouwy', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r']) for letter in letters}
+
+
+def normalize_tokens(name: str) -> List[str]:
+    """normalize_tokens
+
+    Args:
+        name (str): a single person's name, or part of it, e.g. "José Núñez-Smith"
+
+    Returns:
+        List[str]: lower case name tokens without accents or punctuation,
+                   e.g. ['jose', 'nunez', 'smith']
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(ch for ch in name if not unicodedata.combining(ch)).lower().translate(TRANSLITERATIONS)
+    name = re.sub(r"[.']", '', name)
+    return [token for token in re.split(r'[^a-z]+', name) if token]
+
+
+def name_words(name: str) -> List[List[str]]:
+    """name_words
+
+    Split a name into its words, each as a list of normalized tokens (hyphenated words have
+    several), without the titles in front of it and the degrees after it. A title or degree is
+    only dropped while at least two words are left, so "Linh Do" keeps its surname while
+    "Jane Doe MD" loses the "MD".
+
+    Args:
+        name (str): a single person's name
+
+    Returns:
+        List[List[str]]: the tokens of each word
+    """
+    words = [tokens for tokens in map(normalize_tokens, name.split()) if tokens]
+    while len(words) > 2 and set(words[0]) <= TITLE_TOKENS:
+        words = words[1:]
+    while len(words) > 2 and set(words[-1]) <= DEGREE_TOKENS:
+        words = words[:-1]
+
+    return words
+
+
+def parse_name(name: str) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """parse_name
+
+    Split a name in "first [middle] last" order into its given names and surname. The surname
+    is the last word of the name, which is split into parts if it is hyphenated.
+
+    Args:
+        name (str): a single person's name
+
+    Returns:
+        Tuple[Tuple[str, ...], Tuple[str, ...]]: the given names (first and middle names or
+                                                 initials) with nicknames mapped to the full
+                                                 name, () if there is only a surname, and the
+                                                 surname parts
+    """
+    words = name_words(name)
+    if not words:
+        return (), ()
+
+    given = tuple(NICKNAMES.get(token, token) for word in words[:-1] for token in word)
+
+    return given, tuple(words[-1])
+
+
+def split_authors(authors: str) -> List[str]:
+    """split_authors
+
+    Split an authors list into one string per author. Authors are separated by commas,
+    semicolons, '&' or ' and ', and chunks that are only degrees (e.g. the "MD" and "PhD"
+    in "Jane Doe, MD, PhD") are dropped.
+
+    Args:
+        authors (str): the authors list of an abstract
+
+    Returns:
+        List[str]: the authors
+    """
+    chunks = re.split(r'[,;&]|\band\b', authors)
+    return [chunk.strip() for chunk in chunks
+            if normalize_tokens(chunk) and not set(normalize_tokens(chunk)) <= NON_NAME_TOKENS]
+
+
+def soundex(token: str) -> str:
+    """soundex
+
+    Args:
+        token (str): a lower case name token
+
+    Returns:
+        str: the Soundex code of the token, e.g. 'h423' for both 'halsted' and 'halstead'
+    """
+    codes = [SOUNDEX_CODES.get(letter, '') for letter in token]
+    encoded = []
+    for i, code in enumerate(codes[1:], 1):
+        # h and w do not separate letters with the same code, vowels do
+        if code and code != '0' and code != codes[i - 1] and not (
+                i > 1 and token[i - 1] in 'hw' and code == codes[i - 2]):
+            encoded.append(code)
+    return (token[:1] + ''.join(encoded) + '000')[:4]
+
+
+def blocking_keys(surname: Tuple[str, ...]) -> List[tuple]:
+    """blocking_keys
+
+    Args:
+        surname (Tuple[str, ...]): surname parts from parse_name
+
+    Returns:
+        List[tuple]: the keys of the blocks the name is filed under
+    """
+    return [('surname', part) for part in surname] + [('soundex', soundex(part)) for part in surname]
+
+
+def build_author_index(authors_lists: List[str]) -> dict:
+    """build_author_index
+
+    Parse every author of every abstract once, and file them under their blocking keys.
+    The same person usually shows up on several abstracts and many people share a surname, so
+    each distinct surname is filed (and later compared) once, and each distinct set of given
+    names with that surname once.
+
+    Args:
+        authors_lists (List[str]): the authors list of each abstract
+
+    Returns:
+        dict: with the keys
+            - surnames: mapping of [surname parts] -> [given names] -> [list of (abstract position,
+                        author as written)]
+            - blocks: mapping of [blocking key] -> [list of surname parts]
+    """
+    surnames = defaultdict(lambda: defaultdict(list))
+    blocks = defaultdict(list)
+    for pos, authors_list in enumerate(authors_lists):
+        for author in split_authors(authors_list):
+            given, surname = parse_name(author)
+            if not surname:
+                continue
+            if surname not in surnames:
+                for key in set(blocking_keys(surname)):
+                    blocks[key].append(surname)
+            surnames[surname][given].append((pos, author))
+
+    return {'surnames': surnames, 'blocks': dict(blocks)}
+
+
+@lru_cache(maxsize=2**16)
+def surname_similarity(surname: Tuple[str, ...], other_surname: Tuple[str, ...]) -> float:
+    """surname_similarity
+
+    Args:
+        surname (Tuple[str, ...]): the judge's surname parts
+        other_surname (Tuple[str, ...]): an author's surname parts
+
+    Returns:
+        float: 1 if the surnames are the same, 0.9 if the judge has a hyphenated surname and the
+               author wrote one of its parts ("Smith-Jones" vs "Jones"), 0.9 if a part of each is
+               at least MIN_TYPO_LENGTH letters long and they are one letter apart ("Halsted" vs
+               "Halstead"), otherwise 0. Surnames that only share a prefix ("Martin" vs
+               "Martinez", "Kim" vs "Kimm") or where the author has the longer hyphenated
+               surname ("Smith" vs "Smith-Wilson") are different people
+    """
+    if surname == other_surname:
+        return 1.0
+    if len(surname) > 1 and set(other_surname) <= set(surname):
+        return 0.9
+    if any(a != b and min(len(a), len(b)) >= MIN_TYPO_LENGTH and is_one_edit_apart(a, b)
+           for a in surname for b in other_surname):
+        return 0.9
+    return 0.0
+
+
+@lru_cache(maxsize=2**16)
+def first_name_similarity(first: str, other_first: str) -> float:
+    """first_name_similarity
+
+    Returns:
+        float: 1 if the first names are the same (after mapping nicknames), 0.85 if one is the
+               initial of the other, or if both have at least MIN_TYPO_LENGTH letters and are one letter apart
+               (a typo), 0.5 if either is missing, otherwise 0
+    """
+    if not first or not other_first:
+        return 0.5
+    if first == other_first:
+        return 1.0
+    if (len(first) == 1 or len(other_first) == 1) and first[0] == other_first[0]:
+        return 0.85
+    if min(len(first), len(other_first)) >= MIN_TYPO_LENGTH and is_one_edit_apart(first, other_first):
+        return 0.85
+    return 0.0
+
+
+def is_one_edit_apart(a: str, b: str) -> bool:
+    """is_one_edit_apart
+
+    Returns:
+        bool: True if a and b differ by a single inserted, deleted or substituted letter
+    """
+    if abs(len(a) - len(b)) > 1:
+        return False
+    prefix = 0
+    while prefix < min(len(a), len(b)) and a[prefix] == b[prefix]:
+        prefix += 1
+    return a[prefix + (len(a) >= len(b)):] == b[prefix + (len(b) >= len(a)):]
+
+
+def given_name_similarity(first: str, other_given: Tuple[str, ...]) -> float:
+    """given_name_similarity
+
+    Args:
+        first (str): the judge's first name, '' if unknown
+        other_given (Tuple[str, ...]): an author's given names, from parse_name
+
+    Returns:
+        float: first_name_similarity of first with the author's first given name, or 1 if first
+               is spelled out as one of the later ones ("Michael" in "J. Michael Smith"). later
+               given names are usually middle initials, which say little about who it is
+    """
+    if not first or not other_given:
+        return 0.5
+    if len(first) > 1 and first in other_given[1:]:
+        return 1.0
+    return first_name_similarity(first, other_given[0])
+
+
+def match_name(author_index: dict, name: str, threshold: float = CONFLICT_THRESHOLD) -> Tuple[List[tuple], int]:
+    """match_name
+
+    Find the authors in author_index that are likely to be the same person as name. The
+    confidence of a match is the product of surname_similarity and given_name_similarity, and
+    a surname that is not an exact match also needs the exact first name.
+
+    Args:
+        author_index (dict): from build_author_index
+        name (str): judge name in "first last" format
+        threshold (float): minimum confidence for a match
+
+    Returns:
+        Tuple[List[tuple], int]: (abstract position, author, confidence) for the best match in
+                                 each abstract with a match, and the number of distinct author
+                                 names compared
+    """
+    given, surname = parse_name(name)
+    if not surname:
+        return [], 0
+    first = given[0] if given else ''
+
+    candidates = set()
+    for key in blocking_keys(surname):
+        candidates.update(author_index['blocks'].get(key, ()))
+
+    best = {}
+    compared = 0
+    for other_surname in candidates:
+        surname_score = surname_similarity(surname, other_surname)
+        # the first name can only lower the confidence
+        if surname_score < threshold:
+            continue
+        for other_given, occurrences in author_index['surnames'][other_surname].items():
+            compared += 1
+            given_score = given_name_similarity(first, other_given)
+            if surname_score < 1 and given_score < 1:
+                continue
+            confidence = surname_score * given_score
+            if confidence < threshold:
+                continue
+            for pos, author in occurrences:
+                if confidence > best.get(pos, (None, 0))[1]:
+                    best[pos] = (author, confidence)
+
+    return [(pos, author, round(confidence, 3)) for pos, (author, confidence) in sorted(best.items())], compared
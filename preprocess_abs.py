@@ -11,123 +11,719 @@ Once the abstracts are as individual pdfs, we read the excel file containing the
 abstracts to judges and combine all of each judge's abstracts into a single file,
 with filename based on the judge name for easy attachment :).
 
+With --in_memory, the big pdf is only read from disk once. Each judge's bundle is written
+straight from the pages of the big pdf, and the individual pdfs are only written if
+--write_intermediates is also provided.
+
+With --compact, identical objects in a bundle (mostly the fonts that every page of the mail
+merge pdf carries its own copy of, once the pages have been split into intermediates) are only
+written once, and uncompressed streams are compressed. The size of each bundle before and after
+is printed, and recorded in the manifest. Bundles built with --in_memory already share the
+objects of the big pdf, so --compact does not make them any smaller.
+
 """
+import hashlib
+import io
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pprint
+from typing import Dict, List
 from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.pdf import PageObject
+from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject,
+                            NullObject)
 import pandas as pd
 import argparse
 
+from assignment_store import judge_abstracts, read_assignments
+from excel_cache import clear_excel_cache, read_excel_cached
+
+
+# name of the file in the output directory that records the inputs of each bundle
+MANIFEST_NAME = 'bundle_manifest.json'
+
+# name of the file in the intermediates directory that records the page hash of each intermediate
+INTERMEDIATES_MANIFEST_NAME = 'intermediates_manifest.json'
+
+# state for the process that writes the judge bundles, see init_bundle_worker
+_bundle_worker = {}
+
+# page attributes that a page can inherit from the nodes above it in the page tree
+INHERITABLE_PAGE_ATTRIBUTES = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+
+def add_arguments(parser: argparse.ArgumentParser, chained: bool = False) -> argparse.ArgumentParser:
+    """add_arguments
+
+    Add the command line options for splitting and bundling the abstracts to parser, so that
+    they can be shared by this script and the msrs split, bundle and all subcommands.
+
+    Args:
+        parser (argparse.ArgumentParser): parser to add the options to
+        chained (bool): for msrs all, where the abstract ids and the assignments are passed on in
+                        memory, so the submissions and judging files are not needed, and the output
+                        directory is --bundle_outdir, since --outdir belongs to the assignment
+    """
+    parser.add_argument('--abstract_pdf', type=str, action='store', required=True,
+                        help='pdf of all of the anonymized abstracts, formatted as one per page, in same order as abs id list')
+    if not chained:
+        parser.add_argument('--submissions', type=str, action='store',
+                            help='excel file the abstracts and all student information. Used to get the list of abstract ids, unless --page_ranges is provided')
+        parser.add_argument('--judging', type=str, action='store',
+                            help='assignments.npz or unified.csv written by assign_abstracts.py, with the ids of the abstracts assigned to each judge')
+        parser.add_argument('--bundle_abstracts', action='store_true',
+                            help='if provided, bundle the abstracts for each judge into a single file for easier mailmerge')
+        parser.add_argument('--no_cache', action='store_true',
+                            help='always parse the submissions excel file, instead of loading it from the cache')
+        parser.add_argument('--clear_cache', action='store_true',
+                            help='remove the cached copies of the submissions excel file before reading it')
+    parser.add_argument('--page_ranges', type=str, action='store',
+                        help='abstract_pages.csv from render_abstracts.py, with the pages of each abstract. otherwise each abstract is assumed to be 1 page, in the same order as the abs id list')
+    parser.add_argument('--in_memory', action='store_true',
+                        help='if provided, build the bundles directly from the abstract pdf instead of from the individual abstract pdfs')
+    parser.add_argument('--write_intermediates', action='store_true',
+                        help='with --in_memory, also write out the individual abstract pdfs')
+    parser.add_argument('--jobs', type=int, action='store', default=1,
+                        help='number of processes used to write the judge bundles')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild every bundle and intermediate, even if its abstracts have not changed since the last run')
+    parser.add_argument('--compact', action='store_true',
+                        help='write each shared font and resource once per bundle and compress uncompressed streams. worth it when bundling from the individual abstract pdfs (about 12-19%% smaller attachments), not with --in_memory, where the pages already share them')
+    if chained:
+        parser.add_argument('--bundle_outdir', type=str, action='store', required=True,
+                            help='directory where each of the abstract bundles should be generated to')
+    else:
+        parser.add_argument('--outdir', type=str, action='store',
+                            help='directory where each of the abstract bundles should be generated to')
+
+    return parser
+
 
 def parse_command_line() -> dict:
 
     parser = argparse.ArgumentParser(
         description='prepare abstracts for mail merging to judges')
 
-    parser.add_argument('--abstract_pdf', type=str, action='store', required=True,
-                        help='pdf of all of the anonymized abstracts, formatted as one per page, in same order as abs id list')
-    parser.add_argument('--submissions', type=str, action='store', required=True,
-                        help='excel file the abstracts and all student information. Used to get the list of abstract ids')
-    parser.add_argument('--judging', type=str, action='store', required=True,
-                        help='excel file containing the ids of abstracts assigned to each judge')
-    parser.add_argument('--bundle_abstracts', action='store_true',
-                        help='if provided, bundle the abstracts for each judge into a single file for easier mailmerge')
-    parser.add_argument('--outdir', type=str, action='store',
-                        help='directory where each of the abstract bundles should be generated to')
-
-    args = vars(parser.parse_args())
+    args = vars(add_arguments(parser).parse_args())
+    if args['bundle_abstracts'] and not args['judging']:
+        parser.error('--bundle_abstracts requires --judging')
+    if not args['submissions'] and not args['page_ranges']:
+        parser.error('one of --submissions or --page_ranges is required')
     print('--- received the following commandline arguments')
     pprint(args)
     return args
 
 
-def main():
+def build_page_index(num_pages: int, ids: list) -> Dict[int, List[int]]:
+    """build_page_index
 
-    args = parse_command_line()
-    # pdf_path = "/Users/alex/Desktop/HOPKINS/MSRS/mailmerge_abstract_judging_merged.pdf"
-    pdf_reader = PdfFileReader(args['abstract_pdf'])
+    Map each abstract id to the pages of the big pdf that contain it. Each abstract is assumed
+    to be 1 page, in the same order as the list of abstract ids.
 
-    abstract_df = pd.read_excel(
-        args['submissions'], sheet_name='remove repeats')
-    ids = list(abstract_df['ids'])
+    Args:
+        num_pages (int): number of pages in the big pdf
+        ids (list): abstract ids, in the same order as the pages
 
-    # create the file for the outputs if it does not exist
-    if not os.path.exists(args['outdir']):
-        print('creating output directory at %s' % args['outdir'])
-        os.makedirs(args['outdir'])
+    Returns:
+        Dict[int, List[int]]: mapping of [abstract id] -> [list of page indices]
+    """
+    if num_pages != len(ids):
+        print('WARNING: the abstract pdf has %d pages, but there are %d abstract ids' % (num_pages, len(ids)))
+
+    # this was to account for Natalie Marrero's long ass 2-page abstract from 2021.
+    # comment it out under assumption that each abstract is 1 page
+    # abs_id = ids[page_idx] if page_idx == 0 else ids[page_idx-1]
+    return {int(abs_id): [page_idx] for page_idx, abs_id in zip(range(num_pages), ids)}
+
+
+def read_page_ranges(page_ranges_file: str, num_pages: int) -> Dict[int, List[int]]:
+    """read_page_ranges
+
+    Read the pages of each abstract from the abstract_pages.csv written by render_abstracts.py,
+    instead of assuming that each abstract is 1 page.
+
+    Args:
+        page_ranges_file (str): csv with the columns 'ids', 'first page' and 'last page', with
+                                pages numbered from 1
+        num_pages (int): number of pages in the big pdf
+
+    Returns:
+        Dict[int, List[int]]: mapping of [abstract id] -> [list of page indices]
+    """
+    page_ranges = pd.read_csv(page_ranges_file)
+    if len(page_ranges) and page_ranges['last page'].max() > num_pages:
+        print('WARNING: %s goes up to page %d, but the abstract pdf only has %d pages' % (
+            page_ranges_file, page_ranges['last page'].max(), num_pages))
+
+    return {int(abs_id): list(range(first - 1, min(last, num_pages)))
+            for abs_id, first, last in zip(page_ranges['ids'], page_ranges['first page'], page_ranges['last page'])}
+
+
+def write_intermediates(pdf_reader: PdfFileReader, page_index: Dict[int, List[int]], outdir: str,
+                        page_hashes: Dict[int, str] = None, force: bool = False) -> None:
+    """write_intermediates
 
+    Write each abstract to its own pdf, intermediates/[abstract id].pdf. The page hash of each
+    intermediate is recorded in intermediates/intermediates_manifest.json, and intermediates
+    whose pages have not changed since the last run are not written again.
+
+    Args:
+        pdf_reader (PdfFileReader): reader for the big pdf
+        page_index (Dict[int, List[int]]): mapping of [abstract id] -> [list of page indices]
+        outdir (str): output directory, the intermediates are written to a subdirectory
+        page_hashes (Dict[int, str]): from hash_abstract_pages. if None, every intermediate is written
+        force (bool): write every intermediate, even if its pages have not changed
+    """
     # create the file for the intermediates
-    if not os.path.exists(os.path.join(args['outdir'], 'intermediates')):
-        os.makedirs(os.path.join(args['outdir'], 'intermediates'))
+    intermediates_dir = os.path.join(outdir, 'intermediates')
+    if not os.path.exists(intermediates_dir):
+        os.makedirs(intermediates_dir)
 
-    # separate the big pdf into individual pages
-    for page_idx, page in enumerate(pdf_reader.pages):
-        # this was to account for Natalie Marrero's long ass 2-page abstract from 2021.
-        # comment it out under assumption that each abstract is 1 page
-        # abs_id = ids[page_idx] if page_idx == 0 else ids[page_idx-1]
+    manifest_path = os.path.join(intermediates_dir, INTERMEDIATES_MANIFEST_NAME)
+    previous = {}
+    if page_hashes is not None and not force and os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            previous = json.load(f)
 
-        abs_id = ids[page_idx]
-        outfile = os.path.join(
-            args['outdir'], 'intermediates', "%d.pdf" % abs_id)
+    # separate the big pdf into individual pages
+    written = 0
+    for abs_id, page_indices in page_index.items():
+        outfile = os.path.join(intermediates_dir, "%d.pdf" % abs_id)
+        if page_hashes is not None and previous.get(str(abs_id)) == page_hashes[abs_id] and os.path.exists(outfile):
+            continue
 
         pdf_writer = PdfFileWriter()
-        pdf_writer.addPage(page)
+        for page_idx in page_indices:
+            pdf_writer.addPage(pdf_reader.getPage(page_idx))
 
         with open(outfile, "wb") as f:
             pdf_writer.write(f)
+        written += 1
 
-    # if we do not want to bundle the abstracts, exit here
-    if not args['bundle_abstracts']:
-        print('completing without bundling abstracts')
-        exit()
+    if page_hashes is not None:
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({str(abs_id): page_hashes[abs_id] for abs_id in page_index}, f, indent=2, sort_keys=True)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    print('--- wrote %d, skipped %d unchanged intermediate abstract pdfs' % (written, len(page_index) - written))
+
+    return
+
+
+def hash_abstract_pages(pdf_reader: PdfFileReader, page_index: Dict[int, List[int]]) -> Dict[int, str]:
+    """hash_abstract_pages
+
+    Hash the content of the pages of each abstract, so that we can tell whether a bundle needs
+    to be rebuilt when the abstract pdf is regenerated.
+
+    Args:
+        pdf_reader (PdfFileReader): reader for the big pdf
+        page_index (Dict[int, List[int]]): mapping of [abstract id] -> [list of page indices]
+
+    Returns:
+        Dict[int, str]: mapping of [abstract id] -> [hash of the abstract's pages]
+    """
+    page_hashes = {}
+    for abs_id, page_indices in page_index.items():
+        sha = hashlib.sha256()
+        for page_idx in page_indices:
+            page = pdf_reader.getPage(page_idx)
+            contents = page.getContents()
+            sha.update(repr(list(page.mediaBox)).encode())
+            if contents is not None:
+                sha.update(contents.getData())
+        page_hashes[abs_id] = sha.hexdigest()
+
+    return page_hashes
+
+
+def load_manifest(outdir: str) -> dict:
+    """load_manifest
+
+    Load the manifest of the bundles written on the previous run, if there is one. The manifest
+    maps [bundle file name] -> {'abstract_ids': [...], 'source_hash': hash of the abstract pages}
+
+    Args:
+        outdir (str): directory the bundles are written to
+
+    Returns:
+        dict: the manifest, empty if there was no previous run
+    """
+    manifest_path = os.path.join(outdir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(outdir: str, manifest: dict) -> None:
+    """write_manifest
+
+    Args:
+        outdir (str): directory the bundles are written to
+        manifest (dict): mapping of [bundle file name] -> {'abstract_ids': [...], 'source_hash': ...}
+    """
+    manifest_path = os.path.join(outdir, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return
+
+
+def bundle_source_hash(abs_ids: List[int], page_hashes: Dict[int, str]) -> str:
+    """bundle_source_hash
+
+    Hash of everything that goes into a bundle: the ordered abstract ids and their pages.
+
+    Args:
+        abs_ids (List[int]): abstract ids in the bundle, in order
+        page_hashes (Dict[int, str]): mapping of [abstract id] -> [hash of the abstract's pages]
+
+    Returns:
+        str: hash of the bundle inputs
+    """
+    sha = hashlib.sha256()
+    for abs_id in abs_ids:
+        sha.update(('%d:%s;' % (abs_id, page_hashes.get(abs_id, 'missing'))).encode())
+
+    return sha.hexdigest()
+
+
+def read_judge_bundles(judging: str, outdir: str) -> List[tuple]:
+    """read_judge_bundles
+
+    Read the abstracts assigned to each judge, from assignments.npz or unified.csv, and work out
+    which bundle needs to be written for each judge.
 
-    if '.xls' in args['judging']:
-        assignments_df = pd.read_excel(args['judging'])
+    Args:
+        judging (str): file with the abstract assignments, see assignment_store.read_assignments
+        outdir (str): directory where the bundles will be written
+
+    Returns:
+        List[tuple]: (path of the bundle, list of abstract ids) for each judge
+    """
+    store = read_assignments(judging)
+
+    bundles = []
+    for judge_idx, (first, last) in enumerate(zip(store['judge_first'], store['judge_last'])):
+        judge_path = os.path.join(outdir, "MSRS_abstracts_Dr_%s_%s.pdf" % (first, last))
+        abs_ids = judge_abstracts(store, judge_idx).tolist()
+
+        print(store['judge_email'][judge_idx], first, last, abs_ids)
+        bundles.append((judge_path, abs_ids))
+
+    return bundles
+
+
+def bundles_from_assignments(table: dict, outdir: str) -> List[tuple]:
+    """bundles_from_assignments
+
+    Same as read_judge_bundles, but from the assignments in memory instead of from unified.csv.
+
+    Args:
+        table (dict): the assignment table, from assign_abstracts.build_assignment_table
+        outdir (str): directory where the bundles will be written
+
+    Returns:
+        List[tuple]: (path of the bundle, list of abstract ids) for each judge
+    """
+    return [(os.path.join(outdir, "MSRS_abstracts_Dr_%s_%s.pdf" % (first, last)), abstracts[:load].tolist())
+            for first, last, load, abstracts in zip(table['first'], table['last'], table['load'], table['abstracts'])]
+
+
+def page_references(pdf_reader: PdfFileReader) -> List[tuple]:
+    """page_references
+
+    Walk the page tree of a pdf and record where each page lives, so that a single page can be
+    loaded from a fresh reader without parsing every page in the document.
+
+    Args:
+        pdf_reader (PdfFileReader): reader for the big pdf
+
+    Returns:
+        List[tuple]: for each page, in order, ((idnum, generation) of the page,
+                     {attribute: (idnum, generation) of the page tree node it is inherited from})
+    """
+    refs = []
+
+    def walk(node_ref, inherited):
+        node = pdf_reader.getObject(node_ref)
+        if node.get('/Type') == '/Pages':
+            inherited = dict(inherited)
+            for key in INHERITABLE_PAGE_ATTRIBUTES:
+                if key in node:
+                    inherited[key] = (node_ref.idnum, node_ref.generation)
+            for kid_ref in node['/Kids']:
+                walk(kid_ref, inherited)
+        else:
+            refs.append(((node_ref.idnum, node_ref.generation),
+                         {key: ref for key, ref in inherited.items() if key not in node}))
+
+    walk(pdf_reader.trailer['/Root'].raw_get('/Pages'), {})
+    return refs
+
+
+def load_page(pdf_reader: PdfFileReader, page_ref: tuple):
+    """load_page
+
+    Load a single page using its entry from page_references.
+
+    Args:
+        pdf_reader (PdfFileReader): reader for the big pdf
+        page_ref (tuple): entry of page_references for the page
+
+    Returns:
+        DictionaryObject: the page, with any inherited attributes filled in
+    """
+    (idnum, generation), inherited = page_ref
+    page = pdf_reader.getObject(IndirectObject(idnum, generation, pdf_reader))
+    for key, (node_idnum, node_generation) in inherited.items():
+        node = pdf_reader.getObject(IndirectObject(node_idnum, node_generation, pdf_reader))
+        page[NameObject(key)] = node.raw_get(key)
+
+    return page
+
+
+def _replace_references(data, remap: Dict[int, int], pdf_writer: PdfFileWriter):
+    """_replace_references
+
+    Point every reference to an object in remap at the object that it was merged into.
+    """
+    if isinstance(data, IndirectObject):
+        return IndirectObject(remap[data.idnum], 0, pdf_writer) if data.idnum in remap else data
+    if isinstance(data, DictionaryObject):
+        for key, value in list(data.items()):
+            data[key] = _replace_references(value, remap, pdf_writer)
+    elif isinstance(data, ArrayObject):
+        for i, value in enumerate(data):
+            data[i] = _replace_references(value, remap, pdf_writer)
+
+    return data
+
+
+def _copy_referenced_objects(pdf_writer: PdfFileWriter) -> None:
+    """_copy_referenced_objects
+
+    Copy every object that the pages of a writer reference from their readers into the writer,
+    which PdfFileWriter.write otherwise only does while it writes. This is the first half of
+    PdfFileWriter.write from PyPDF2 1.28, and uses its private attributes, so check it against
+    write when upgrading PyPDF2.
+    """
+    if not pdf_writer._root:
+        pdf_writer._root = pdf_writer._add_object(pdf_writer._root_object)
+
+    # pages that refer back to themselves (e.g. from their annotations) should point at the
+    # copy of the page in the writer, instead of pulling in another copy of the page
+    external_reference_map = {}
+    for i, obj in enumerate(pdf_writer._objects):
+        if isinstance(obj, PageObject) and obj.indirectRef is not None:
+            ref = obj.indirectRef
+            external_reference_map.setdefault(ref.pdf, {}).setdefault(ref.generation, {})[ref.idnum] = \
+                IndirectObject(i + 1, 0, pdf_writer)
+
+    pdf_writer.stack = []
+    pdf_writer._sweep_indirect_references(external_reference_map, pdf_writer._root)
+    del pdf_writer.stack
+
+    return
+
+
+def compact_bundle(pdf_writer: PdfFileWriter) -> int:
+    """compact_bundle
+
+    Merge identical objects and compress uncompressed streams in the writer of a bundle, before
+    it is written.
+
+    Pages copied from different readers (e.g. one intermediate per abstract) each bring their own
+    copy of the fonts, which PdfFileWriter writes out once per page. Objects are compared by their
+    serialized bytes, with references written as object numbers, so merging e.g. the font files
+    makes the font descriptors that point at them identical as well. This is repeated until
+    nothing else can be merged. Page objects are never merged, even if the same abstract shows
+    up twice. The streams that are left are then compressed.
+
+    The objects are reached through the private PdfFileWriter._objects, which PyPDF2 1.28 does not
+    have a public API for, see _copy_referenced_objects.
+
+    Args:
+        pdf_writer (PdfFileWriter): writer for the bundle
+
+    Returns:
+        int: size in bytes that the bundle would have had without compacting, from the objects
+             serialized by the first round of merging, so the bundle is not written twice
+    """
+    _copy_referenced_objects(pdf_writer)
+    objects = pdf_writer._objects
+
+    size_before = None
+    while True:
+        canonical = {}
+        remap = {}
+        # the xref table has 20 bytes per object, plus the free entry
+        serialized_size = 20
+        for i, obj in enumerate(objects):
+            if obj is None:
+                continue
+            serialized = io.BytesIO()
+            obj.writeToStream(serialized, None)
+            serialized_size += len(serialized.getvalue()) + len(b'%d 0 obj\n\nendobj\n' % (i + 1)) + 20
+            if isinstance(obj, NullObject) or (
+                    isinstance(obj, DictionaryObject) and obj.get('/Type') in ('/Page', '/Pages', '/Catalog')):
+                continue
+            key = hashlib.sha256(serialized.getvalue()).digest()
+            if key in canonical:
+                remap[i + 1] = canonical[key]
+            else:
+                canonical[key] = i + 1
+        if size_before is None:
+            # plus the header, and the trailer that points at the xref table
+            trailer = io.BytesIO()
+            pdf_writer._write_trailer(trailer)
+            size_before = (serialized_size + len(pdf_writer._header) + len(b'\n%\xe2\xe3\xcf\xd3\n')
+                           + len(b'xref\n0 %d\n' % (len(objects) + 1)) + trailer.tell()
+                           + len(b'\nstartxref\n%d\n%%%%EOF\n' % serialized_size))
+
+        if not remap:
+            break
+
+        # merged objects are left as nulls, so that the other object numbers do not change
+        for idnum in remap:
+            objects[idnum - 1] = NullObject()
+        for obj in objects:
+            _replace_references(obj, remap, pdf_writer)
+
+    # compressing after merging means that each shared stream is only compressed once
+    for i, obj in enumerate(objects):
+        if isinstance(obj, DecodedStreamObject) and '/Filter' not in obj:
+            # very short streams can come out larger
+            encoded = obj.flateEncode()
+            if len(encoded._data) < len(obj.getData()):
+                objects[i] = encoded
+
+    return size_before
+
+
+def init_bundle_worker(abstract_pdf: str, page_index: Dict[int, List[int]], outdir: str, in_memory: bool,
+                       compact: bool = False) -> None:
+    """init_bundle_worker
+
+    Set up a process for writing judge bundles. With in_memory, each process reads the abstract
+    pdf into memory once and holds its own read-only copy, since readers cannot be shared
+    between processes.
+
+    Args:
+        abstract_pdf (str): pdf of all of the anonymized abstracts
+        page_index (Dict[int, List[int]]): mapping of [abstract id] -> [list of page indices]
+        outdir (str): output directory, which holds the intermediates
+        in_memory (bool): whether to read pages from the abstract pdf instead of the intermediates
+        compact (bool): whether to write the bundles with compact_bundle
+    """
+    if in_memory:
+        with open(abstract_pdf, 'rb') as f:
+            _bundle_worker['pdf_bytes'] = f.read()
+        _bundle_worker['page_refs'] = page_references(PdfFileReader(io.BytesIO(_bundle_worker['pdf_bytes'])))
     else:
-        assignments_df = pd.read_csv(args['judging'], )
+        _bundle_worker['pdf_bytes'] = None
+    _bundle_worker['page_index'] = page_index
+    _bundle_worker['outdir'] = outdir
+    _bundle_worker['compact'] = compact
 
-    # cols = ["Email Address", "First Name", "Last Name", "Abs1", "Abs2",
-    #         "Abs3", "Abs4", "Abs5", "Abs6", "Abs7", "Abs8", "Abs9", "Abs10", "Abs"]
-    # print(assignments_df.head())
-    # for idx, (cat, *merge_info) in assignments_df.iterrows():
-    with open(args['judging'], 'r') as f:
-        # skip the first line bc its a header lol
-        _ = f.readline()
-        line = f.readline()
+    return
 
-        while line:
-            cat, *merge_info = line.strip().split(',')
 
-            judge_path = os.path.join(args['outdir'], "MSRS_abstracts_Dr_%s_%s.pdf" % (
-                merge_info[1], merge_info[2]))
+def write_judge_bundle(bundle: tuple) -> tuple:
+    """write_judge_bundle
 
-            # os.makedirs(judge_directory, exist_ok=True)
+    Combine the abstracts assigned to a judge into a single pdf. Errors are caught and
+    returned instead of raised, so that one bad bundle does not stop the others.
 
-            abs_ids = merge_info[3:]
+    Args:
+        bundle (tuple): (path of the bundle, list of abstract ids)
 
-            print(merge_info)
-            pdf_writer = PdfFileWriter()
+    Returns:
+        tuple: (path of the bundle, None if it was written, or a description of the error,
+                (size before, size after) in bytes if the bundle was compacted, otherwise None)
+    """
+    judge_path, abs_ids = bundle
 
-            # conmbine the individual pdfs together
-            for abs_id in abs_ids:
-                if pd.isnull(abs_id):
-                    continue
+    try:
+        # PdfFileWriter rewrites the references inside of the pages that it copies, so pages are
+        # not reused across bundles. instead, each bundle gets a fresh reader over the bytes of the
+        # abstract pdf, and loads its pages by reference, so that only the objects that the bundle
+        # actually needs are parsed.
+        pdf_reader = None
+        if _bundle_worker['pdf_bytes'] is not None:
+            pdf_reader = PdfFileReader(io.BytesIO(_bundle_worker['pdf_bytes']))
 
-                pdf_reader = PdfFileReader(os.path.join(
-                    args['outdir'], 'intermediates', str(int(abs_id)) + ".pdf"))
-                for page in pdf_reader.pages:
-                    pdf_writer.addPage(page)
+        pdf_writer = PdfFileWriter()
+
+        # conmbine the individual pdfs together
+        for abs_id in abs_ids:
+            if pdf_reader is not None:
+                # the pages come straight from the big pdf, so no intermediates are read
+                for page_idx in _bundle_worker['page_index'][abs_id]:
+                    pdf_writer.addPage(load_page(pdf_reader, _bundle_worker['page_refs'][page_idx]))
+                continue
+
+            abstract_reader = PdfFileReader(os.path.join(
+                _bundle_worker['outdir'], 'intermediates', str(abs_id) + ".pdf"))
+            for page in abstract_reader.pages:
+                pdf_writer.addPage(page)
+
+        sizes = None
+        size_before = compact_bundle(pdf_writer) if _bundle_worker['compact'] else None
+
+        with open(judge_path, "wb") as out_fp:
+            pdf_writer.write(out_fp)
+            if size_before is not None:
+                sizes = (size_before, out_fp.tell())
+
+    except Exception as e:
+        return judge_path, repr(e), None
+
+    return judge_path, None, sizes
+
+
+def split_abstracts(args: dict, abstract_df: pd.DataFrame = None) -> tuple:
+    """split_abstracts
+
+    Read the big pdf, work out which pages belong to each abstract, and write the individual
+    abstract pdfs unless the bundles are going to be built in memory. Only the abstracts whose
+    pages changed since the last run are written again, see write_intermediates.
+
+    Args:
+        args (dict): options from add_arguments
+        abstract_df (pd.DataFrame): abstract submissions with an 'ids' column, in the same order
+                                    as the pages. if None, read from the 'remove repeats' tab of
+                                    args['submissions']. not used with args['page_ranges']
+
+    Returns:
+        tuple: the page index, mapping of [abstract id] -> [list of page indices], and the hash
+               of each abstract's pages, from hash_abstract_pages
+    """
+    # pdf_path = "/Users/alex/Desktop/HOPKINS/MSRS/mailmerge_abstract_judging_merged.pdf"
+    pdf_reader = PdfFileReader(args['abstract_pdf'])
+
+    if args['page_ranges']:
+        page_index = read_page_ranges(args['page_ranges'], pdf_reader.getNumPages())
+    elif abstract_df is None:
+        if args['clear_cache']:
+            clear_excel_cache(args['submissions'])
+
+        abstract_df = read_excel_cached(
+            args['submissions'], sheet_name='remove repeats', use_cache=not args['no_cache'])
+
+    # create the file for the outputs if it does not exist
+    if not os.path.exists(args['outdir']):
+        print('creating output directory at %s' % args['outdir'])
+        os.makedirs(args['outdir'])
+
+    if not args['page_ranges']:
+        page_index = build_page_index(pdf_reader.getNumPages(), list(abstract_df['ids']))
+
+    # hash the source pages before anything is copied out of the big pdf
+    page_hashes = hash_abstract_pages(pdf_reader, page_index)
+
+    if not args['in_memory'] or args['write_intermediates']:
+        write_intermediates(pdf_reader, page_index, args['outdir'], page_hashes, force=args['force'])
+
+    return page_index, page_hashes
+
+
+def bundle_judge_abstracts(args: dict, page_index: Dict[int, List[int]], page_hashes: Dict[int, str],
+                           bundles: List[tuple] = None) -> dict:
+    """bundle_judge_abstracts
+
+    Write the bundle of abstracts for each judge, skipping the bundles that have not changed
+    since the last run.
+
+    Args:
+        args (dict): options from add_arguments
+        page_index (Dict[int, List[int]]): from split_abstracts
+        page_hashes (Dict[int, str]): from split_abstracts
+        bundles (List[tuple]): (path of the bundle, list of abstract ids) for each judge. if None,
+                               read from args['judging'] with read_judge_bundles
+
+    Returns:
+        dict: the manifest of the bundles that were written
+    """
+    if bundles is None:
+        bundles = read_judge_bundles(args['judging'], args['outdir'])
+
+    # only rebuild the bundles whose abstracts or abstract pages changed since the last run
+    previous_manifest = {} if args['force'] else load_manifest(args['outdir'])
+    manifest = {}
+    to_build = []
+    for judge_path, abs_ids in bundles:
+        entry = {'abstract_ids': abs_ids, 'source_hash': bundle_source_hash(abs_ids, page_hashes)}
+        if args['compact']:
+            entry['compact'] = True
+        bundle_name = os.path.basename(judge_path)
+        previous_entry = dict(previous_manifest.get(bundle_name, {}))
+        size_info = {key: previous_entry.pop(key) for key in ('size_before', 'size_after') if key in previous_entry}
+        if previous_entry == entry and os.path.exists(judge_path):
+            manifest[bundle_name] = dict(entry, **size_info)
+        else:
+            to_build.append((judge_path, abs_ids))
+            manifest[bundle_name] = entry
+
+    # remove the bundles of judges that no longer have any assignments
+    deleted = 0
+    for bundle_name in set(previous_manifest) - set(manifest):
+        stale_path = os.path.join(args['outdir'], bundle_name)
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+            deleted += 1
+
+    init_args = (args['abstract_pdf'], page_index, args['outdir'], args['in_memory'], args['compact'])
+    if args['jobs'] > 1:
+        # each worker holds its own read-only handle on the abstract pdf
+        with ProcessPoolExecutor(max_workers=args['jobs'], initializer=init_bundle_worker,
+                                 initargs=init_args) as executor:
+            results = list(executor.map(write_judge_bundle, to_build))
+    else:
+        init_bundle_worker(*init_args)
+        results = [write_judge_bundle(bundle) for bundle in to_build]
+
+    failed = [(judge_path, error) for judge_path, error, _ in results if error is not None]
+
+    # failed bundles are left out of the manifest so that they are retried on the next run
+    for judge_path, error in failed:
+        manifest.pop(os.path.basename(judge_path), None)
+
+    compacted = [(judge_path, sizes) for judge_path, error, sizes in results if sizes is not None]
+    for judge_path, (size_before, size_after) in compacted:
+        print('%s: %d -> %d bytes' % (os.path.basename(judge_path), size_before, size_after))
+        manifest[os.path.basename(judge_path)].update(size_before=size_before, size_after=size_after)
+    write_manifest(args['outdir'], manifest)
 
-                # individual_pdf_path = os.path.join(
-                #     args['outdir'], 'intermediates', str(int(abs_id)) + ".pdf")
+    print('--- rebuilt %d, skipped %d unchanged, deleted %d stale judge bundles' % (
+        len(results) - len(failed), len(bundles) - len(to_build), deleted))
+    if compacted:
+        total_before = sum(size_before for _, (size_before, _) in compacted)
+        total_after = sum(size_after for _, (_, size_after) in compacted)
+        print('--- compacted the rebuilt bundles from %.1f MB to %.1f MB (%.0f%% smaller)' % (
+            total_before / 1e6, total_after / 1e6, 100 * (1 - total_after / max(total_before, 1))))
+    if failed:
+        print('--- the following bundles failed:')
+        for judge_path, error in failed:
+            print('%s: %s' % (judge_path, error))
 
-                # shutil.copy(individual_pdf_path, os.path.join(
-                #     judge_directory, str(int(abs_id)) + ".pdf"))
+    return manifest
 
-            with open(judge_path, "wb") as out_fp:
-                pdf_writer.write(out_fp)
 
-            line = f.readline()
+def main():
+
+    args = parse_command_line()
+    page_index, page_hashes = split_abstracts(args)
+
+    # if we do not want to bundle the abstracts, exit here
+    if not args['bundle_abstracts']:
+        print('completing without bundling abstracts')
+        return
+
+    bundle_judge_abstracts(args, page_index, page_hashes)
 
     return
 
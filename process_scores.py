@@ -0,0 +1,360 @@
+"""process_scores.py
+
+Script for turning the scores entered by judges into normalized abstract rankings.
+
+Judges differ in how lenient they are and in how much of the scale they use, and each judge
+only sees a handful of abstracts, so raw averages mostly reflect who the judges were. The scores
+are modelled with a Gaussian mixed effects model:
+
+    score[judge, abstract] = abstract effect + judge leniency + noise
+
+    judge leniency ~ N(0, sigma_judge^2)
+    noise          ~ N(0, sigma_j^2), a separate scale for each judge j
+
+The abstract effects are fixed effects, and are the adjusted scores. The judge scales sigma_j
+are shrunk towards the pooled residual variance, so that a judge with only a few scores does not
+get an extreme weight. The variance components are estimated by iterating EM updates.
+
+All of the judges and abstracts are solved together, with sparse design matrices. The abstract
+effects are eliminated from the mixed model equations, which leaves a (judges x judges) system
+(the Schur complement). It is block diagonal, with a block for each group of judges that share
+abstracts (i.e. each category), so each iteration costs one small Cholesky factorization per
+category, and standard errors come from the same factorizations:
+
+    var(abstract effects) = diag(A^-1 + A^-1 B S^-1 B' A^-1)
+
+where A is the (diagonal) weighted count of scores for each abstract, B the weighted
+abstract x judge incidence matrix and S the Schur complement.
+
+Adjusted scores are converted to z-scores within each category, and abstracts are ranked
+within their category and overall.
+"""
+import argparse
+import logging
+import os
+from typing import Dict, Union
+
+import numpy as np
+import pandas as pd
+from scipy.linalg import cho_factor, cho_solve, lapack
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.csgraph import connected_components
+
+from assignment_store import abstract_judges, judge_names, read_assignments
+from excel_cache import read_excel_cached
+from instrumentation import LOG_LEVELS, setup_logging, stage
+
+log = logging.getLogger(__name__)
+
+
+def add_arguments(parser: argparse.ArgumentParser, chained: bool = False) -> argparse.ArgumentParser:
+    """add_arguments
+
+    Add the command line options of the scoring to parser, so that they can be shared by this
+    script and the msrs score and all subcommands.
+
+    Args:
+        parser (argparse.ArgumentParser): parser to add the options to
+        chained (bool): for msrs all, where the judge categories come from the assignments in
+                        memory and the rankings are written to the output directory of the
+                        assignment, so only --scores (optional) and --max_iter are added
+    """
+    if not chained:
+        parser.add_argument('--assignments', action="store", type=str, required=True,
+                            help='assignments.npz or unified.csv written by assign_abstracts.py, used to get the category of each judge'
+                            )
+    parser.add_argument('--scores', action="store", type=str, required=not chained,
+                        help='csv or excel file with one row per score, with the columns judge (first and last name), abstract id and score'
+                        )
+    if not chained:
+        parser.add_argument('--outdir', action="store", type=str, required=True,
+                            help='directory in which abstract_rankings.csv and judge_effects.csv should be written'
+                            )
+    parser.add_argument('--max_iter', action="store", type=int, default=100,
+                        help='maximum number of EM iterations for the variance components'
+                        )
+    if not chained:
+        parser.add_argument('--log_level', '--log-level', action="store", type=str, default='INFO', choices=LOG_LEVELS,
+                            help='only log messages at or above this level'
+                            )
+
+    return parser
+
+
+def parse_command_line():
+
+    parser = argparse.ArgumentParser(
+        description='normalize judge scores with a gaussian mixed effects model and rank the abstracts')
+
+    args = vars(add_arguments(parser).parse_args())
+
+    setup_logging(args['log_level'])
+    log.debug('%s', args)
+    return args
+
+
+def read_judge_categories(store: dict) -> Dict[str, str]:
+    """read_judge_categories
+
+    Args:
+        store (dict): the assignments, from assignment_store.read_assignments
+
+    Returns:
+        dict: mapping of [judge name] -> [category]
+    """
+    return {name: str(store['categories'][code]) for name, code in zip(judge_names(store), store['judge_category'])}
+
+
+def find_unassigned_scores(scores: pd.DataFrame, store: dict) -> np.ndarray:
+    """find_unassigned_scores
+
+    Args:
+        scores (pd.DataFrame): from read_scores
+        store (dict): from assignment_store.read_assignments
+
+    Returns:
+        np.ndarray: boolean mask of the scores of judges that are in the assignments, for
+                    abstracts that were not assigned to them (e.g. a typo in the abstract id)
+    """
+    judge_pos = {name: idx for idx, name in enumerate(judge_names(store))}
+    return np.array([judge in judge_pos and judge_pos[judge] not in abstract_judges(store, abs_id)
+                     for judge, abs_id in zip(scores['judge'], scores['abstract id'])], dtype=bool)
+
+
+def read_scores(scores_file: str) -> pd.DataFrame:
+    """read_scores
+
+    Read the long format scores file. Rows without a score (e.g. not entered yet) are dropped.
+
+    Args:
+        scores_file (str): csv or excel file with the columns judge, abstract id and score
+
+    Returns:
+        pd.DataFrame: with the columns judge, abstract id and score
+    """
+    if scores_file.endswith('.csv'):
+        scores = pd.read_csv(scores_file)
+    else:
+        scores = read_excel_cached(scores_file)
+
+    scores = scores[['judge', 'abstract id', 'score']].dropna()
+    scores['judge'] = scores['judge'].astype(str).str.strip()
+    scores['abstract id'] = scores['abstract id'].astype(int)
+    scores['score'] = scores['score'].astype(float)
+
+    return scores.reset_index(drop=True)
+
+
+def fit_mixed_model(judge_idx: np.ndarray, abstract_idx: np.ndarray, y: np.ndarray, num_judges: int, num_abstracts: int,
+                    max_iter: int = 100, tol: float = 1e-4, prior_df: float = 4.0) -> dict:
+    """fit_mixed_model
+
+    Fit the mixed effects model in the module docstring.
+
+    Args:
+        judge_idx (np.ndarray): judge of each score, in [0, num_judges)
+        abstract_idx (np.ndarray): abstract of each score, in [0, num_abstracts)
+        y (np.ndarray): the scores
+        num_judges (int): number of judges
+        num_abstracts (int): number of abstracts, every abstract needs at least one score
+        max_iter (int): maximum number of EM iterations
+        tol (float): stop once the variance components change by less than this (relative)
+        prior_df (float): weight of the pooled residual variance in each judge's scale, in
+                          number of scores
+
+    Returns:
+        dict: with the keys
+            - abstract_effect, abstract_se: adjusted score of each abstract and its standard error
+            - judge_effect, judge_se: leniency of each judge and its standard error
+            - judge_scale: residual standard deviation of each judge
+            - sigma_judge: standard deviation of the judge leniencies
+            - iterations: number of EM iterations run
+    """
+    n = len(y)
+    num_scores = np.bincount(judge_idx, minlength=num_judges)
+    sigma2 = np.var(y) if n > 1 and np.var(y) > 0 else 1.0
+    floor = 1e-6 * sigma2
+    sigma2_judge = sigma2 / 2
+    sigma2_j = np.full(num_judges, sigma2)
+
+    # judges that never scored the same abstract are only linked through the variance
+    # components, so S is block diagonal, with one block per connected group of judges
+    # (in practice, one per category), and each block can be factorized on its own
+    incidence = csr_matrix((np.ones(n), (abstract_idx, judge_idx)), shape=(num_abstracts, num_judges))
+    num_groups, group = connected_components(incidence.T @ incidence, directed=False)
+    blocks = [np.nonzero(group == g)[0] for g in range(num_groups)]
+
+    judge_effect = np.zeros(num_judges)
+    for iteration in range(1, max_iter + 1):
+        w = 1 / sigma2_j[judge_idx]
+
+        # weighted blocks of the mixed model equations. A = X'WX is diagonal
+        a = np.bincount(abstract_idx, weights=w, minlength=num_abstracts)
+        B = csr_matrix((w, (abstract_idx, judge_idx)), shape=(num_abstracts, num_judges))
+        xwy = np.bincount(abstract_idx, weights=w * y, minlength=num_abstracts)
+        zwy = np.bincount(judge_idx, weights=w * y, minlength=num_judges)
+        zwz = np.bincount(judge_idx, weights=w, minlength=num_judges)
+
+        # eliminate the abstract effects: S = Z'WZ + I / sigma_judge^2 - B' A^-1 B
+        C = diags(1 / a) @ B
+        S = (diags(zwz + 1 / sigma2_judge) - B.T @ C).tocsr()
+        rhs = zwy - C.T @ xwy
+
+        S_inv = []
+        for block in blocks:
+            cho = cho_factor(S[block][:, block].toarray())
+            judge_effect[block] = cho_solve(cho, rhs[block])
+            # inverse from the cholesky factor. only one triangle of it is filled in, which is
+            # enough for the trace, so it is only made symmetric once the loop is done
+            S_inv.append((lapack.dpotri(cho[0], lower=cho[1])[0], cho[1]))
+        abstract_effect = (xwy - B @ judge_effect) / a
+
+        # EM updates of the variance components
+        resid = y - abstract_effect[abstract_idx] - judge_effect[judge_idx]
+        trace = sum(np.trace(inv) for inv, _ in S_inv)
+        new_sigma2_judge = max((judge_effect @ judge_effect + trace) / num_judges, floor)
+        new_sigma2 = max(resid @ resid / max(n - num_abstracts, 1), floor)
+        # the abstract effects use up n - num_abstracts of the degrees of freedom, which are
+        # shared out over the judges in proportion to their number of scores
+        rss = np.bincount(judge_idx, weights=resid ** 2, minlength=num_judges)
+        dof = num_scores * max(n - num_abstracts, 1) / n
+        new_sigma2_j = np.maximum((prior_df * new_sigma2 + rss) / (prior_df + dof), floor)
+
+        change = max(abs(new_sigma2_judge - sigma2_judge) / sigma2_judge,
+                     np.max(np.abs(new_sigma2_j - sigma2_j) / sigma2_j))
+        sigma2_judge, sigma2, sigma2_j = new_sigma2_judge, new_sigma2, new_sigma2_j
+        log.debug('EM iteration %d: sigma_judge %.4f, sigma %.4f, change %.2e',
+                  iteration, np.sqrt(sigma2_judge), np.sqrt(sigma2), change)
+        if change < tol:
+            break
+
+    # var(abstract effects) = diag(A^-1 + C S^-1 C'), with C = A^-1 B
+    abstract_var = 1 / a
+    judge_var = np.empty(num_judges)
+    for block, (inv, lower) in zip(blocks, S_inv):
+        inv = np.tril(inv) + np.tril(inv, -1).T if lower else np.triu(inv) + np.triu(inv, 1).T
+        C_block = C[:, block]
+        abstract_var = abstract_var + np.asarray(C_block.multiply(C_block @ inv).sum(axis=1)).ravel()
+        judge_var[block] = np.diag(inv)
+
+    return {
+        'abstract_effect': abstract_effect,
+        'abstract_se': np.sqrt(abstract_var),
+        'judge_effect': judge_effect,
+        'judge_se': np.sqrt(judge_var),
+        'judge_scale': np.sqrt(sigma2_j),
+        'sigma_judge': np.sqrt(sigma2_judge),
+        'iterations': iteration,
+    }
+
+
+def rank_abstracts(scores: pd.DataFrame, judge_categories: Dict[str, str], max_iter: int = 100) -> Union[pd.DataFrame, pd.DataFrame]:
+    """rank_abstracts
+
+    Fit the mixed effects model to the scores, and rank the abstracts.
+
+    Args:
+        scores (pd.DataFrame): from read_scores
+        judge_categories (dict): from read_judge_categories
+        max_iter (int): maximum number of EM iterations
+
+    Returns:
+        Union[pd.DataFrame, pd.DataFrame]: the abstract rankings and the judge effects
+    """
+    unknown = ~scores['judge'].isin(judge_categories.keys())
+    if unknown.any():
+        log.warning('ignoring %d scores from judges that are not in the assignments: %s',
+                    unknown.sum(), sorted(scores.loc[unknown, 'judge'].unique()))
+        scores = scores.loc[~unknown]
+
+    judge_codes, judges = pd.factorize(scores['judge'])
+    abstract_codes, abstracts = pd.factorize(scores['abstract id'])
+    log.info('fitting mixed effects model to %d scores of %d abstracts by %d judges',
+             len(scores), len(abstracts), len(judges))
+
+    fit = fit_mixed_model(judge_codes, abstract_codes, scores['score'].to_numpy(dtype=float),
+                          len(judges), len(abstracts), max_iter=max_iter)
+    if fit['iterations'] == max_iter:
+        # usually because the judges hardly differ in leniency, and sigma_judge is going to 0 slowly
+        log.warning('variance components did not converge in %d iterations, judge leniency sd %.3f',
+                    max_iter, fit['sigma_judge'])
+    else:
+        log.info('converged after %d iterations, judge leniency sd %.3f', fit['iterations'], fit['sigma_judge'])
+
+    # the category of an abstract is the category of the judges that scored it
+    categories = scores.drop_duplicates('abstract id').set_index('abstract id')['judge'].map(judge_categories)
+
+    rankings = pd.DataFrame({
+        'abstract id': abstracts,
+        'category': categories.reindex(abstracts).to_numpy(),
+        'scores': np.bincount(abstract_codes, minlength=len(abstracts)),
+        'raw mean': scores.groupby(abstract_codes)['score'].mean().to_numpy(),
+        'adjusted score': fit['abstract_effect'],
+        'se': fit['abstract_se'],
+    })
+
+    # z-scores within each category, so that the categories can be ranked together
+    by_cat = rankings.groupby('category')['adjusted score']
+    spread = by_cat.transform('std').fillna(1.0).replace(0, 1.0)
+    rankings['z score'] = (rankings['adjusted score'] - by_cat.transform('mean')) / spread
+    rankings['z se'] = rankings['se'] / spread
+    rankings['category rank'] = rankings.groupby('category')['z score'].rank(ascending=False, method='min').astype(int)
+    rankings['overall rank'] = rankings['z score'].rank(ascending=False, method='min').astype(int)
+    rankings = rankings.sort_values(['category', 'category rank']).reset_index(drop=True)
+
+    judge_effects = pd.DataFrame({
+        'category': [judge_categories[judge] for judge in judges],
+        'judge': judges,
+        'scores': np.bincount(judge_codes, minlength=len(judges)),
+        'leniency': fit['judge_effect'],
+        'leniency se': fit['judge_se'],
+        'scale': fit['judge_scale'],
+    }).sort_values(['category', 'leniency']).reset_index(drop=True)
+
+    return rankings, judge_effects
+
+
+def run_scoring(args: dict, judge_categories: Dict[str, str] = None) -> Union[pd.DataFrame, pd.DataFrame]:
+    """run_scoring
+
+    Read the scores, fit the model and write abstract_rankings.csv and judge_effects.csv.
+
+    Args:
+        args (dict): options from add_arguments
+        judge_categories (dict): mapping of [judge name] -> [category]. if None, read from
+                                 args['assignments']
+
+    Returns:
+        Union[pd.DataFrame, pd.DataFrame]: the abstract rankings and judge effects
+    """
+    with stage('read'):
+        scores = read_scores(args['scores'])
+        if judge_categories is None:
+            store = read_assignments(args['assignments'])
+            judge_categories = read_judge_categories(store)
+            unassigned = find_unassigned_scores(scores, store)
+            if unassigned.any():
+                log.warning('%d scores are for abstracts that were not assigned to the judge, check the abstract ids:\n%s',
+                            unassigned.sum(), scores.loc[unassigned].to_string(index=False))
+
+    with stage('fit'):
+        rankings, judge_effects = rank_abstracts(scores, judge_categories, max_iter=args['max_iter'])
+
+    os.makedirs(args['outdir'], exist_ok=True)
+    rankings.to_csv(os.path.join(args['outdir'], 'abstract_rankings.csv'), index=False)
+    judge_effects.to_csv(os.path.join(args['outdir'], 'judge_effects.csv'), index=False)
+    log.info('wrote rankings of %d abstracts to %s', len(rankings), args['outdir'])
+
+    return rankings, judge_effects
+
+
+def main():
+
+    args = parse_command_line()
+    run_scoring(args)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
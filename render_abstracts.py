@@ -0,0 +1,432 @@
+"""render_abstracts.py
+
+Render the anonymized abstract pdf straight from the abstract submissions, instead of mail
+merging mailmerge_abstract_judging_template.docx in Word and saving the result as a pdf.
+
+Each abstract gets the same fields as the mail merge template: the abstract id, the title, the
+Background / Methods / Results / Conclusion sections and the freeform abstract text. Nothing that
+identifies the student (names, authors, email) is rendered.
+
+Abstracts that do not fit on a single page continue onto as many pages as they need, and the
+pages of each abstract are recorded in abstract_pages.csv, so that preprocess_abs.py --page_ranges
+can split the pdf without assuming one page per abstract, or that the pages are in the same order
+as the ids.
+
+The pdf is written directly, with the standard Helvetica fonts that every pdf viewer has, so this
+runs offline and needs nothing beyond the Python standard library. Text is wrapped with the
+Helvetica character widths. The abstracts are laid out across a process pool with --jobs.
+
+The standard fonts only have the WinAnsiEncoding (cp1252) characters, so Greek letters, math
+symbols and super / subscripts are spelled out first (TNF-α -> TNF-alpha, ≥ -> >=, CD4⁺ -> CD4+,
+see TRANSLITERATIONS), and accents that cp1252 does not have are dropped. Anything that is still
+left is printed as '?', and listed in a warning for each abstract that has it, so that it can be
+checked in the pdf.
+
+Usage:
+
+    python render_abstracts.py --students MSRS2021/inputs/student_abstracts.xlsx --students_tab PROCESSING_READY --outdir MSRS2021/
+"""
+import argparse
+import logging
+import os
+import unicodedata
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import pandas as pd
+
+from assign_abstracts import add_id_arguments, id_space_from_args, preprocess_abstract_submissions
+from instrumentation import LOG_LEVELS, setup_logging, stage
+
+log = logging.getLogger(__name__)
+
+# US letter, with 1 inch margins
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792
+MARGIN = 72
+FONT_SIZE = 10
+LEADING = 12.5
+
+# [column of the submissions sheet] -> label, in the same order as the mail merge template
+SECTIONS = [
+    ('Background', 'Background:'),
+    ('Methods', 'Methods:'),
+    ('Results', 'Results:'),
+    ('Conclusion', 'Conclusion:'),
+    ('Please enter your abstract text below:', 'Freeform Abstract:'),
+]
+
+# widths of the printable ascii characters (space to ~) in 1/1000 of the font size, from the
+# Adobe font metrics of the standard 14 fonts
+HELVETICA_WIDTHS = dict(zip(map(chr, range(32, 127)), [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]))
+HELVETICA_BOLD_WIDTHS = dict(zip(map(chr, range(32, 127)), [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+]))
+# punctuation that Word likes to put in, which WinAnsiEncoding has but ascii does not
+EXTRA_WIDTHS = {'‘': 222, '’': 222, '“': 333, '”': 333, '–': 556, '—': 1000,
+                '…': 1000, '•': 350, '±': 584, '°': 400, 'µ': 556, '×': 584}
+
+FONTS = {'regular': ('/F1', HELVETICA_WIDTHS), 'bold': ('/F2', HELVETICA_BOLD_WIDTHS)}
+
+# spelled out forms of the characters that come up in abstracts but are not in WinAnsiEncoding
+TRANSLITERATIONS = {
+    'α': 'alpha', 'β': 'beta', 'γ': 'gamma', 'δ': 'delta', 'ε': 'epsilon', 'ζ': 'zeta', 'η': 'eta',
+    'θ': 'theta', 'ι': 'iota', 'κ': 'kappa', 'λ': 'lambda', 'μ': 'µ', 'ν': 'nu', 'ξ': 'xi',
+    'π': 'pi', 'ρ': 'rho', 'σ': 'sigma', 'ς': 'sigma', 'τ': 'tau', 'υ': 'upsilon', 'φ': 'phi',
+    'χ': 'chi', 'ψ': 'psi', 'ω': 'omega',
+    'Γ': 'Gamma', 'Δ': 'Delta', 'Θ': 'Theta', 'Λ': 'Lambda', 'Ξ': 'Xi', 'Π': 'Pi', 'Σ': 'Sigma',
+    'Φ': 'Phi', 'Ψ': 'Psi', 'Ω': 'Omega',
+    '≥': '>=', '≤': '<=', '≠': '!=', '≈': '~', '∼': '~', '−': '-', '∓': '-/+', '→': '->',
+    '←': '<-', '↔': '<->', '⇒': '=>', '∞': 'infinity',
+    '√': 'sqrt', '∑': 'sum', '∆': 'Delta', '‐': '-', '‑': '-', '‒': '-', '′': "'", '″': "''",
+    '\u2009': ' ', '\u202f': ' ', '\u200b': '', '\ufeff': '',
+    '⁰': '0', '⁴': '4', '⁵': '5', '⁶': '6', '⁷': '7', '⁸': '8', '⁹': '9', '⁺': '+', '⁻': '-',
+    '₀': '0', '₁': '1', '₂': '2', '₃': '3', '₄': '4', '₅': '5', '₆': '6', '₇': '7', '₈': '8',
+    '₉': '9', '₊': '+', '₋': '-',
+}
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """add_arguments
+
+    Add the command line options of the renderer to parser, so that they can be shared by this
+    script and the msrs render subcommand.
+    """
+    parser.add_argument('--students', action="store", type=str, required=True,
+                        help='file containing abstract submissions, as passed to assign_abstracts.py'
+                        )
+    parser.add_argument('--students_tab', action="store", type=str,
+                        help='the tab within the students file to be read'
+                        )
+    parser.add_argument('--outdir', action="store", type=str, required=True,
+                        help='directory in which abstracts_merged.pdf and abstract_pages.csv should be written'
+                        )
+    parser.add_argument('--jobs', action="store", type=int, default=1,
+                        help='number of processes used to lay out the abstracts'
+                        )
+    parser.add_argument('--no_cache', action="store_true",
+                        help='always parse the excel file, instead of loading it from the cache'
+                        )
+    add_id_arguments(parser)
+    parser.add_argument('--log_level', '--log-level', action="store", type=str, default='INFO', choices=LOG_LEVELS,
+                        help='only log messages at or above this level'
+                        )
+
+    return parser
+
+
+def parse_command_line():
+
+    parser = argparse.ArgumentParser(
+        description='render the anonymized abstract pdf from the abstract submissions, without a word mail merge')
+
+    args = vars(add_arguments(parser).parse_args())
+
+    setup_logging(args['log_level'])
+    log.debug('%s', args)
+    return args
+
+
+def char_width(ch: str, widths: Dict[str, int]) -> int:
+    """char_width
+
+    Returns:
+        int: width of ch in 1/1000 of the font size. accented letters are as wide as the letter
+             without the accent, and anything else that is unknown is as wide as a digit
+    """
+    if ch in widths:
+        return widths[ch]
+    if ch in EXTRA_WIDTHS:
+        return EXTRA_WIDTHS[ch]
+    base = unicodedata.normalize('NFKD', ch)[:1]
+    return widths.get(base, 556)
+
+
+def wrap_text(text: str, font: str, max_width: float, size: float = FONT_SIZE) -> List[str]:
+    """wrap_text
+
+    Break text into lines that fit in max_width points, at spaces where possible. Line breaks in
+    the text are kept, and words that are longer than a whole line are broken up.
+
+    Args:
+        text (str): the text to wrap
+        font (str): 'regular' or 'bold'
+        max_width (float): width available for each line, in points
+        size (float): font size in points
+
+    Returns:
+        List[str]: the lines
+    """
+    widths = FONTS[font][1]
+    limit = max_width * 1000 / size
+    space = char_width(' ', widths)
+
+    lines = []
+    for paragraph in text.splitlines() or ['']:
+        line, line_width = [], 0
+        for word in paragraph.split():
+            word_width = sum(char_width(ch, widths) for ch in word)
+            if line and line_width + space + word_width > limit:
+                lines.append(' '.join(line))
+                line, line_width = [], 0
+
+            while word_width > limit:
+                # break up words that do not fit on a line by themselves (e.g. long urls)
+                cut, cut_width = 0, 0
+                while cut_width + char_width(word[cut], widths) <= limit:
+                    cut_width += char_width(word[cut], widths)
+                    cut += 1
+                lines.append(word[:max(cut, 1)])
+                word = word[max(cut, 1):]
+                word_width = sum(char_width(ch, widths) for ch in word)
+
+            line_width += (space if line else 0) + word_width
+            line.append(word)
+        lines.append(' '.join(line))
+
+    return lines
+
+
+def to_win_ansi(text: str) -> Tuple[str, List[str]]:
+    """to_win_ansi
+
+    Args:
+        text (str): any text
+
+    Returns:
+        str: text with only WinAnsiEncoding characters, with TRANSLITERATIONS spelled out,
+             unsupported accents dropped, and '?' for anything else
+        List[str]: the characters that had to be replaced with '?', in the order they come up
+    """
+    chars, replaced = [], []
+    for ch in text:
+        try:
+            ch.encode('cp1252')
+        except UnicodeEncodeError:
+            if ch in TRANSLITERATIONS:
+                ch = TRANSLITERATIONS[ch]
+            else:
+                # e.g. the o of Erdős, which cp1252 only has with other accents
+                base = ''.join(c for c in unicodedata.normalize('NFKD', ch) if not unicodedata.combining(c))
+                try:
+                    base.encode('cp1252')
+                    ch = base
+                except UnicodeEncodeError:
+                    if ch not in replaced:
+                        replaced.append(ch)
+                    ch = '?'
+        chars.append(ch)
+
+    return ''.join(chars), replaced
+
+
+def pdf_string(text: str) -> bytes:
+    """pdf_string
+
+    Returns:
+        bytes: text as a pdf string literal in WinAnsiEncoding, see to_win_ansi
+    """
+    text = to_win_ansi(text)[0].encode('cp1252')
+    return b'(' + text.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def layout_abstract(abstract: dict) -> Tuple[List[bytes], List[str]]:
+    """layout_abstract
+
+    Lay out a single anonymized abstract over as many pages as it needs.
+
+    Args:
+        abstract (dict): 'ids', 'Title' and the columns in SECTIONS for one abstract
+
+    Returns:
+        List[bytes]: the content stream of each page
+        List[str]: the characters of the abstract that could not be rendered, see to_win_ansi
+    """
+    text_width = PAGE_WIDTH - 2 * MARGIN
+    replaced = []
+
+    def win_ansi(text):
+        # spelled out before wrapping, so that the lines are wrapped at their printed width
+        text, missing = to_win_ansi(text)
+        replaced.extend(ch for ch in missing if ch not in replaced)
+        return text
+
+    # (font, text) for every line, with None for a blank line
+    lines = [('bold', 'Student ID: %d' % abstract['ids']), None, ('bold', 'Title:')]
+    title = abstract['Title'] if isinstance(abstract['Title'], str) else ''
+    lines += [('regular', line) for line in wrap_text(win_ansi(title), 'regular', text_width)]
+    for column, label in SECTIONS:
+        text = abstract.get(column)
+        if not isinstance(text, str) or not text.strip():
+            continue
+        lines += [None, ('bold', label)]
+        lines += [('regular', line) for line in wrap_text(win_ansi(text.strip()), 'regular', text_width)]
+
+    # leave room for the footer that marks which page of the abstract this is
+    lines_per_page = int((PAGE_HEIGHT - 2 * MARGIN - 2 * LEADING) // LEADING)
+    # blank lines at the top of a continuation page are dropped
+    pages = [[]]
+    for line in lines:
+        if len(pages[-1]) == lines_per_page:
+            pages.append([])
+        if line is None and not pages[-1]:
+            continue
+        pages[-1].append(line)
+
+    streams = []
+    for page_num, page_lines in enumerate(pages, start=1):
+        ops = []
+        y = PAGE_HEIGHT - MARGIN - FONT_SIZE
+        for line in page_lines:
+            if line is not None:
+                font, text = line
+                ops.append(b'BT %s %d Tf 1 0 0 1 %d %.2f Tm %s Tj ET' % (
+                    FONTS[font][0].encode(), FONT_SIZE, MARGIN, y, pdf_string(text)))
+            y -= LEADING
+        if len(pages) > 1:
+            ops.append(b'BT /F1 8 Tf 1 0 0 1 %d %d Tm %s Tj ET' % (
+                MARGIN, MARGIN // 2, pdf_string('Student ID: %d, page %d of %d' % (abstract['ids'], page_num, len(pages)))))
+        streams.append(b'\n'.join(ops))
+
+    return streams, replaced
+
+
+def write_pdf(page_streams: List[bytes], pdf_path: str) -> None:
+    """write_pdf
+
+    Write a pdf with one page for each content stream. All of the pages share the two fonts,
+    regular Helvetica as /F1 and bold as /F2, and the content streams are compressed.
+
+    Args:
+        page_streams (List[bytes]): content stream of each page, e.g. from layout_abstract
+        pdf_path (str): where to write the pdf
+    """
+    num_pages = len(page_streams)
+    # object numbers: 1 catalog, 2 page tree, 3 and 4 fonts, then a (page, content stream) pair per page
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [' + b' '.join(b'%d 0 R' % (5 + 2*i) for i in range(num_pages)) +
+        b'] /Count %d >>' % num_pages,
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>',
+    ]
+    for i, content in enumerate(page_streams):
+        content = zlib.compress(content)
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] '
+                       b'/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents %d 0 R >>' % (
+                           PAGE_WIDTH, PAGE_HEIGHT, 6 + 2*i))
+        objects.append(b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(content) + content + b'\nendstream')
+
+    with open(pdf_path, 'wb') as f:
+        f.write(b'%PDF-1.4\n')
+        offsets = []
+        for num, obj in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(b'%d 0 obj\n' % num + obj + b'\nendobj\n')
+        xref = f.tell()
+        f.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b'%010d 00000 n \n' % offset)
+        f.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref))
+
+    return
+
+
+def render_abstracts(student_df: pd.DataFrame, pdf_path: str, jobs: int = 1) -> pd.DataFrame:
+    """render_abstracts
+
+    Render every abstract in student_df to a single pdf, in the same order as the rows.
+
+    Args:
+        student_df (pd.DataFrame): full students dataframe from preprocess_abstract_submissions,
+                                   with the 'ids' column
+        pdf_path (str): where to write the pdf
+        jobs (int): number of processes used to lay out the abstracts
+
+    Returns:
+        pd.DataFrame: the pages of each abstract, with the columns 'ids', 'first page' and
+                      'last page' (numbered from 1, inclusive)
+    """
+    columns = ['ids', 'Title'] + [column for column, _ in SECTIONS if column in student_df.columns]
+    abstracts = student_df[columns].to_dict('records')
+
+    if jobs > 1:
+        # the abstracts are independent, so send them to the workers in a few large chunks
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            pages = list(executor.map(layout_abstract, abstracts, chunksize=max(1, len(abstracts) // (4 * jobs))))
+    else:
+        pages = [layout_abstract(abstract) for abstract in abstracts]
+
+    for abstract, (_, replaced) in zip(abstracts, pages):
+        if replaced:
+            log.warning("abstract %d has characters that the pdf fonts do not have, and they are printed as '?': %s",
+                        abstract['ids'], ' '.join('%s (U+%04X)' % (ch, ord(ch)) for ch in replaced))
+    pages = [streams for streams, _ in pages]
+
+    write_pdf([stream for abstract_pages in pages for stream in abstract_pages], pdf_path)
+
+    num_pages = [len(abstract_pages) for abstract_pages in pages]
+    last_page = pd.Series(num_pages).cumsum().to_numpy()
+    page_ranges = pd.DataFrame({
+        'ids': [abstract['ids'] for abstract in abstracts],
+        'first page': last_page - num_pages + 1,
+        'last page': last_page,
+    })
+
+    overflow = page_ranges.loc[page_ranges['last page'] > page_ranges['first page'], 'ids']
+    if len(overflow):
+        log.info('%d abstracts did not fit on a single page: %s', len(overflow), list(overflow))
+
+    return page_ranges
+
+
+def run_rendering(args: dict) -> pd.DataFrame:
+    """run_rendering
+
+    Read the submissions, and write abstracts_merged.pdf and abstract_pages.csv to args['outdir'].
+
+    Args:
+        args (dict): options from add_arguments
+
+    Returns:
+        pd.DataFrame: the pages of each abstract, from render_abstracts
+    """
+    _, student_df = preprocess_abstract_submissions(
+        args['students'], args['students_tab'], use_cache=not args['no_cache'],
+        id_registry=args['id_registry'], id_space=id_space_from_args(args))
+
+    os.makedirs(args['outdir'], exist_ok=True)
+    pdf_path = os.path.join(args['outdir'], 'abstracts_merged.pdf')
+
+    with stage('render'):
+        page_ranges = render_abstracts(student_df, pdf_path, jobs=args['jobs'])
+
+    page_ranges.to_csv(os.path.join(args['outdir'], 'abstract_pages.csv'), index=False)
+    log.info('rendered %d abstracts on %d pages to %s', len(page_ranges),
+             page_ranges['last page'].max() if len(page_ranges) else 0, pdf_path)
+
+    return page_ranges
+
+
+def main():
+
+    args = parse_command_line()
+    run_rendering(args)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""seed_search.py
+
+Search over seeds for the greedy assignment, for --search_seeds.
+
+The greedy assignment shuffles the abstracts and breaks ties between equally loaded judges at
+random, so some seeds are unluckier than others: conflicts late in the shuffled order can leave
+an abstract with fewer judges than it needs, or some judges with more abstracts than others.
+Instead of the single seed from --seed, K candidate seeds are tried, and each realization is
+scored on
+
+    - shortfall: judge slots that could not be filled, summed over the abstracts
+    - conflicts assigned: judges given an abstract they have a conflict with (the negative of the
+      conflicts avoided, which the greedy assignment never does, but it is checked anyway)
+    - excess load variance: variance of the number of abstracts per judge, above the smallest
+      variance possible for that many judges and slots (loads that differ by at most 1)
+
+summed over the categories, and compared in that order. The best realization is kept, and its
+seed is logged and written to seed_search.csv, so that running again with --seed set to it gives
+the same assignments without searching.
+
+The first candidate is --seed itself, so the search never does worse than a normal run. The
+conflict index of each category is built once and sent to each worker process once, so each
+candidate only costs the greedy assignment itself. The search stops early at the first candidate
+with no shortfall, no conflicts and the smallest possible load variance, since no other candidate
+can beat it. Candidates are always compared in the same order, so the seed that is picked does
+not depend on the number of processes or the order they finish in.
+"""
+import logging
+import os
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from assign_abstracts import assign_category, derive_seed
+from instrumentation import COUNTERS, counter_snapshot, setup_logging
+
+log = logging.getLogger(__name__)
+
+# entropy that separates the candidate seeds from the per-category seeds of derive_seed
+SEARCH_STREAM = 1
+
+# state of each search worker process, set once by init_search_worker
+_worker = {}
+
+
+def candidate_seeds(seed: int, num_seeds: int) -> List[int]:
+    """candidate_seeds
+
+    Args:
+        seed (int): the seed of a normal run, which is always the first candidate
+        num_seeds (int): number of candidates
+
+    Returns:
+        List[int]: reproducible candidate seeds derived from seed
+    """
+    derived = np.random.SeedSequence([seed, SEARCH_STREAM]).generate_state(max(num_seeds - 1, 0))
+    return [seed] + [int(value) for value in derived]
+
+
+def score_assignment(judge_dict: Dict[str, list], category_df: pd.DataFrame, judges_per_abstract: int,
+                     conflict_index: dict) -> dict:
+    """score_assignment
+
+    Args:
+        judge_dict (Dict[str, list]): mapping of [judge name] -> [list of abstract ids]
+        category_df (pd.DataFrame): abstract submissions in the category
+        judges_per_abstract (int): number of judges that should see each abstract
+        conflict_index (dict): from build_conflict_index
+
+    Returns:
+        dict: with the keys shortfall, conflicts_assigned, conflicts_avoided, load_variance and
+              excess_variance
+    """
+    judges_of = Counter(abs_id for abs_list in judge_dict.values() for abs_id in abs_list)
+    to_judge = category_df.loc[category_df.iloc[:, 3] == 'Yes', 'ids']
+    shortfall = sum(max(0, judges_per_abstract - judges_of[abs_id]) for abs_id in to_judge)
+
+    matrix, judge_pos, abstract_pos = conflict_index['matrix'], conflict_index['judge_pos'], conflict_index['abstract_pos']
+    conflicts_assigned = sum(int(matrix[judge_pos[name], abstract_pos[abs_id]])
+                             for name, abs_list in judge_dict.items() for abs_id in abs_list)
+
+    loads = np.array([len(abs_list) for abs_list in judge_dict.values()])
+    load_variance = excess_variance = 0.0
+    if len(loads):
+        # the variance is smallest when the loads differ by at most 1
+        remainder = loads.sum() % len(loads)
+        load_variance = float(loads.var())
+        excess_variance = max(0.0, load_variance - remainder * (len(loads) - remainder) / len(loads) ** 2)
+
+    return {
+        'shortfall': int(shortfall),
+        'conflicts_assigned': conflicts_assigned,
+        'conflicts_avoided': len(conflict_index['conflicts']) - conflicts_assigned,
+        'load_variance': load_variance,
+        'excess_variance': excess_variance,
+    }
+
+
+def init_search_worker(tasks: List[dict], log_level: str) -> None:
+    """init_search_worker
+
+    Keep the category tasks, with their conflict indexes, in the worker process, so that they are
+    sent to each worker once instead of with every candidate seed.
+    """
+    # the warnings of the candidates that are not kept are only noise
+    setup_logging('ERROR' if log_level != 'DEBUG' else log_level)
+    _worker['tasks'] = tasks
+
+    return
+
+
+def try_seed(candidate: int) -> dict:
+    """try_seed
+
+    Assign every category with the per-category seeds derived from candidate, as a normal run
+    with --seed candidate would, and score the result.
+
+    Args:
+        candidate (int): candidate seed
+
+    Returns:
+        dict: with the keys seed, results (from assign_category, for each category) and score (the
+              scores from score_assignment, summed over the categories)
+    """
+    results = []
+    score = Counter()
+    for cat_idx, task in enumerate(_worker['tasks']):
+        result = assign_category(dict(task, seed=derive_seed(candidate, cat_idx)))
+        results.append(result)
+        score.update(score_assignment(result['judge_dict'], task['id_df'], task['judges_per_abstract'],
+                                      result['conflict_index']))
+
+    return {'seed': candidate, 'results': results, 'score': dict(score)}
+
+
+def score_key(score: dict) -> tuple:
+    """score_key
+
+    Returns:
+        tuple: sort key of a score, lower is better
+    """
+    return score['shortfall'], score['conflicts_assigned'], round(score['excess_variance'], 9)
+
+
+def search_seeds(tasks: List[dict], seed: int, num_seeds: int, workers: int, log_level: str = 'INFO') -> dict:
+    """search_seeds
+
+    Args:
+        tasks (List[dict]): the assign_category task of each category, in category order. each task
+                            should have its conflict_index already, so that it is built only once
+        seed (int): seed of a normal run, see candidate_seeds
+        num_seeds (int): number of candidate seeds to try
+        workers (int): number of processes, or 1 to try the seeds in this process
+        log_level (str): log level of the worker processes
+
+    Returns:
+        dict: with the keys
+            - seed: the seed of the best candidate
+            - results: from assign_category, for each category of the best candidate. the
+                       counters of the candidates are not added to COUNTERS, only the number of
+                       candidates tried, so the caller should merge the 'counters' of these results
+            - score: the score of the best candidate
+            - tried: one row per candidate that was tried, with its seed and score
+    """
+    candidates = candidate_seeds(seed, num_seeds)
+    done = {}
+
+    def is_perfect(idx):
+        return score_key(done[idx]['score']) == (0, 0, 0)
+
+    def first_perfect():
+        return min((idx for idx in done if is_perfect(idx)), default=None)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_search_worker,
+                                 initargs=(tasks, log_level)) as executor:
+            # only a couple of candidates per worker are in flight at a time, so that the search
+            # can stop early without waiting on a long queue
+            pending = {}
+            next_idx = 0
+            while pending or next_idx < len(candidates):
+                stop = first_perfect()
+                while next_idx < len(candidates) and len(pending) < 2 * workers and stop is None:
+                    pending[executor.submit(try_seed, candidates[next_idx])] = next_idx
+                    next_idx += 1
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done[pending.pop(future)] = future.result()
+                # candidates after a perfect one cannot be picked, but the ones before it can
+                stop = first_perfect()
+                if stop is not None:
+                    for future in [future for future, idx in pending.items() if idx > stop]:
+                        future.cancel()
+                        pending.pop(future)
+    else:
+        init_search_worker(tasks, log_level)
+        # this process keeps its own log level
+        setup_logging(log_level)
+        # the candidates add to the counters of this process, which worker processes do not, so
+        # they are put back afterwards, and the caller merges the counters of the best candidate
+        # either way
+        snapshot = counter_snapshot()
+        for idx, candidate in enumerate(candidates):
+            done[idx] = try_seed(candidate)
+            if is_perfect(idx):
+                break
+        COUNTERS.clear()
+        COUNTERS.update(snapshot)
+
+    best_idx = min(done, key=lambda idx: (score_key(done[idx]['score']), idx))
+    if first_perfect() is not None:
+        stop = first_perfect()
+        done = {idx: result for idx, result in done.items() if idx <= stop}
+        log.info('stopped the seed search at candidate %d / %d, which has full coverage and balanced loads',
+                 stop + 1, len(candidates))
+
+    COUNTERS['seed_candidates_tried'] += len(done)
+    tried = pd.DataFrame([{'candidate': idx, 'seed': done[idx]['seed'], **done[idx]['score']} for idx in sorted(done)])
+    best = done[best_idx]
+    log.info('best of %d seeds: %d (shortfall %d, conflicts avoided %d, load variance %.3f), rerun with --seed %d to reproduce it',
+             len(done), best['seed'], best['score']['shortfall'], best['score']['conflicts_avoided'],
+             best['score']['load_variance'], best['seed'])
+
+    return {'seed': best['seed'], 'results': best['results'], 'score': best['score'], 'tried': tried}
+
+
+def write_seed_report(search: dict, outdir: str) -> None:
+    """write_seed_report
+
+    Write the score of every candidate from search_seeds to seed_search.csv, best first.
+
+    Args:
+        search (dict): from search_seeds
+        outdir (str): directory to write the report to
+    """
+    tried = search['tried'].sort_values(['shortfall', 'conflicts_assigned', 'excess_variance', 'candidate'])
+    tried.to_csv(os.path.join(outdir, 'seed_search.csv'), index=False)
+
+    return